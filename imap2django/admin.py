@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Account, Mailbox, Person, Message, MailboxMessage, Thread, Attachment, Recipient, ImportCheckpoint
+from .models import Account, Mailbox, Person, Message, MailboxMessage, Thread, Attachment, Recipient, ImportCheckpoint, RebuildProgress
 
 admin.site.register(Account)
 admin.site.register(Mailbox)
@@ -10,3 +10,4 @@ admin.site.register(Thread)
 admin.site.register(Attachment)
 admin.site.register(Recipient)
 admin.site.register(ImportCheckpoint)
+admin.site.register(RebuildProgress)
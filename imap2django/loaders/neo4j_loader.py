@@ -1,65 +1,194 @@
 """
-Neo4j loader stub.
+Neo4j loader.
 You can keep SQL as primary, or switch backend=neo4j in the command.
 
-This file is intentionally minimal. It shows the pattern: MERGE by unique keys.
+Neo4jLoader keeps one driver (and its connection pool) for the whole run and
+writes a batch with a single parametrized UNWIND query: MERGE by unique keys
+for accounts, mailboxes, messages, people, recipients and threads.
 """
+import atexit
+from typing import Any, Dict, List, Optional
 from django.conf import settings
+from ..services.normalizer import ImportItem
+from ..services.threading import thread_key_for
 
-def load_neo4j(*args, **kwargs):
-    from neo4j import GraphDatabase
-
-    if not settings.NEO4J_URI:
-        raise RuntimeError("Neo4j not configured. Set NEO4J_URI/USER/PASSWORD in .env")
-
-    driver = GraphDatabase.driver(settings.NEO4J_URI, auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD))
-
-    account_email = kwargs["account_email"]
-    provider = kwargs.get("provider", "")
-    mailbox_name = kwargs["mailbox_name"]
-    uid = kwargs["uid"]
-    flags = kwargs.get("flags") or []
-    internal_date = kwargs.get("internal_date")
-    n = kwargs["normalized"]
-
-    cypher = """
-    MERGE (a:Account {email:$account_email})
-      ON CREATE SET a.provider=$provider
-    MERGE (m:Mailbox {key:$mailbox_key})
-      ON CREATE SET m.name=$mailbox_name
-    MERGE (a)-[:HAS_MAILBOX]->(m)
-
-    MERGE (msg:Message {raw_sha256:$raw_sha256})
-      ON CREATE SET msg.message_id=$message_id,
-                    msg.content_fingerprint=$content_fingerprint,
-                    msg.subject=$subject,
-                    msg.subject_norm=$subject_norm,
-                    msg.date=$date,
-                    msg.internal_date=$internal_date,
-                    msg.size=$size
-
-    MERGE (m)-[c:CONTAINS {uid:$uid}]->(msg)
-      SET c.flags=$flags
+CONSTRAINTS = [
+    "CREATE CONSTRAINT account_email IF NOT EXISTS FOR (a:Account) REQUIRE a.email IS UNIQUE",
+    "CREATE CONSTRAINT mailbox_key IF NOT EXISTS FOR (m:Mailbox) REQUIRE m.key IS UNIQUE",
+    "CREATE CONSTRAINT message_sha IF NOT EXISTS FOR (msg:Message) REQUIRE msg.raw_sha256 IS UNIQUE",
+    "CREATE CONSTRAINT person_email IF NOT EXISTS FOR (p:Person) REQUIRE p.email IS UNIQUE",
+    "CREATE CONSTRAINT thread_key IF NOT EXISTS FOR (t:Thread) REQUIRE t.key IS UNIQUE",
+]
+
+BATCH_CYPHER = """
+MERGE (a:Account {email:$account_email})
+  ON CREATE SET a.provider=$provider
+MERGE (m:Mailbox {key:$mailbox_key})
+  ON CREATE SET m.name=$mailbox_name
+MERGE (a)-[:HAS_MAILBOX]->(m)
+WITH m
+UNWIND $rows AS row
+MERGE (msg:Message {raw_sha256:row.raw_sha256})
+  ON CREATE SET msg.message_id=row.message_id,
+                msg.content_fingerprint=row.content_fingerprint,
+                msg.subject=row.subject,
+                msg.subject_norm=row.subject_norm,
+                msg.date=row.date,
+                msg.internal_date=row.internal_date,
+                msg.size=row.size
+MERGE (m)-[c:CONTAINS {uid:row.uid}]->(msg)
+  SET c.flags=row.flags
+MERGE (t:Thread {key:row.thread_key})
+  ON CREATE SET t.subject_norm=row.subject_norm
+MERGE (msg)-[:IN_THREAD]->(t)
+FOREACH (s IN row.sender |
+  MERGE (p:Person {email:s.email})
+    ON CREATE SET p.name=s.name
+  MERGE (p)-[:SENT]->(msg))
+FOREACH (r IN row.recipients |
+  MERGE (p:Person {email:r.email})
+    ON CREATE SET p.name=r.name
+  MERGE (msg)-[:RECIPIENT {type:r.type}]->(p))
+"""
+
+def _row(item: ImportItem) -> Dict[str, Any]:
+    n = item.normalized
+    recipients = []
+    for rtype, addrs in (("to", n.to_norm), ("cc", n.cc_norm), ("bcc", n.bcc_norm)):
+        for name, email in addrs:
+            if email:
+                recipients.append({"email": email, "name": name or "", "type": rtype})
+    sender = [{"email": n.from_email_norm, "name": n.from_name or ""}] if n.from_email_norm else []
+    return {
+        "raw_sha256": n.raw_sha256,
+        "message_id": n.message_id or None,
+        "content_fingerprint": n.content_fingerprint,
+        "subject": n.subject,
+        "subject_norm": n.subject_norm,
+        "date": str(n.date_dt) if n.date_dt else None,
+        "internal_date": str(item.internal_date) if item.internal_date else None,
+        "size": n.size,
+        "uid": int(item.uid),
+        "flags": list(item.flags or []),
+        "thread_key": thread_key_for(n.references, n.in_reply_to, n.subject_norm, n.date_dt, n.message_id),
+        "sender": sender,
+        "recipients": recipients,
+    }
+
+class Neo4jLoader:
+    """
+    Usage:
+        with Neo4jLoader() as loader:
+            loader.load_batch(account_email, provider, mailbox_name, items)
+
+    Pass driver= to reuse an existing driver or a RecordingDriver in tests.
+    """
+    def __init__(self, driver=None, database: Optional[str] = None):
+        if driver is None:
+            from neo4j import GraphDatabase
+
+            if not settings.NEO4J_URI:
+                raise RuntimeError("Neo4j not configured. Set NEO4J_URI/USER/PASSWORD in .env")
+            driver = GraphDatabase.driver(settings.NEO4J_URI, auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD))
+        self.driver = driver
+        self.database = database
+        self._constraints_ready = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.driver.close()
+
+    def _session(self):
+        return self.driver.session(database=self.database) if self.database else self.driver.session()
+
+    def ensure_constraints(self):
+        # unique constraints double as the indexes MERGE needs to stay fast
+        if self._constraints_ready:
+            return
+        with self._session() as session:
+            for cypher in CONSTRAINTS:
+                session.run(cypher)
+        self._constraints_ready = True
+
+    def load_batch(self, account_email: str, provider: str, mailbox_name: str, items: List[ImportItem]):
+        if not items:
+            return
+        self.ensure_constraints()
+        params = {
+            "account_email": account_email,
+            "provider": provider or "",
+            "mailbox_key": f"{account_email}:{mailbox_name}",
+            "mailbox_name": mailbox_name,
+            "rows": [_row(it) for it in items],
+        }
+        with self._session() as session:
+            session.execute_write(lambda tx: tx.run(BATCH_CYPHER, params).consume())
+
+class RecordingDriver:
+    """
+    Test double for neo4j.Driver: records every (cypher, params) instead of
+    talking to a server. Inspect .queries after exercising a Neo4jLoader.
     """
+    def __init__(self):
+        self.queries: List[tuple] = []
+        self.closed = False
+
+    def session(self, **kwargs):
+        return _RecordingSession(self)
+
+    def close(self):
+        self.closed = True
+
+class _RecordingSession:
+    def __init__(self, driver: RecordingDriver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
 
-    mailbox_key = f"{account_email}:{mailbox_name}"
-
-    with driver.session() as session:
-        session.run(
-            cypher,
-            account_email=account_email,
-            provider=provider,
-            mailbox_key=mailbox_key,
-            mailbox_name=mailbox_name,
-            raw_sha256=n.raw_sha256,
-            message_id=n.message_id or None,
-            content_fingerprint=n.content_fingerprint,
-            subject=n.subject,
-            subject_norm=n.subject_norm,
-            date=str(n.date_dt) if n.date_dt else None,
-            internal_date=str(internal_date) if internal_date else None,
-            size=n.size,
-            uid=int(uid),
-            flags=list(flags),
-        )
-    driver.close()
+    def run(self, cypher: str, parameters: Optional[Dict[str, Any]] = None, **kwargs):
+        self.driver.queries.append((cypher, dict(parameters or {}, **kwargs)))
+        return _RecordingResult()
+
+    def execute_write(self, fn, *args, **kwargs):
+        return fn(self, *args, **kwargs)
+
+class _RecordingResult:
+    def consume(self):
+        return None
+
+_default_loader: Optional[Neo4jLoader] = None
+
+def _close_default_loader():
+    global _default_loader
+    if _default_loader is not None:
+        _default_loader.close()
+        _default_loader = None
+
+def load_neo4j(*args, loader: Optional[Neo4jLoader] = None, **kwargs):
+    """
+    Single-message entry point kept for compatibility. Writes through `loader`
+    if given, else through one shared loader opened on first use and closed
+    at interpreter exit.
+    """
+    global _default_loader
+    if loader is None:
+        if _default_loader is None:
+            _default_loader = Neo4jLoader()
+            atexit.register(_close_default_loader)
+        loader = _default_loader
+    item = ImportItem(
+        uid=kwargs["uid"],
+        flags=kwargs.get("flags") or [],
+        internal_date=kwargs.get("internal_date"),
+        normalized=kwargs["normalized"],
+    )
+    loader.load_batch(kwargs["account_email"], kwargs.get("provider", ""), kwargs["mailbox_name"], [item])
@@ -1,6 +1,10 @@
+from typing import List, Optional, Tuple
 from django.db import transaction
 from ..models import Account, Mailbox, MailboxMessage
-from ..services.dedup import upsert_message_and_relations
+from ..services.dedup import fill_bodies_bulk, upsert_message_and_relations, upsert_messages_bulk
+from ..services.import_session import FolderSession
+from ..services.metrics import Metrics, measure_stage
+from ..services.normalizer import ImportItem
 
 @transaction.atomic
 def ensure_account_and_mailbox(account_email: str, provider: str, mailbox_name: str):
@@ -16,8 +20,89 @@ def link_mailbox_message(mailbox, message, uid: int, flags: list, modseq=None):
         defaults={"message": message, "flags_json": list(flags or []), "modseq": modseq}
     )
 
-def load_sql(account_email: str, provider: str, mailbox_name: str, uid: int, flags, internal_date, normalized):
-    account, mailbox = ensure_account_and_mailbox(account_email, provider, mailbox_name)
+def link_mailbox_messages_bulk(mailbox, links):
+    """
+    links: iterable of (uid, message_pk, flags, modseq). Upserts on (mailbox, uid).
+    """
+    rows = {}
+    for uid, message_pk, flags, modseq in links:
+        rows[uid] = MailboxMessage(
+            mailbox=mailbox, message_id=message_pk, uid=uid, flags_json=list(flags or []), modseq=modseq
+        )
+    if rows:
+        MailboxMessage.objects.bulk_create(
+            list(rows.values()),
+            update_conflicts=True,
+            unique_fields=["mailbox", "uid"],
+            update_fields=["message", "flags_json", "modseq", "last_seen_at"],
+        )
+
+def unlink_mailbox(mailbox) -> int:
+    """
+    Drops every MailboxMessage of a folder (after a UIDVALIDITY change their
+    uids point nowhere). Messages stay and are re-linked by Message-ID/size.
+    """
+    return MailboxMessage.objects.filter(mailbox=mailbox).delete()[0]
+
+def load_sql(account_email: str, provider: str, mailbox_name: str, uid: int, flags, internal_date, normalized, folder: Optional[FolderSession] = None):
+    if folder:
+        account, mailbox = folder.account, folder.mailbox
+    else:
+        account, mailbox = ensure_account_and_mailbox(account_email, provider, mailbox_name)
     msg, _created = upsert_message_and_relations(normalized, internal_date=internal_date)
     link_mailbox_message(mailbox, msg, uid=uid, flags=flags or [], modseq=None)
     return account, mailbox, msg
+
+@transaction.atomic
+def load_sql_batch(
+    account_email: str,
+    provider: str,
+    mailbox_name: str,
+    items: List[ImportItem],
+    links=(),
+    person_cache=None,
+    folder: Optional[FolderSession] = None,
+    metrics: Optional[Metrics] = None,
+    advance: bool = True,
+):
+    """
+    Batch version of load_sql: persists a whole fetched batch with a handful of
+    set-based statements in one transaction. links are (uid, message_pk, flags)
+    of messages already stored (see header prefetch) that only need a MailboxMessage.
+    With folder (an ImportSession folder) the cached account/mailbox are used and
+    its checkpoint advances to the batch's highest uid in the same transaction,
+    unless advance=False (uids that are not ordered, e.g. archive file hashes).
+    With metrics, the existing-message lookup and the checkpoint update are
+    recorded as the "dedup" and "checkpoint" stages.
+    Returns (account, mailbox, messages) with messages in the same order as items.
+    """
+    if folder:
+        account, mailbox = folder.account, folder.mailbox
+    else:
+        account, mailbox = ensure_account_and_mailbox(account_email, provider, mailbox_name)
+    messages, _created = upsert_messages_bulk(
+        ((it.normalized, it.internal_date) for it in items), person_cache=person_cache, metrics=metrics
+    )
+    ordered = [messages[it.normalized.raw_sha256] for it in items]
+    link_mailbox_messages_bulk(
+        mailbox,
+        [(it.uid, msg.pk, it.flags, None) for it, msg in zip(items, ordered)]
+        + [(uid, pk, flags, None) for uid, pk, flags in links],
+    )
+    if folder and advance:
+        with measure_stage(metrics, "checkpoint"):
+            folder.advance(max([it.uid for it in items] + [uid for uid, _pk, _flags in links], default=0))
+    return account, mailbox, ordered
+
+@transaction.atomic
+def load_bodies_batch(mailbox, items: List[ImportItem], person_cache=None) -> Tuple[int, int]:
+    """
+    Backfill counterpart of load_sql_batch (import_imap --mode bodies): items
+    are full messages fetched again for uids whose Message was imported
+    header-only; each such Message is filled in (see fill_bodies_bulk).
+    No checkpoint moves. Returns (filled, merged).
+    """
+    pks = dict(
+        MailboxMessage.objects.filter(mailbox=mailbox, uid__in=[it.uid for it in items]).values_list("uid", "message_id")
+    )
+    return fill_bodies_bulk([(pks[it.uid], it.normalized) for it in items if it.uid in pks], person_cache)
@@ -0,0 +1,90 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from imap2django.services.parser import ParseOptions
+from imap2django.testing.benchmark import run_benchmark
+from imap2django.testing.corpus import CorpusSpec
+from imap2django.utils import parse_byte_size
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the import stages on a synthetic corpus served by the in-process fake IMAP server. "
+        "Runs against a throwaway test database and prints a JSON report."
+    )
+
+    def add_arguments(self, parser):
+        defaults = CorpusSpec()
+        parser.add_argument("--messages", type=int, default=defaults.messages, help="Distinct messages in the corpus")
+        parser.add_argument("--seed", type=int, default=defaults.seed, help="Same seed, same corpus")
+        parser.add_argument("--folders", default=",".join(defaults.folders), help="Comma-separated folder names")
+        parser.add_argument("--body-size", type=parse_byte_size, default=defaults.body_median, help="Median body text size, e.g. 4K")
+        parser.add_argument("--attachment-size", type=parse_byte_size, default=defaults.attachment_median, help="Median attachment size, e.g. 100K")
+        parser.add_argument("--html-ratio", type=float, default=defaults.html_ratio, help="Share of HTML-only messages")
+        parser.add_argument("--multipart-ratio", type=float, default=defaults.multipart_ratio, help="Share of multipart/alternative messages")
+        parser.add_argument("--attachment-ratio", type=float, default=defaults.attachment_ratio, help="Share of messages with attachments")
+        parser.add_argument("--reply-ratio", type=float, default=defaults.reply_ratio, help="Share of messages replying to an earlier one")
+        parser.add_argument("--thread-depth", type=int, default=defaults.max_thread_depth, help="Max messages per reply chain")
+        parser.add_argument("--duplicate-rate", type=float, default=defaults.duplicate_rate, help="Share of messages also stored in a second folder")
+        parser.add_argument("--batch", type=int, default=200)
+        parser.add_argument("--io", choices=["sync", "async"], default="sync")
+        parser.add_argument("--pipeline", type=int, default=4, help="UID FETCH commands in flight with --io async")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server delays every response")
+        parser.add_argument("--engine", choices=["jwz", "headers"], default="jwz", help="rebuild_threads engine")
+        parser.add_argument("--hash-attachments", action="store_true", help="Stream-decode attachments while parsing")
+        parser.add_argument(
+            "--body-storage", choices=["inline", "table"], default=settings.BODY_STORAGE,
+            help="Where bodies are written (default: BODY_STORAGE)",
+        )
+        parser.add_argument("--output", default="", help="Write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **opts):
+        spec = CorpusSpec(
+            messages=opts["messages"],
+            seed=opts["seed"],
+            folders=tuple(f.strip() for f in opts["folders"].split(",") if f.strip()),
+            body_median=opts["body_size"],
+            attachment_median=opts["attachment_size"],
+            html_ratio=opts["html_ratio"],
+            multipart_ratio=opts["multipart_ratio"],
+            attachment_ratio=opts["attachment_ratio"],
+            reply_ratio=opts["reply_ratio"],
+            max_thread_depth=opts["thread_depth"],
+            duplicate_rate=opts["duplicate_rate"],
+        )
+
+        def log(msg: str):
+            self.stderr.write(msg)
+
+        # like `manage.py test`: a fresh database, dropped afterwards
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(BODY_STORAGE=opts["body_storage"]):
+                report = run_benchmark(
+                    spec,
+                    batch_size=opts["batch"],
+                    io=opts["io"],
+                    pipeline=opts["pipeline"],
+                    latency=opts["latency"],
+                    engine=opts["engine"],
+                    parse_options=ParseOptions(hash_attachments=opts["hash_attachments"]),
+                    log=log,
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        text = json.dumps(report, indent=2)
+        if opts["output"]:
+            with open(opts["output"], "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+            for name, stage in report["stages"].items():
+                log(
+                    f"{name:>16}: {stage['msg_per_s']:>9.1f} msg/s {stage['bytes_per_s'] / 1e6:>8.2f} MB/s "
+                    f"{stage['queries_per_msg'] if stage['queries_per_msg'] is not None else '-':>7} q/msg "
+                    f"peak {stage['peak_rss_mb']} MB"
+                )
+            log(f"Report written to {opts['output']}")
+        else:
+            self.stdout.write(text)
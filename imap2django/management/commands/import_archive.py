@@ -0,0 +1,134 @@
+import contextlib
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from imap2django.services.archive import archive_producer, discover_sources
+from imap2django.services.parse_pool import ParsePool
+from imap2django.services.parser import ParseOptions
+from imap2django.services.person_cache import PersonCache
+from imap2django.services.pipeline import FetchOptions, ImportPipeline
+from imap2django.services.raw_spool import RawSpool
+from imap2django.services.import_session import ImportSession
+from imap2django.utils import parse_byte_size
+from imap2django.loaders.sql_loader import load_sql_batch, unlink_mailbox
+from imap2django.loaders.neo4j_loader import Neo4jLoader
+
+class Command(BaseCommand):
+    help = "Import emails from mbox files, Maildirs or .eml directories (no IMAP server; resumable)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="mbox file, .eml file, Maildir, or a directory containing any of them")
+        parser.add_argument("--account", required=True, help="Account email the messages belong to")
+        parser.add_argument("--provider", default="archive")
+        parser.add_argument("--mailbox", default="", help="Mailbox name (only when path is a single source)")
+        parser.add_argument("--backend", choices=["sql", "neo4j"], default="sql")
+        parser.add_argument("--batch", type=int, default=200)
+        parser.add_argument("--batch-bytes", type=parse_byte_size, default=0, help="Byte budget per batch, e.g. 64M (0 = count only)")
+        parser.add_argument("--max", type=int, default=0, help="Max messages per source (0 = no limit)")
+        parser.add_argument("--workers", type=int, default=0, help="Parser processes (0/1 = parse inline)")
+        parser.add_argument(
+            "--hash-attachments", action="store_true",
+            help="Stream-decode attachments to fill Attachment.sha256 (default: size estimate only)",
+        )
+        parser.add_argument(
+            "--attachment-store", default=settings.ATTACHMENT_STORE_DIR,
+            help="Directory of the content-addressed attachment store (default: ATTACHMENT_STORE_DIR)",
+        )
+        parser.add_argument(
+            "--raw-spool", default=settings.RAW_SPOOL_DIR,
+            help="Keep raw messages in this compressed spool so `reprocess` can re-parse them (default: RAW_SPOOL_DIR)",
+        )
+        parser.add_argument("--person-cache", type=int, default=100_000, help="Max people kept in the in-memory Person cache")
+        parser.add_argument("--warm-person-cache", action="store_true", help="Pre-load the Person cache from the DB")
+        parser.add_argument("--queue-depth", type=int, default=2, help="Batches buffered between pipeline stages")
+
+    def handle(self, *args, **opts):
+        backend = opts["backend"]
+        account_email = opts["account"]
+        provider = opts["provider"]
+
+        sources = discover_sources(opts["path"])
+        if not sources:
+            raise CommandError(f"No mbox, Maildir or .eml files found in {opts['path']}")
+        if opts["mailbox"]:
+            if len(sources) > 1:
+                raise CommandError(f"--mailbox needs a single source, {opts['path']} has {len(sources)}")
+            sources[0].mailbox = opts["mailbox"]
+
+        log_lock = threading.Lock()
+
+        def log(msg: str):
+            with log_lock:
+                self.stdout.write(msg)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Starting archive import of {len(sources)} sources for {account_email} (backend={backend}, workers={opts['workers']})"
+        ))
+        fetch_options = FetchOptions(batch_size=opts["batch"], batch_bytes=opts["batch_bytes"])
+        producer = archive_producer(account_email, provider, sources, fetch_options, max_per_source=opts["max"], log=log)
+
+        person_cache = PersonCache(max_size=opts["person_cache"])
+        if backend == "sql" and opts["warm_person_cache"]:
+            self.stdout.write(f"Person cache warmed with {person_cache.warm()} people")
+
+        session = ImportSession()
+        # Maildirs and .eml directories are resumed by the files they recorded, mboxes by offset
+        file_sources = {source.mailbox for source in sources if source.kind != "mbox"}
+        processed = {}
+        total = 0
+        total_bytes = 0
+        started = time.monotonic()
+
+        parse_options = ParseOptions(
+            hash_attachments=opts["hash_attachments"],
+            attachment_store=opts["attachment_store"] or "",
+        )
+        neo4j_loader = Neo4jLoader() if backend == "neo4j" else None
+        spool = RawSpool(opts["raw_spool"]) if opts["raw_spool"] else None
+        with ParsePool(opts["workers"], parse_options) as pool, neo4j_loader or contextlib.nullcontext(), spool or contextlib.nullcontext():
+            pipeline = ImportPipeline(pool, depth=opts["queue_depth"], spool=spool)
+            for batch in pipeline.run([producer]):
+                folder = batch.folder
+                folder_session = session.folder(account_email, provider, folder)
+                if batch.folder_state:
+                    # a new source, or an mbox replaced since the last run (its offsets changed)
+                    with transaction.atomic():
+                        if batch.reset and backend == "sql":
+                            removed = unlink_mailbox(folder_session.mailbox)
+                            log(f"{folder}: source replaced, unlinked {removed} stale uids")
+                        folder_session.record_state(batch.folder_state.uidvalidity, reset=batch.reset)
+                    continue
+                with transaction.atomic():
+                    if backend == "sql":
+                        load_sql_batch(
+                            account_email=account_email,
+                            provider=provider,
+                            mailbox_name=folder,
+                            items=batch.items,
+                            person_cache=person_cache,
+                            folder=folder_session,
+                            advance=folder not in file_sources,
+                        )
+                    else:
+                        neo4j_loader.load_batch(account_email, provider, folder, batch.items)
+                    # file uids are name hashes, not positions: the recorded files are the checkpoint
+                    if folder in file_sources:
+                        folder_session.record_files(batch.uids)
+                    elif backend != "sql":
+                        folder_session.advance(batch.max_uid)
+
+                processed[folder] = processed.get(folder, 0) + len(batch.items)
+                total += len(batch.items)
+                total_bytes += batch.bytes
+                position = "" if folder in file_sources else f" checkpoint offset={folder_session.last_uid},"
+                log(f"Batch done. {folder}{position} folder_count={processed[folder]}")
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        for folder, count in sorted(processed.items()):
+            self.stdout.write(f"  {folder}: {count} messages")
+        self.stdout.write(
+            f"Throughput: {total / elapsed:.1f} msg/s, {total_bytes / elapsed / 1e6:.2f} MB/s over {elapsed:.1f}s"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Archive import finished. Total processed: {total}"))
@@ -1,147 +1,314 @@
-import json
-from django.core.management.base import BaseCommand
-from imap2django.services.imap_client import ImapClient, ImapConfig
-from imap2django.services.parser import parse_rfc822, parse_date_to_dt
-from imap2django.services.normalizer import normalize
-from imap2django.services.checkpoint import get_checkpoint, set_checkpoint
-from imap2django.loaders.sql_loader import load_sql
-from imap2django.loaders.neo4j_loader import load_neo4j
-from datetime import timezone as dt_timezone
-from django.utils import timezone
+import contextlib
+import os
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from imap2django.services.imap_client import load_account_config
+from imap2django.services.metrics import ImportProgress, Metrics, MetricsLog, StackSampler, write_textfile
+from imap2django.services.parse_pool import ParsePool
+from imap2django.services.parser import ParseOptions
+from imap2django.services.person_cache import PersonCache
+from imap2django.services.pipeline import FetchOptions, ImportPipeline
+from imap2django.services.raw_spool import RawSpool
+from imap2django.services.scheduler import ImportScheduler, load_account_configs
+from imap2django.services.flag_sync import apply_flag_changes
+from imap2django.services.import_session import ImportSession
+from imap2django.utils import parse_byte_size
+from imap2django.loaders.sql_loader import load_bodies_batch, load_sql_batch, unlink_mailbox
+from imap2django.loaders.neo4j_loader import Neo4jLoader
 
 class Command(BaseCommand):
     help = "Import emails from IMAP into Django SQL models or Neo4j (streaming + checkpoint)."
 
     def add_arguments(self, parser):
-        parser.add_argument("--config", required=True, help="Path to account config JSON file")
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument("--config", help="Path to account config JSON file")
+        source.add_argument("--config-dir", help="Directory of account config JSON files (multi-account mode)")
         parser.add_argument("--backend", choices=["sql", "neo4j"], default="sql")
+        parser.add_argument(
+            "--mode", choices=["full", "headers", "bodies"], default="full",
+            help="full messages; headers only (BODY[HEADER] + BODYSTRUCTURE, no bodies stored); "
+                 "or bodies, to backfill messages imported with --mode headers (sql backend)",
+        )
         parser.add_argument("--folders", default="", help="Comma-separated folders (default: all)")
         parser.add_argument("--batch", type=int, default=200)
+        parser.add_argument("--batch-bytes", type=parse_byte_size, default=0, help="Byte budget per batch, e.g. 64M (0 = count only)")
+        parser.add_argument(
+            "--large-message", type=parse_byte_size, default=0,
+            help="Stream messages above this size (e.g. 16M) to a temp file in partial fetches (0 = never)",
+        )
         parser.add_argument("--resume", action="store_true", help="Resume from checkpoint (default behavior)")
         parser.add_argument("--max", type=int, default=0, help="Max messages per folder (0 = no limit)")
+        parser.add_argument("--workers", type=int, default=0, help="Parser processes (0/1 = parse inline)")
+        parser.add_argument(
+            "--hash-attachments", action="store_true",
+            help="Stream-decode attachments to fill Attachment.sha256 (default: size estimate only)",
+        )
+        parser.add_argument(
+            "--attachment-store", default=settings.ATTACHMENT_STORE_DIR,
+            help="Directory of the content-addressed attachment store (default: ATTACHMENT_STORE_DIR)",
+        )
+        parser.add_argument(
+            "--raw-spool", default=settings.RAW_SPOOL_DIR,
+            help="Keep raw messages in this compressed spool so `reprocess` can re-parse them (default: RAW_SPOOL_DIR)",
+        )
+        parser.add_argument("--person-cache", type=int, default=100_000, help="Max people kept in the in-memory Person cache")
+        parser.add_argument("--warm-person-cache", action="store_true", help="Pre-load the Person cache from the DB")
+        parser.add_argument("--queue-depth", type=int, default=2, help="Batches buffered between pipeline stages")
+        parser.add_argument("--connections", type=int, default=1, help="IMAP connections used concurrently")
+        parser.add_argument("--per-host", type=int, default=4, help="Max concurrent IMAP connections per server host")
+        parser.add_argument(
+            "--io", choices=["sync", "async"], default="sync",
+            help="IMAP transport: blocking imapclient, or asyncio with pipelined UID FETCH on one event loop",
+        )
+        parser.add_argument("--pipeline", type=int, default=4, help="UID FETCH commands in flight per connection with --io async")
+        parser.add_argument(
+            "--retries", type=int, default=5,
+            help="Reconnect attempts (exponential backoff) before an IMAP command fails the job",
+        )
+        parser.add_argument(
+            "--prefetch-headers", action="store_true",
+            help="Fetch Message-ID/size first and only download bodies of messages not stored yet (sql backend)",
+        )
+        parser.add_argument(
+            "--sync-flags", action="store_true",
+            help="Also sync flags and expunges of already-imported messages via CONDSTORE/QRESYNC (sql backend)",
+        )
+        parser.add_argument(
+            "--metrics", default="",
+            help="Append per-batch stage timings/queries and a run summary to this file (JSON lines)",
+        )
+        parser.add_argument(
+            "--metrics-textfile", default="",
+            help="Keep counters in this file in the Prometheus text format (e.g. for the node_exporter textfile collector)",
+        )
+        parser.add_argument("--progress-interval", type=float, default=10.0, help="Seconds between throughput/ETA lines")
+        parser.add_argument(
+            "--profile", action="store_true",
+            help="Sample the stacks of all threads and write them (collapsed format) next to the metrics file",
+        )
 
     def handle(self, *args, **opts):
-        cfg_path = opts["config"]
         backend = opts["backend"]
         batch_size = opts["batch"]
         folder_filter = [f.strip() for f in opts["folders"].split(",") if f.strip()]
         max_per_folder = opts["max"]
+        workers = opts["workers"]
+        depth = opts["queue_depth"]
+        prefetch = opts["prefetch_headers"]
+        if prefetch and backend != "sql":
+            raise CommandError("--prefetch-headers looks messages up in the SQL tables; use it with --backend sql")
+        sync_flags = opts["sync_flags"]
+        if sync_flags and backend != "sql":
+            raise CommandError("--sync-flags updates the SQL MailboxMessage rows; use it with --backend sql")
+        mode = opts["mode"]
+        if mode != "full" and backend != "sql":
+            raise CommandError(f"--mode {mode} keeps track of header-only messages in the SQL tables; use it with --backend sql")
+        if mode == "bodies" and prefetch:
+            raise CommandError("--prefetch-headers would link the header-only messages instead of fetching their bodies")
 
-        with open(cfg_path, "r", encoding="utf-8") as f:
-            account_cfg = json.load(f)
-
-        account_email = account_cfg["account_email"]
-        provider = account_cfg.get("provider", "")
-        imap_cfg = ImapConfig(
-            host=account_cfg["imap"]["host"],
-            port=int(account_cfg["imap"].get("port", 993)),
-            ssl=bool(account_cfg["imap"].get("ssl", True)),
-            username=account_cfg["imap"]["username"],
-            password=account_cfg["imap"]["password"],
-        )
-
-        self.stdout.write(self.style.SUCCESS(f"Starting import for {account_email} (backend={backend})"))
-
-        with ImapClient(imap_cfg) as imap:
-            folders = imap.list_folders()
-            if folder_filter:
-                folders = [f for f in folders if f in folder_filter]
-
-            self.stdout.write(f"Folders: {folders}")
-
-            total = 0
-            for folder in folders:
-                self.stdout.write(self.style.MIGRATE_HEADING(f"== Folder: {folder} =="))
-                try:
-                    imap.select_folder(folder)
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.WARNING(f"Skipping folder '{folder}' (not selectable): {e}")
-                    )
-                    continue
+        if opts["config_dir"]:
+            accounts = load_account_configs(opts["config_dir"])
+        else:
+            accounts = [load_account_config(opts["config"])]
+        if not accounts:
+            raise CommandError(f"No account configs found in {opts['config_dir']}")
 
+        self.stdout.write(self.style.SUCCESS(
+            f"Starting import for {', '.join(a.account_email for a in accounts)} "
+            f"(backend={backend}, mode={mode}, workers={workers}, connections={opts['connections']}, io={opts['io']})"
+        ))
 
-                # Checkpoint stored in SQL tables (even if backend=neo4j, simplest approach)
-                from imap2django.models import Account
-                account_obj, _ = Account.objects.get_or_create(email=account_email, defaults={"provider": provider})
-                last_uid = get_checkpoint(account_obj, folder)
+        log_lock = threading.Lock()
 
-                uids = imap.search_uids_since(last_uid)
-                uids = sorted(uids)
+        def log(msg: str):
+            with log_lock:
+                self.stdout.write(msg)
 
-                if not uids:
-                    self.stdout.write("No new messages.")
+        fetch_options = FetchOptions(
+            batch_size=batch_size,
+            prefetch=prefetch,
+            batch_bytes=opts["batch_bytes"],
+            large_bytes=opts["large_message"],
+            pipeline=opts["pipeline"],
+            mode=mode,
+        )
+        progress = ImportProgress(interval=opts["progress_interval"])
+        scheduler = ImportScheduler(
+            accounts,
+            fetch_options=fetch_options,
+            connections=opts["connections"],
+            per_host=opts["per_host"],
+            folder_filter=folder_filter,
+            max_per_folder=max_per_folder,
+            sync_flags=sync_flags,
+            relink=backend == "sql",
+            io=opts["io"],
+            retries=opts["retries"],
+            log=log,
+            on_plan=lambda plan: progress.plan((plan.account_email, plan.folder), plan.last_uid, plan.uids),
+        )
+
+        person_cache = PersonCache(max_size=opts["person_cache"])
+        if backend == "sql" and opts["warm_person_cache"]:
+            self.stdout.write(f"Person cache warmed with {person_cache.warm()} people")
+
+        # Checkpoint stored in SQL tables (even if backend=neo4j, simplest approach);
+        # accounts, mailboxes and checkpoints are resolved once per folder
+        session = ImportSession()
+        processed = {}
+        total = 0
+        total_bytes = 0
+        linked = 0
+        flags_updated = 0
+        expunged = 0
+        filled = 0
+        merged = 0
+        started = time.monotonic()
+        run_metrics = Metrics()
+        metrics_log = MetricsLog(opts["metrics"]) if opts["metrics"] else None
+        profiler = StackSampler() if opts["profile"] else None
+
+        def export():
+            if opts["metrics_textfile"]:
+                counters = {"reconnects": scheduler.reconnects, "failed_jobs": len(scheduler.failures)}
+                write_textfile(opts["metrics_textfile"], run_metrics, progress, counters)
+
+        parse_options = ParseOptions(
+            hash_attachments=opts["hash_attachments"],
+            attachment_store=opts["attachment_store"] or "",
+        )
+        neo4j_loader = Neo4jLoader() if backend == "neo4j" else None
+        spool = RawSpool(opts["raw_spool"]) if opts["raw_spool"] else None
+        with (
+            ParsePool(workers, parse_options) as pool,
+            neo4j_loader or contextlib.nullcontext(),
+            spool or contextlib.nullcontext(),
+            metrics_log or contextlib.nullcontext(),
+            profiler or contextlib.nullcontext(),
+        ):
+            # fetch, parse and load overlap: batch N+1 downloads while N parses and N-1 commits
+            pipeline = ImportPipeline(pool, depth=depth, spool=spool)
+            for batch in pipeline.run(scheduler.producers()):
+                account_email, folder = batch.account_email, batch.folder
+                key = (account_email, folder)
+                folder_session = session.folder(account_email, batch.provider, folder)
+                metrics = batch.metrics or Metrics()
+                if batch.folder_state:
+                    state = batch.folder_state
+                    with transaction.atomic():
+                        if batch.reset and backend == "sql":
+                            removed = unlink_mailbox(folder_session.mailbox)
+                            log(f"[{account_email}] {folder}: UIDVALIDITY reset, unlinked {removed} stale uids")
+                        folder_session.record_state(state.uidvalidity, state.highest_modseq, reset=batch.reset)
+                    continue
+                if batch.relinked:
+                    # every batch of the re-link pass is in: later runs go back to plain fetches
+                    with transaction.atomic():
+                        folder_session.finish_relink()
+                    log(f"[{account_email}] {folder}: re-link after UIDVALIDITY reset complete")
                     continue
+                if batch.flag_changes:
+                    with metrics.measure("flag_sync"):
+                        updated, removed = apply_flag_changes(folder_session, batch.flag_changes)
+                    run_metrics.merge(metrics)
+                    flags_updated += updated
+                    expunged += removed
+                    log(f"Flags synced. [{account_email}] {folder}: {updated} updated, {removed} expunged")
+                    continue
+                count = len(batch.items) + len(batch.links)
+                if batch.backfill:
+                    # header-only messages get their bodies; the checkpoint stays put
+                    with metrics.measure("load", messages=count, nbytes=batch.bytes):
+                        batch_filled, batch_merged = load_bodies_batch(folder_session.mailbox, batch.items, person_cache)
+                    filled += batch_filled
+                    merged += batch_merged
+                elif backend == "sql":
+                    # one transaction, a dozen set-based statements per batch; the
+                    # checkpoint advances inside it, so data and checkpoint can't diverge
+                    with metrics.measure("load", messages=count, nbytes=batch.bytes):
+                        load_sql_batch(
+                            account_email=account_email,
+                            provider=batch.provider,
+                            mailbox_name=folder,
+                            items=batch.items,
+                            links=batch.links,
+                            person_cache=person_cache,
+                            folder=folder_session,
+                            metrics=metrics,
+                        )
+                else:
+                    # one UNWIND query per batch over a long-lived driver;
+                    # checkpoint only after the batch is written, earlier batches already are
+                    with metrics.measure("load", messages=count, nbytes=batch.bytes):
+                        neo4j_loader.load_batch(account_email, batch.provider, folder, batch.items)
+                    with metrics.measure("checkpoint"), transaction.atomic():
+                        folder_session.advance(batch.max_uid)
+
+                processed[key] = processed.get(key, 0) + count
+                total += count
+                linked += len(batch.links)
+                total_bytes += batch.bytes
+                run_metrics.merge(metrics)
+                progress.advance(key, batch.max_uid, count, batch.bytes)
+                if metrics_log:
+                    metrics_log.write({
+                        "account": account_email, "folder": folder, "last_uid": folder_session.last_uid,
+                        "messages": count, "bytes": batch.bytes, "stages": metrics.totals(),
+                    })
+                export()
+
+                log(
+                    f"Batch done. [{account_email}] {folder} checkpoint last_uid={folder_session.last_uid}, "
+                    f"folder_count={processed[key]} ({metrics.brief()})"
+                )
+                if progress.due():
+                    log(progress.line())
+
+            elapsed = max(time.monotonic() - started, 1e-6)
+            if metrics_log:
+                metrics_log.write({
+                    "summary": True, "elapsed": round(elapsed, 3), "messages": total, "bytes": total_bytes,
+                    "reconnects": scheduler.reconnects, "failed_jobs": len(scheduler.failures),
+                    "stages": run_metrics.as_dict(),
+                })
+        export()
+        if profiler:
+            base = os.path.splitext(opts["metrics"] or opts["metrics_textfile"] or "import_imap")[0]
+            profiler.write(f"{base}.profile.folded")
+            self.stdout.write(f"Profile ({profiler.ticks} samples) written to {base}.profile.folded")
+
+        per_account = {}
+        for (account_email, _folder), count in processed.items():
+            per_account[account_email] = per_account.get(account_email, 0) + count
+        for account_email, count in sorted(per_account.items()):
+            self.stdout.write(f"  {account_email}: {count} messages")
+        if backend == "sql":
+            self.stdout.write(f"Person cache: {person_cache.hits} hits, {person_cache.misses} misses, {len(person_cache)} cached")
+        if sync_flags:
+            self.stdout.write(f"Flag sync: {flags_updated} messages updated, {expunged} expunged")
+        if scheduler.reconnects:
+            self.stdout.write(f"Reconnected {scheduler.reconnects} times after dropped IMAP connections")
+        if prefetch or linked:
+            self.stdout.write(f"Linked {linked} already-stored messages without downloading bodies")
+        if mode == "bodies":
+            self.stdout.write(f"Bodies: {filled} messages filled in, {merged} merged into already-stored copies")
+        self.stdout.write(
+            f"Throughput: {total / elapsed:.1f} msg/s, {total_bytes / elapsed / 1e6:.2f} MB/s "
+            f"over {elapsed:.1f}s ({len(accounts)} accounts)"
+        )
+        # parse/normalize are summed over parser workers, the other stages overlap in wall time
+        for name, stats in run_metrics.stages.items():
+            self.stdout.write(
+                f"  {name:<10} {stats.seconds:8.1f}s  {stats.queries:>7} queries"
+                + (f"  {stats.messages / stats.seconds:9.1f} msg/s" if stats.messages and stats.seconds else "")
+            )
 
-                processed_in_folder = 0
-
-                for i in range(0, len(uids), batch_size):
-                    batch_uids = uids[i:i+batch_size]
-                    fetched = imap.fetch_batch(batch_uids)
-
-                    # process each uid in the batch
-                    max_uid_in_batch = last_uid
-                    for uid in batch_uids:
-                        item = fetched.get(uid) or {}
-                        raw = item.get(b"RFC822") or item.get("RFC822") or b""
-                        # flags = item.get(b"FLAGS") or item.get("FLAGS") or []
-                        raw_flags = item.get(b"FLAGS") or item.get("FLAGS") or []
-                        flags = [
-                            f.decode("utf-8", errors="ignore") if isinstance(f, (bytes, bytearray)) else str(f)
-                            for f in raw_flags
-                        ]
-                            
-                        internal_date = item.get(b"INTERNALDATE") or item.get("INTERNALDATE")
-                        if internal_date and timezone.is_naive(internal_date):
-                            internal_date = timezone.make_aware(internal_date, dt_timezone.utc)
-
-                        size = item.get(b"RFC822.SIZE") or item.get("RFC822.SIZE") or 0
-
-                        if not raw:
-                            continue
-
-                        parsed = parse_rfc822(raw)
-                        date_dt = parse_date_to_dt(parsed.date or "")
-                        norm = normalize(parsed, raw, size=size, date_dt=date_dt)
-
-                        if backend == "sql":
-                            load_sql(
-                                account_email=account_email,
-                                provider=provider,
-                                mailbox_name=folder,
-                                uid=uid,
-                                flags=flags,
-                                internal_date=internal_date,
-                                normalized=norm,
-                            )
-                        else:
-                            load_neo4j(
-                                account_email=account_email,
-                                provider=provider,
-                                mailbox_name=folder,
-                                uid=uid,
-                                flags=flags,
-                                internal_date=internal_date,
-                                normalized=norm,
-                            )
-
-                        processed_in_folder += 1
-                        total += 1
-                        if uid > max_uid_in_batch:
-                            max_uid_in_batch = uid
-
-                        if max_per_folder and processed_in_folder >= max_per_folder:
-                            break
-
-                    # checkpoint after each batch
-                    if max_uid_in_batch > last_uid:
-                        set_checkpoint(account_obj, folder, max_uid_in_batch)
-                        last_uid = max_uid_in_batch
-
-                    self.stdout.write(f"Batch done. checkpoint last_uid={last_uid}, folder_count={processed_in_folder}")
-
-                    if max_per_folder and processed_in_folder >= max_per_folder:
-                        self.stdout.write("Reached --max limit for folder.")
-                        break
+        if scheduler.failures:
+            for account_email, folder, error in scheduler.failures:
+                self.stdout.write(self.style.ERROR(f"  failed: {account_email} {folder}: {error}"))
+            raise CommandError(f"Import finished with {len(scheduler.failures)} failed jobs. Total processed: {total}")
 
         self.stdout.write(self.style.SUCCESS(f"Import finished. Total processed: {total}"))
@@ -1,12 +1,53 @@
-from django.core.management.base import BaseCommand
-from imap2django.services.threading import rebuild_threads
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from imap2django.services.threading import delete_empty_threads, rebuild_threads
+
+def _parse_since(value: str):
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise CommandError(f"--since: expected an ISO date or datetime, got {value!r}")
+        dt = datetime(d.year, d.month, d.day)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
 
 class Command(BaseCommand):
     help = "Assign/rebuild Thread objects for Messages."
 
     def add_arguments(self, parser):
         parser.add_argument("--limit", type=int, default=0)
+        parser.add_argument("--since", default="", help="Only messages created since this ISO date/datetime")
+        parser.add_argument("--unthreaded", action="store_true", help="Only messages that have no thread yet")
+        parser.add_argument(
+            "--engine",
+            choices=["jwz", "headers"],
+            default="jwz",
+            help="jwz: link replies to their parents across broken chains; headers: hash each message's own headers",
+        )
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Messages written per transaction")
+        parser.add_argument("--workers", type=int, default=0, help="Apply chunks in this many processes (0/1 = inline)")
+        parser.add_argument("--resume", action="store_true", help="Continue an interrupted rebuild from its last chunk")
+        parser.add_argument(
+            "--delete-empty", action="store_true",
+            help="Afterwards delete threads no message belongs to (e.g. left behind by re-keyed threads)",
+        )
 
     def handle(self, *args, **opts):
-        count = rebuild_threads(limit=opts["limit"])
+        since = _parse_since(opts["since"]) if opts["since"] else None
+        count = rebuild_threads(
+            limit=opts["limit"],
+            since=since,
+            unthreaded=opts["unthreaded"],
+            engine=opts["engine"],
+            chunk_size=opts["chunk_size"],
+            workers=opts["workers"],
+            resume=opts["resume"],
+            log=lambda msg: self.stdout.write(msg),
+        )
         self.stdout.write(self.style.SUCCESS(f"Threads rebuilt for {count} messages"))
+        if opts["delete_empty"]:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {delete_empty_threads()} empty threads"))
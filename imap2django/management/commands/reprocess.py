@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from imap2django.services.parse_pool import ParsePool
+from imap2django.services.parser import ParseOptions
+from imap2django.services.person_cache import PersonCache
+from imap2django.services.raw_spool import RawSpool
+from imap2django.services.reprocess import reprocess_spool
+
+class Command(BaseCommand):
+    help = "Re-parse messages from the raw spool and rewrite their bodies, recipients and attachments (no IMAP)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--raw-spool", default=settings.RAW_SPOOL_DIR, help="Spool directory (default: RAW_SPOOL_DIR)")
+        parser.add_argument("--batch", type=int, default=500, help="Messages written per transaction")
+        parser.add_argument("--limit", type=int, default=0, help="Max messages to reprocess (0 = all)")
+        parser.add_argument("--workers", type=int, default=0, help="Parser processes (0/1 = parse inline)")
+        parser.add_argument("--queue-depth", type=int, default=2, help="Batches buffered between pipeline stages")
+        parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its last batch")
+        parser.add_argument(
+            "--hash-attachments", action="store_true",
+            help="Stream-decode attachments to fill Attachment.sha256 (default: size estimate only)",
+        )
+        parser.add_argument(
+            "--attachment-store", default=settings.ATTACHMENT_STORE_DIR,
+            help="Directory of the content-addressed attachment store (default: ATTACHMENT_STORE_DIR)",
+        )
+        parser.add_argument("--person-cache", type=int, default=100_000, help="Max people kept in the in-memory Person cache")
+
+    def handle(self, *args, **opts):
+        if not opts["raw_spool"]:
+            raise CommandError("No spool configured: pass --raw-spool or set RAW_SPOOL_DIR")
+        parse_options = ParseOptions(
+            hash_attachments=opts["hash_attachments"],
+            attachment_store=opts["attachment_store"] or "",
+        )
+        with RawSpool(opts["raw_spool"]) as spool, ParsePool(opts["workers"], parse_options) as pool:
+            count = reprocess_spool(
+                spool,
+                pool,
+                batch_size=opts["batch"],
+                limit=opts["limit"],
+                resume=opts["resume"],
+                depth=opts["queue_depth"],
+                person_cache=PersonCache(max_size=opts["person_cache"]),
+                log=lambda msg: self.stdout.write(msg),
+            )
+        self.stdout.write(self.style.SUCCESS(f"Reprocessed {count} messages"))
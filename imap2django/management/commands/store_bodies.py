@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from imap2django.models import MessageBody
+from imap2django.services.body_store import move_inline_bodies, prune_bodies, table_storage
+
+class Command(BaseCommand):
+    help = (
+        "Move message bodies stored inline on Message into the compressed, deduplicated MessageBody table "
+        "(BODY_STORAGE=table), and optionally delete bodies nothing refers to any more."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500, help="Messages moved per transaction")
+        parser.add_argument("--limit", type=int, default=0, help="Max messages to move (0 = all)")
+        parser.add_argument(
+            "--prune", action="store_true",
+            help="Afterwards delete MessageBody rows no message uses (do not run while importing)",
+        )
+
+    def handle(self, *args, **opts):
+        if not table_storage():
+            raise CommandError("BODY_STORAGE is not 'table': imports would keep writing bodies inline")
+        messages, bodies = move_inline_bodies(
+            batch_size=opts["batch"], limit=opts["limit"], log=lambda msg: self.stdout.write(msg)
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {bodies} bodies of {messages} messages ({MessageBody.objects.count()} distinct bodies stored)"
+        ))
+        if opts["prune"]:
+            self.stdout.write(self.style.SUCCESS(f"Pruned {prune_bodies()} unused bodies"))
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.8 on 2026-10-17 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RebuildProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('engine', models.CharField(blank=True, default='', max_length=16)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('changed', models.BigIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
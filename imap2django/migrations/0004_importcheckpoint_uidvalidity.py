@@ -0,0 +1,18 @@
+# Generated by Django 5.0.8 on 2026-10-17 21:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0003_importcheckpoint_highest_modseq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='uidvalidity',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.8 on 2026-10-17 21:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0004_importcheckpoint_uidvalidity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='has_body',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.8 on 2026-10-17 22:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0005_message_has_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageBody',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('codec', models.CharField(max_length=8)),
+                ('size', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='html_body',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='imap2django.messagebody'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='text_body',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='imap2django.messagebody'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.8 on 2026-10-17 22:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0006_message_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='relinking',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.8 on 2026-10-17 22:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0007_importcheckpoint_relinking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.BigIntegerField()),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_files', to='imap2django.importcheckpoint')),
+            ],
+            options={
+                'unique_together': {('checkpoint', 'uid')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.8 on 2026-10-17 23:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imap2django', '0008_archivefile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rebuildprogress',
+            name='since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rebuildprogress',
+            name='unthreaded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -33,6 +33,19 @@ class Thread(models.Model):
     subject_norm = models.CharField(max_length=512, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
 
+class MessageBody(models.Model):
+    # One compressed body shared by every message with the same text (BODY_STORAGE = "table")
+    sha256 = models.CharField(max_length=64, unique=True)
+    codec = models.CharField(max_length=8)
+    size = models.IntegerField(default=0)  # uncompressed UTF-8 length
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def text(self) -> str:
+        from .services.body_store import decode_body
+        return decode_body(self.codec, bytes(self.data))
+
 class Message(models.Model):
     raw_sha256 = models.CharField(max_length=64, unique=True)
     message_id = models.CharField(max_length=512, blank=True, null=True, db_index=True)
@@ -49,12 +62,25 @@ class Message(models.Model):
 
     body_text = models.TextField(blank=True, default="")
     body_html = models.TextField(blank=True, default="")
+    # With BODY_STORAGE = "table" the bodies live in MessageBody and the two fields above stay empty;
+    # get_body_text()/get_body_html() read whichever is set
+    text_body = models.ForeignKey(MessageBody, on_delete=models.PROTECT, null=True, blank=True, related_name="+")
+    html_body = models.ForeignKey(MessageBody, on_delete=models.PROTECT, null=True, blank=True, related_name="+")
     size = models.IntegerField(default=0)
+    # False for header-only imports (import_imap --mode headers) until --mode bodies backfills them;
+    # raw_sha256 is then a hash of the header block
+    has_body = models.BooleanField(default=True, db_index=True)
 
     thread = models.ForeignKey(Thread, on_delete=models.SET_NULL, null=True, blank=True, related_name="messages")
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def get_body_text(self) -> str:
+        return self.text_body.text if self.text_body_id else self.body_text
+
+    def get_body_html(self) -> str:
+        return self.html_body.text if self.html_body_id else self.body_html
+
 class MailboxMessage(models.Model):
     mailbox = models.ForeignKey(Mailbox, on_delete=models.CASCADE, related_name="mailbox_messages")
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="mailbox_messages")
@@ -90,7 +116,32 @@ class ImportCheckpoint(models.Model):
     account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="checkpoints")
     mailbox_name = models.CharField(max_length=255)
     last_uid = models.BigIntegerField(default=0)
+    uidvalidity = models.BigIntegerField(default=0)  # UIDVALIDITY last_uid refers to (0 = unknown)
+    highest_modseq = models.BigIntegerField(default=0)  # CONDSTORE HIGHESTMODSEQ flags were synced up to
+    # set when UIDVALIDITY changed; runs keep re-linking by Message-ID/size until the folder is walked once
+    relinking = models.BooleanField(default=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = [("account", "mailbox_name")]
+
+class ArchiveFile(models.Model):
+    # a Maildir/.eml file import_archive has read into the checkpoint's mailbox, by the uid derived from its name
+    checkpoint = models.ForeignKey(ImportCheckpoint, on_delete=models.CASCADE, related_name="archive_files")
+    uid = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [("checkpoint", "uid")]
+
+class RebuildProgress(models.Model):
+    # one row per long-running maintenance job (e.g. "threads"), so a killed run can resume
+    name = models.CharField(max_length=64, unique=True)
+    engine = models.CharField(max_length=16, blank=True, default="")
+    # the scope of the run, so --resume only continues a run over the same messages
+    since = models.DateTimeField(null=True, blank=True)
+    unthreaded = models.BooleanField(default=False)
+    last_id = models.BigIntegerField(default=0)
+    processed = models.BigIntegerField(default=0)
+    changed = models.BigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
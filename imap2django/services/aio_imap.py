@@ -0,0 +1,347 @@
+"""
+asyncio IMAP transport (--io async).
+
+AioIMAPClient stands in for imapclient.IMAPClient underneath ImapClient. Every
+connection is a pair of asyncio streams on one shared event-loop thread, so
+connections cost no thread of their own and commands can be pipelined:
+fetch_pipelined() keeps several UID FETCH commands in flight on a connection
+and hands the results back in order, instead of paying one round trip per
+batch. Untagged FETCH responses are matched to the command that asked for
+their UID and tagged completions to their tag, so the server may answer
+pipelined commands in any order. Responses are collected in imaplib's format and parsed with
+imapclient's response_parser, so callers get exactly what IMAPClient returns.
+
+Only the commands ImapClient uses are implemented (LOGIN, CAPABILITY, ENABLE,
+LIST, SELECT/EXAMINE, UID SEARCH, UID FETCH, LOGOUT).
+"""
+import asyncio
+import imaplib
+import re
+import ssl as ssl_lib
+import threading
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional
+from imapclient import imap_utf7
+from imapclient.response_parser import parse_fetch_response, parse_message_list, parse_response
+
+_UNTAGGED_RE = re.compile(rb"^(?:(\d+) )?([A-Za-z-]+)(?: (.*))?$", re.S)
+_LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+_CODE_RE = re.compile(rb"^\[([A-Z-]+) (\d+)\]")
+_QUOTED_RE = re.compile(rb'"(?:[^"\\]|\\.)*"')
+_UID_RE = re.compile(rb"\bUID (\d+)", re.I)
+_READ_CHUNK = 1024 * 1024
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop all async connections share, running on a daemon thread.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="imap-aio", daemon=True).start()
+        return _loop
+
+def _quote(text: str) -> bytes:
+    return b'"' + text.encode("utf-8").replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+def _folder(name: str) -> bytes:
+    return _quote(imap_utf7.encode(name).decode("ascii"))
+
+def _message_set(messages) -> bytes:
+    # a uid list, or a set already spelled out ("1:*")
+    if isinstance(messages, (str, bytes, int)):
+        messages = [messages]
+    return b",".join(m if isinstance(m, bytes) else str(m).encode("ascii") for m in messages)
+
+def _paren_list(items) -> bytes:
+    if isinstance(items, (str, bytes)):
+        items = [items]
+    return b"(" + b" ".join((i if isinstance(i, bytes) else i.encode("ascii")).upper() for i in items) + b")"
+
+def _fetch_uid(data: list) -> Optional[int]:
+    """
+    UID of one untagged FETCH response, read from its lines outside literals and quoted strings.
+    """
+    for part in data:
+        line = part[0] if isinstance(part, tuple) else part
+        m = _UID_RE.search(_QUOTED_RE.sub(b'""', line))
+        if m:
+            return int(m.group(1))
+    return None
+
+class _Command:
+    __slots__ = ("tag", "name", "future", "untagged", "uids")
+
+    def __init__(self, tag: bytes, name: str, future: asyncio.Future, uids: Optional[FrozenSet[int]] = None):
+        self.tag = tag
+        self.name = name
+        self.future = future
+        self.untagged: Dict[str, list] = {}
+        self.uids = uids  # UIDs a UID FETCH asked for by number
+
+class AsyncImapConnection:
+    """
+    One IMAP connection driven by a reader task. Commands are written as soon
+    as they are issued. An untagged FETCH goes to the oldest command waiting
+    for its UID; other untagged responses go to the oldest command that did
+    not list its UIDs (else the oldest one), and a tagged reply completes the
+    command with that tag, whichever order they come in.
+    """
+    def __init__(self, host: str, port: int, ssl: bool = True, timeout: Optional[float] = None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Dict[bytes, _Command] = {}  # by tag, oldest first
+        self.counter = 0
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        context = ssl_lib.create_default_context() if self.ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=16 * 1024 * 1024), self.timeout
+        )
+        greeting = await self._readline()
+        if not greeting.startswith((b"* OK", b"* PREAUTH")):
+            raise imaplib.IMAP4.error(f"unexpected greeting: {greeting!r}")
+        self.task = asyncio.ensure_future(self._read_responses())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+    async def command(self, name: str, *args: bytes, uids: Optional[FrozenSet[int]] = None) -> Dict[str, list]:
+        """
+        Sends a command and waits for its tagged OK. Returns its untagged
+        responses by type, in imaplib's format. uids: the UIDs a UID FETCH
+        lists, so their FETCH responses are matched to it.
+        """
+        if self.error:
+            raise self.error
+        self.counter += 1
+        tag = b"A%04d" % self.counter
+        cmd = _Command(tag, name, asyncio.get_running_loop().create_future(), uids)
+        # queue and write before the first await, so commands go out in call order
+        self.pending[tag] = cmd
+        self.writer.write(b" ".join((tag, name.encode("ascii")) + args) + b"\r\n")
+        await self.writer.drain()
+        return await cmd.future
+
+    async def _readline(self, idle_ok: bool = False) -> bytes:
+        """
+        idle_ok: only the reader loop between responses may wait for as long as
+        no command is pending; anywhere else (the greeting, the rest of a
+        response) a silent server times out.
+        """
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                if self.pending or not idle_ok:
+                    raise
+                continue  # idle connection, nothing is overdue
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            return line.rstrip(b"\r\n")
+
+    async def _read_literal(self, size: int) -> bytes:
+        parts = []
+        while size:
+            part = await asyncio.wait_for(self.reader.read(min(size, _READ_CHUNK)), self.timeout)
+            if not part:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            parts.append(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    async def _read_untagged(self, line: bytes):
+        m = _UNTAGGED_RE.match(line)
+        if not m:
+            raise imaplib.IMAP4.abort(f"unexpected response: {line!r}")
+        number, typ, rest = m.groups()
+        dat = b" ".join(p for p in (number, rest) if p is not None)
+        # same layout as imaplib's untagged_responses: (line, literal) tuples, then the tail
+        data: list = []
+        while True:
+            lm = _LITERAL_RE.search(dat)
+            if not lm:
+                data.append(dat)
+                return typ.decode("ascii").upper(), data
+            data.append((dat, await self._read_literal(int(lm.group(1)))))
+            dat = await self._readline()
+
+    async def _read_responses(self):
+        try:
+            while True:
+                line = await self._readline(idle_ok=True)
+                if line.startswith(b"* "):
+                    typ, data = await self._read_untagged(line[2:])
+                    cmd = self._owner(typ, data)
+                    if cmd:
+                        cmd.untagged.setdefault(typ, []).extend(data)
+                    continue
+                if line.startswith(b"+"):
+                    continue  # no literals are ever sent
+                tag, _, rest = line.partition(b" ")
+                cmd = self.pending.pop(tag, None)
+                if cmd is None:
+                    raise imaplib.IMAP4.abort(f"unexpected response: {line!r}")
+                if cmd.future.done():
+                    continue  # caller gave up on it
+                if rest[:3].upper() == b"OK " or rest.upper() == b"OK":
+                    cmd.future.set_result(cmd.untagged)
+                else:
+                    cmd.future.set_exception(
+                        imaplib.IMAP4.error(f"{cmd.name} command error: {rest.decode('utf-8', errors='replace')}")
+                    )
+        except asyncio.CancelledError:
+            self.error = imaplib.IMAP4.abort("connection closed")
+        except (imaplib.IMAP4.abort, ConnectionError, TimeoutError, ssl_lib.SSLError, EOFError) as e:
+            self.error = e
+        except Exception as e:
+            self.error = imaplib.IMAP4.abort(str(e))
+        for cmd in self.pending.values():
+            if not cmd.future.done():
+                cmd.future.set_exception(self.error)
+        self.pending.clear()
+
+    def _owner(self, typ: str, data: list) -> Optional[_Command]:
+        if not self.pending:
+            return None
+        if typ == "FETCH":
+            uid = _fetch_uid(data)
+            if uid is not None:
+                for cmd in self.pending.values():
+                    if cmd.uids and uid in cmd.uids:
+                        return cmd
+        for cmd in self.pending.values():
+            if cmd.uids is None:
+                return cmd
+        return next(iter(self.pending.values()))
+
+class AioIMAPClient:
+    """
+    Blocking facade over AsyncImapConnection with the subset of the
+    IMAPClient API ImapClient uses (UIDs only), plus fetch_pipelined().
+    Safe to use from one thread at a time, like IMAPClient.
+    """
+    def __init__(self, host: str, port: Optional[int] = None, ssl: bool = True, timeout: Optional[float] = None):
+        self.loop = event_loop()
+        self.conn = AsyncImapConnection(host, port or (993 if ssl else 143), ssl=ssl, timeout=timeout)
+        self._run(self.conn.connect())
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _command(self, name: str, *args: bytes) -> Dict[str, list]:
+        return self._run(self.conn.command(name, *args))
+
+    def login(self, username: str, password: str):
+        self._command("LOGIN", _quote(username), _quote(password))
+
+    def logout(self):
+        try:
+            self._command("LOGOUT")
+        except imaplib.IMAP4.abort:
+            pass  # the server hangs up right after BYE
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self._run(self.conn.close())
+
+    def capabilities(self) -> tuple:
+        untagged = self._command("CAPABILITY")
+        return tuple(b" ".join(untagged.get("CAPABILITY", [])).upper().split())
+
+    def enable(self, *capabilities: str) -> list:
+        untagged = self._command("ENABLE", *(c.encode("ascii") for c in capabilities))
+        return b" ".join(untagged.get("ENABLED", [])).split()
+
+    def list_folders(self, directory: str = "", pattern: str = "*") -> list:
+        untagged = self._command("LIST", _folder(directory), _folder(pattern))
+        parsed = parse_response([d for d in untagged.get("LIST", []) if d])
+        folders = []
+        for i in range(0, len(parsed), 3):
+            flags, delimiter, name = parsed[i:i + 3]
+            name = str(name) if isinstance(name, int) else imap_utf7.decode(name)
+            folders.append((flags, delimiter, name))
+        return folders
+
+    def select_folder(self, folder: str, readonly: bool = False) -> Dict[bytes, object]:
+        untagged = self._command("EXAMINE" if readonly else "SELECT", _folder(folder))
+        resp: Dict[bytes, object] = {}
+        for dat in untagged.get("EXISTS", []):
+            resp[b"EXISTS"] = int(dat)
+        for dat in untagged.get("OK", []):
+            m = _CODE_RE.match(dat if isinstance(dat, bytes) else dat[0])
+            if m:
+                resp[m.group(1)] = int(m.group(2))
+        return resp
+
+    def search(self, criteria: List[str]) -> List[int]:
+        untagged = self._command("UID", b"SEARCH", *(str(c).encode("ascii") for c in criteria))
+        return parse_message_list(untagged.get("SEARCH", []) or [b""])
+
+    def _fetch_args(self, messages, data, modifiers) -> List[bytes]:
+        args = [b"FETCH", _message_set(messages), _paren_list(data)]
+        if modifiers:
+            args.append(_paren_list(modifiers))
+        return args
+
+    def _fetch_command(self, messages, data, modifiers=None):
+        uids = frozenset(messages) if isinstance(messages, (list, tuple, set, frozenset)) else None
+        return self.conn.command("UID", *self._fetch_args(messages, data, modifiers), uids=uids)
+
+    def _parse_fetch(self, untagged: Dict[str, list]):
+        return parse_fetch_response(untagged.get("FETCH", []), True, True)
+
+    def fetch(self, messages, data: List[str], modifiers: Optional[List[str]] = None):
+        if not messages:
+            return {}
+        return self._parse_fetch(self._run(self._fetch_command(messages, data, modifiers)))
+
+    def fetch_vanished(self, messages, data: List[str], modifiers: List[str]):
+        """
+        fetch() that also returns the VANISHED response lines of this command (see SyncIMAPClient).
+        """
+        untagged = self._run(self._fetch_command(messages, data, modifiers))
+        return self._parse_fetch(untagged), [line for line in untagged.get("VANISHED", []) if line]
+
+    def fetch_pipelined(self, batches: Iterable[List[int]], data: List[str], window: int = 4) -> Iterator[dict]:
+        """
+        Yields fetch(uids, data) for every uid list, in order, with up to
+        `window` UID FETCH commands in flight at once.
+        """
+        inflight: deque = deque()
+        batches = iter(batches)
+        try:
+            while True:
+                while len(inflight) < max(1, window):
+                    uids = next(batches, None)
+                    if uids is None:
+                        break
+                    inflight.append(
+                        asyncio.run_coroutine_threadsafe(self._fetch_command(uids, data), self.loop) if uids else None
+                    )
+                if not inflight:
+                    return
+                future = inflight.popleft()
+                yield self._parse_fetch(future.result()) if future else {}
+        finally:
+            for future in inflight:
+                if future:
+                    future.cancel()
@@ -0,0 +1,267 @@
+"""
+Offline message sources for import_archive: mbox files (Google Takeout),
+Maildir trees and directories of .eml files.
+
+Each source becomes one mailbox and is read by a producer of the regular
+ImportPipeline, so messages go through the same parse/normalize/loader path
+as IMAP. Where an IMAP folder has UIDs, a source's messages are numbered by:
+
+- mbox: the byte offset where a message ends (= where the next one starts).
+  The file is mmap'ed and split on "From " lines, never read as a whole, and
+  a resumed import seeks straight to the offset in ImportCheckpoint.last_uid.
+- Maildir / .eml directory: a hash of the file's name (the Maildir unique
+  name, which survives flag changes and the move from new/ to cur/). Files
+  read are recorded as ArchiveFile rows, and a resumed import reads every
+  file not recorded yet, so deleted files and new ones sorting anywhere in
+  the directory don't make it skip messages.
+
+The uid doubles as MailboxMessage.uid. The checkpoint's uidvalidity holds a
+fingerprint of an mbox, so a replaced file starts over like a UIDVALIDITY
+reset; so does one whose stored offset no longer starts a message (rewritten
+past the fingerprinted head). Directories are tracked file by file and need
+none.
+"""
+import hashlib
+import mmap
+import os
+import re
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Collection, Iterator, List, Optional, Tuple
+from .checkpoint import peek_archive_files, peek_checkpoint, peek_uidvalidity
+from .imap_client import FolderState
+from .pipeline import FetchOptions, Producer, RawBatch
+
+MBOX_SUFFIXES = (".mbox", ".mbx")
+EML_SUFFIXES = (".eml",)
+MAILDIR_FLAGS = {"D": "\\Draft", "F": "\\Flagged", "R": "\\Answered", "S": "\\Seen", "T": "\\Deleted"}
+MBOX_STATUS_FLAGS = {"R": "\\Seen", "A": "\\Answered", "F": "\\Flagged", "D": "\\Deleted", "T": "\\Draft"}
+
+_FROM_QUOTED_RE = re.compile(rb"^>(>*From )", re.M)
+_STATUS_RE = re.compile(rb"^X?-?Status: *([A-Z]*)", re.M | re.I)
+_TZ_RE = re.compile(r"^[+-]\d{4}$")
+
+# (uid, raw, flags, internal_date)
+ArchiveRow = Tuple[int, bytes, List[str], Optional[datetime]]
+
+@dataclass
+class ArchiveSource:
+    kind: str  # "mbox" | "maildir" | "eml"
+    path: str
+    mailbox: str
+
+def discover_sources(path: str) -> List[ArchiveSource]:
+    """
+    Finds every mbox file, Maildir and .eml directory under path (or path itself).
+    Mailbox names are paths relative to it.
+    """
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        kind = "eml" if path.lower().endswith(EML_SUFFIXES) else "mbox"
+        return [ArchiveSource(kind, path, stem)]
+
+    sources = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        rel = os.path.relpath(root, path)
+        name = "" if rel == "." else rel.replace(os.sep, "/")
+        if _is_maildir(root):
+            sources.append(ArchiveSource("maildir", root, name or "INBOX"))
+            # Maildir++ subfolders (.Sent, .Archive.2020) are maildirs of their own
+            for sub in sorted(d for d in dirs if d.startswith(".") and _is_maildir(os.path.join(root, d))):
+                sources.append(ArchiveSource("maildir", os.path.join(root, sub), sub[1:].replace(".", "/")))
+            dirs[:] = []
+            continue
+        for f in sorted(files):
+            if f.lower().endswith(MBOX_SUFFIXES) or f == "mbox":
+                sources.append(ArchiveSource("mbox", os.path.join(root, f), "/".join(filter(None, [name, os.path.splitext(f)[0]]))))
+        if any(f.lower().endswith(EML_SUFFIXES) for f in files):
+            sources.append(ArchiveSource("eml", root, name or os.path.basename(path)))
+    return sources
+
+def _is_maildir(path: str) -> bool:
+    return all(os.path.isdir(os.path.join(path, d)) for d in ("cur", "new"))
+
+def _unique_name(name: str) -> str:
+    # a Maildir file keeps this part when it moves from new/ to cur/ or its flags change
+    return os.path.basename(name).split(":2,", 1)[0]
+
+def _listing(source: ArchiveSource) -> List[str]:
+    if source.kind == "maildir":
+        names = [os.path.join(d, f) for d in ("cur", "new") for f in os.listdir(os.path.join(source.path, d))]
+        return sorted(names, key=lambda n: (_unique_name(n), n))
+    if os.path.isfile(source.path):
+        return [os.path.basename(source.path)]
+    return sorted(f for f in os.listdir(source.path) if f.lower().endswith(EML_SUFFIXES))
+
+def file_uid(source: ArchiveSource, name: str) -> int:
+    """
+    uid of a Maildir/.eml file: 63 bits of the hash of its unique name.
+    """
+    key = _unique_name(name) if source.kind == "maildir" else os.path.basename(name)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8", errors="surrogateescape"), digest_size=8).digest(), "big") >> 1
+
+def source_identity(source: ArchiveSource) -> int:
+    """
+    Fingerprint stored as the checkpoint's uidvalidity: the first 64 KiB of an
+    mbox, which survive appends. Directories get a fixed value per kind (their
+    uids don't depend on what else is in them); it differs from the name
+    fingerprints older releases stored, so those start over once.
+    """
+    if source.kind == "mbox":
+        with open(source.path, "rb") as f:
+            head = f.read(64 * 1024)
+    else:
+        head = f"{source.kind}:file-names".encode("ascii")
+    return zlib.crc32(head) or 1
+
+def mbox_boundary(path: str, offset: int) -> bool:
+    """
+    Whether offset (an mbox uid) is still where a message starts, or the end
+    of the file. An mbox that was only appended to keeps every boundary.
+    """
+    size = os.path.getsize(path)
+    if offset == 0 or offset == size:
+        return True
+    if offset > size:
+        return False
+    with open(path, "rb") as f:
+        f.seek(offset - 1)
+        return f.read(6) == b"\nFrom "
+
+def _mbox_flags(header: bytes) -> List[str]:
+    flags = []
+    for m in _STATUS_RE.finditer(header):
+        flags.extend(MBOX_STATUS_FLAGS[c] for c in m.group(1).decode("ascii").upper() if c in MBOX_STATUS_FLAGS)
+    return sorted(set(flags))
+
+def _header_block(raw: bytes) -> bytes:
+    ends = [i for i in (raw.find(b"\n\n"), raw.find(b"\r\n\r\n")) if i >= 0]
+    return raw[:min(ends)] if ends else raw
+
+def _from_line_date(line: bytes) -> Optional[datetime]:
+    # "From sender@example.com Thu Jan  1 10:00:00 2020" (asctime, usually UTC)
+    # Takeout adds an offset: "From 1234@xxx Sat Jan 01 10:00:00 +0000 2022"
+    parts = line.decode("latin-1").split(None, 2)
+    if len(parts) < 3:
+        return None
+    tokens = [t for t in parts[2].split() if not _TZ_RE.match(t)][:5]
+    try:
+        return datetime.strptime(" ".join(tokens), "%a %b %d %H:%M:%S %Y").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def iter_mbox(path: str, start: int = 0) -> Iterator[ArchiveRow]:
+    """
+    Yields the messages of an mbox whose end offset lies after start.
+    """
+    size = os.path.getsize(path)
+    if size == 0 or start >= size:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[start:start + 5] == b"From " and (start == 0 or mm[start - 1] == 0x0A):
+            pos = start
+        else:
+            nxt = mm.find(b"\nFrom ", max(0, start - 1))
+            if nxt < 0:
+                return
+            pos = nxt + 1
+        while pos < size:
+            line_end = mm.find(b"\n", pos)
+            if line_end < 0:
+                return
+            nxt = mm.find(b"\nFrom ", line_end)
+            end = size if nxt < 0 else nxt + 1
+            raw = mm[line_end + 1:end]
+            # drop the blank separator line, undo mboxrd ">From " quoting
+            if raw.endswith(b"\r\n"):
+                raw = raw[:-2]
+            elif raw.endswith(b"\n"):
+                raw = raw[:-1]
+            if b">From " in raw:
+                raw = _FROM_QUOTED_RE.sub(rb"\1", raw)
+            yield end, raw, _mbox_flags(_header_block(raw)), _from_line_date(mm[pos:line_end])
+            pos = end
+
+def _file_date(path: str) -> datetime:
+    return datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+
+def iter_files(source: ArchiveSource, skip: Collection[int] = ()) -> Iterator[ArchiveRow]:
+    """
+    Yields the messages of a Maildir or .eml directory in name order, except
+    the files whose uid is in skip.
+    """
+    directory = source.path if os.path.isdir(source.path) else os.path.dirname(source.path)
+    for name in _listing(source):
+        uid = file_uid(source, name)
+        if uid in skip:
+            continue
+        path = os.path.join(directory, name)
+        with open(path, "rb") as f:
+            raw = f.read()
+        flags: List[str] = []
+        if source.kind == "maildir" and ":2," in name:
+            flags = sorted(MAILDIR_FLAGS[c] for c in name.rsplit(":2,", 1)[1] if c in MAILDIR_FLAGS)
+        yield uid, raw, flags, _file_date(path)
+
+def iter_source(source: ArchiveSource, start: int = 0, skip: Collection[int] = ()) -> Iterator[ArchiveRow]:
+    if source.kind == "mbox":
+        return iter_mbox(source.path, start)
+    return iter_files(source, skip)
+
+def archive_producer(
+    account_email: str,
+    provider: str,
+    sources: List[ArchiveSource],
+    opts: FetchOptions,
+    max_per_source: int = 0,
+    log=None,
+) -> Producer:
+    """
+    One pipeline producer reading the sources one after the other, emitting
+    batches bounded by opts.batch_size/opts.batch_bytes.
+    """
+    log = log or (lambda msg: None)
+
+    def produce(emit, stop) -> None:
+        for source in sources:
+            identity = source_identity(source)
+            stored = peek_uidvalidity(account_email, source.mailbox)
+            start = peek_checkpoint(account_email, source.mailbox)
+            skip = peek_archive_files(account_email, source.mailbox) if source.kind != "mbox" else set()
+            rewritten = source.kind == "mbox" and stored == identity and not mbox_boundary(source.path, start)
+            if stored != identity or rewritten:
+                reset = stored != 0
+                if reset:
+                    log(f"{source.mailbox}: {source.path} changed since the last import, starting over")
+                    start, skip = 0, set()
+                state = FolderState(uidvalidity=identity)
+                if not emit(RawBatch(account_email, provider, source.mailbox, [], [], folder_state=state, reset=reset)):
+                    return
+            if source.kind == "mbox":
+                log(f"{source.mailbox}: reading mbox {source.path} from offset {start}")
+            else:
+                log(f"{source.mailbox}: reading {source.kind} {source.path}, {len(skip)} files already imported")
+
+            rows: list = []
+            batch_bytes = 0
+            count = 0
+            for uid, raw, flags, internal_date in iter_source(source, start, skip):
+                if stop.is_set():
+                    return
+                rows.append((uid, raw, flags, internal_date, len(raw)))
+                batch_bytes += len(raw)
+                count += 1
+                limit = max_per_source and count >= max_per_source
+                if len(rows) >= opts.batch_size or (opts.batch_bytes and batch_bytes >= opts.batch_bytes) or limit:
+                    if not emit(RawBatch(account_email, provider, source.mailbox, [r[0] for r in rows], rows)):
+                        return
+                    rows, batch_bytes = [], 0
+                if limit:
+                    break
+            if rows and not emit(RawBatch(account_email, provider, source.mailbox, [r[0] for r in rows], rows)):
+                return
+
+    return produce
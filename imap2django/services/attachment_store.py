@@ -0,0 +1,59 @@
+"""
+Content-addressed local store for attachment payloads.
+
+Files live at <root>/<sha[:2]>/<sha[2:4]>/<sha>. A payload is hashed in a
+first streaming pass and only written if that hash is not stored yet, so the
+same PDF forwarded 500 times costs one write and one file. Writes go to a
+temp file and are renamed into place, which keeps concurrent importers safe.
+"""
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterable, Tuple
+
+ChunkSource = Callable[[], Iterable[bytes]]
+
+class AttachmentStore:
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    def url_for(self, sha256: str) -> str:
+        return self.path_for(sha256).resolve().as_uri()
+
+    def exists(self, sha256: str) -> bool:
+        return self.path_for(sha256).exists()
+
+    def put(self, chunks: ChunkSource) -> Tuple[str, int, str]:
+        """
+        chunks is called to get a fresh iterator over the decoded payload (once to
+        hash, once more to write if the content is new). Returns (sha256, size, storage_url).
+        """
+        h = hashlib.sha256()
+        size = 0
+        for chunk in chunks():
+            h.update(chunk)
+            size += len(chunk)
+        sha256 = h.hexdigest()
+
+        final = self.path_for(sha256)
+        if not final.exists():
+            final.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=final.parent, prefix=".tmp-")
+            try:
+                written = hashlib.sha256()
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in chunks():
+                        written.update(chunk)
+                        f.write(chunk)
+                if written.hexdigest() != sha256:
+                    raise IOError(f"attachment payload changed while storing {sha256}")
+                os.replace(tmp, final)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        return sha256, size, self.url_for(sha256)
@@ -0,0 +1,117 @@
+"""
+Content-addressed, compressed storage of message bodies (BODY_STORAGE = "table").
+
+Instead of Message.body_text/body_html, each distinct body is stored once in
+a MessageBody row keyed by the sha256 of its text, so the same newsletter
+received by thousands of messages costs one row. Rows are compressed with
+zstandard if installed, zlib otherwise (see compression), and the codec is
+stored per row so both can be read back whatever is installed later. Message only holds
+foreign keys: bodies are read on first access through
+Message.get_body_text()/get_body_html(), and queries that do not ask for
+them (threading, listings) never read body data.
+"""
+import hashlib
+from typing import Callable, Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db import transaction
+from ..models import Message, MessageBody
+from .compression import compress, compressor, decompress
+
+def table_storage() -> bool:
+    return getattr(settings, "BODY_STORAGE", "inline") == "table"
+
+def body_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+def encode_body(data: bytes, level: int = 6) -> Tuple[str, bytes]:
+    """
+    (codec, compressed bytes) of a UTF-8 encoded body.
+    """
+    return compress(data, level)
+
+def decode_body(codec: str, data: bytes) -> str:
+    return decompress(codec, data).decode("utf-8", errors="surrogatepass")
+
+def store_bodies(by_sha: Dict[str, str], level: int = 6) -> Dict[str, int]:
+    """
+    by_sha: {sha256: body text}. Returns {sha256: MessageBody pk}; only bodies
+    not stored yet are compressed (at `level`) and inserted.
+    """
+    if not by_sha:
+        return {}
+    ids = dict(MessageBody.objects.filter(sha256__in=list(by_sha)).values_list("sha256", "id"))
+    new = [sha for sha in by_sha if sha not in ids]
+    if new:
+        rows = []
+        codec, pack = compressor(level)
+        for sha in new:
+            data = by_sha[sha].encode("utf-8", errors="surrogatepass")
+            rows.append(MessageBody(sha256=sha, codec=codec, size=len(data), data=pack(data)))
+        MessageBody.objects.bulk_create(rows, ignore_conflicts=True)
+        ids.update(MessageBody.objects.filter(sha256__in=new).values_list("sha256", "id"))
+    return ids
+
+def externalize_bodies(messages: List[Message]) -> int:
+    """
+    Moves body_text/body_html of Message objects (before they are saved or
+    bulk-updated) into MessageBody rows and points text_body/html_body at them.
+    Does nothing unless BODY_STORAGE = "table". Returns how many bodies moved.
+    """
+    if not table_storage():
+        return 0
+    shas: List[Tuple[str, str]] = []
+    by_sha: Dict[str, str] = {}
+    for m in messages:
+        pair = tuple(body_sha256(t) if t else "" for t in (m.body_text, m.body_html))
+        for sha, text in zip(pair, (m.body_text, m.body_html)):
+            if sha:
+                by_sha[sha] = text
+        shas.append(pair)
+    ids = store_bodies(by_sha)
+    for m, (text_sha, html_sha) in zip(messages, shas):
+        m.text_body_id = ids[text_sha] if text_sha else None
+        m.html_body_id = ids[html_sha] if html_sha else None
+        m.body_text = ""
+        m.body_html = ""
+    return sum(bool(a) + bool(b) for a, b in shas)
+
+INLINE_FIELDS = ["body_text", "body_html", "text_body_id", "html_body_id"]
+
+def move_inline_bodies(batch_size: int = 500, limit: int = 0, log: Optional[Callable[[str], None]] = None) -> Tuple[int, int]:
+    """
+    Moves bodies still stored on Message rows (imported before BODY_STORAGE =
+    "table") into MessageBody, in id order, one transaction per batch. Moved
+    rows no longer match, so an interrupted run just starts over where it
+    stopped. Returns (messages, bodies) moved.
+    """
+    last_id = 0
+    messages = bodies = 0
+    while not limit or messages < limit:
+        size = min(batch_size, limit - messages) if limit else batch_size
+        batch = list(
+            Message.objects.filter(id__gt=last_id)
+            .exclude(body_text="", body_html="")
+            .only("id", *INLINE_FIELDS)
+            .order_by("id")[:size]
+        )
+        if not batch:
+            break
+        with transaction.atomic():
+            bodies += externalize_bodies(batch)
+            Message.objects.bulk_update(batch, INLINE_FIELDS)
+        messages += len(batch)
+        last_id = batch[-1].id
+        if log:
+            log(f"Moved bodies of {messages} messages (up to id {last_id})")
+    return messages, bodies
+
+def prune_bodies() -> int:
+    """
+    Deletes MessageBody rows no message points at any more (left behind when
+    reprocess or a body backfill replaced a body). Not safe while an import is
+    writing. Returns how many were deleted.
+    """
+    used = Message.objects.filter(text_body__isnull=False).values("text_body_id")
+    used_html = Message.objects.filter(html_body__isnull=False).values("html_body_id")
+    deleted, _ = MessageBody.objects.exclude(id__in=used).exclude(id__in=used_html).delete()
+    return deleted
@@ -1,4 +1,5 @@
-from ..models import ImportCheckpoint, Account
+from typing import List, Set
+from ..models import ArchiveFile, ImportCheckpoint, Account, MailboxMessage
 
 def get_checkpoint(account: Account, mailbox_name: str) -> int:
     cp, _ = ImportCheckpoint.objects.get_or_create(
@@ -14,3 +15,68 @@ def set_checkpoint(account: Account, mailbox_name: str, last_uid: int):
         mailbox_name=mailbox_name,
         defaults={"last_uid": last_uid}
     )
+
+def peek_checkpoint(account_email: str, mailbox_name: str) -> int:
+    """
+    Read-only lookup (no row is created); safe to call from fetcher threads.
+    """
+    last_uid = (
+        ImportCheckpoint.objects
+        .filter(account__email=account_email, mailbox_name=mailbox_name)
+        .values_list("last_uid", flat=True)
+        .first()
+    )
+    return last_uid or 0
+
+def peek_highest_modseq(account_email: str, mailbox_name: str) -> int:
+    """
+    HIGHESTMODSEQ the folder's flags were last synced at (0 = never).
+    """
+    modseq = (
+        ImportCheckpoint.objects
+        .filter(account__email=account_email, mailbox_name=mailbox_name)
+        .values_list("highest_modseq", flat=True)
+        .first()
+    )
+    return modseq or 0
+
+def peek_uidvalidity(account_email: str, mailbox_name: str) -> int:
+    """
+    UIDVALIDITY the stored last_uid belongs to (0 = unknown or no checkpoint yet).
+    """
+    uidvalidity = (
+        ImportCheckpoint.objects
+        .filter(account__email=account_email, mailbox_name=mailbox_name)
+        .values_list("uidvalidity", flat=True)
+        .first()
+    )
+    return uidvalidity or 0
+
+def peek_relinking(account_email: str, mailbox_name: str) -> bool:
+    """
+    True while the folder's re-link pass after a UIDVALIDITY change has not completed.
+    """
+    return ImportCheckpoint.objects.filter(
+        account__email=account_email, mailbox_name=mailbox_name, relinking=True
+    ).exists()
+
+def peek_archive_files(account_email: str, mailbox_name: str) -> Set[int]:
+    """
+    uids of the Maildir/.eml files already read into the mailbox (see archive.file_uid).
+    """
+    return set(
+        ArchiveFile.objects
+        .filter(checkpoint__account__email=account_email, checkpoint__mailbox_name=mailbox_name)
+        .values_list("uid", flat=True)
+    )
+
+def peek_header_only_uids(account_email: str, mailbox_name: str) -> List[int]:
+    """
+    UIDs of the folder's messages imported without bodies (import_imap --mode headers), ascending.
+    """
+    return list(
+        MailboxMessage.objects
+        .filter(mailbox__account__email=account_email, mailbox__name=mailbox_name, message__has_body=False)
+        .order_by("uid")
+        .values_list("uid", flat=True)
+    )
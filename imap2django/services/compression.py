@@ -0,0 +1,38 @@
+"""
+Compression shared by the raw spool and the body store: zstandard if
+installed, zlib otherwise. Callers keep the codec name next to the data, so
+either can be read back whatever is installed later.
+"""
+import zlib
+from typing import Callable, Tuple
+
+ZLIB, ZSTD = "zlib", "zstd"
+
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def compressor(level: int = 6) -> Tuple[str, Callable[[bytes], bytes]]:
+    """
+    (codec, function compressing bytes at `level`). Create one per thread:
+    the zstd compressor behind the function must not be shared.
+    """
+    zstd = zstandard_module()
+    if zstd:
+        return ZSTD, zstd.ZstdCompressor(level=level).compress
+    return ZLIB, lambda data: zlib.compress(data, level)
+
+def compress(data: bytes, level: int = 6) -> Tuple[str, bytes]:
+    codec, pack = compressor(level)
+    return codec, pack(data)
+
+def decompress(codec: str, data: bytes) -> bytes:
+    if codec == ZSTD:
+        zstd = zstandard_module()
+        if zstd is None:
+            raise RuntimeError("This data is zstd-compressed but the zstandard package is not installed")
+        return zstd.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
@@ -1,6 +1,11 @@
-from django.db import transaction
-from ..models import Person, Message, Recipient, Attachment
+from typing import Dict, List, Optional, Set, Tuple
+from django.db import IntegrityError, transaction
+from ..models import Person, Message, MailboxMessage, Recipient, Attachment
 from ..utils import norm_email
+from .body_store import externalize_bodies
+from .metrics import Metrics, measure_stage
+from .person_cache import PersonCache, default_person_cache
+from .threading import resolve_threads_bulk, thread_keys_bulk
 
 def upsert_person(email_norm: str, display_name: str = "") -> Person:
     key = email_norm
@@ -19,22 +24,30 @@ def upsert_message_and_relations(n, internal_date=None):
     """
     Returns (message, created_bool)
     """
-    msg, created = Message.objects.get_or_create(
-        raw_sha256=n.raw_sha256,
-        defaults={
-            "message_id": n.message_id or None,
-            "content_fingerprint": n.content_fingerprint,
-            "subject": n.subject,
-            "subject_norm": n.subject_norm,
-            "date": n.date_dt,
-            "internal_date": internal_date,
-            "in_reply_to": n.in_reply_to,
-            "references_json": n.references,
-            "body_text": n.body_text,
-            "body_html": n.body_html,
-            "size": n.size,
-        }
-    )
+    msg = Message.objects.filter(raw_sha256=n.raw_sha256).first()
+    created = False
+    if msg is None:
+        # bodies are only stored for a message that is really new, or they'd be orphaned
+        bodies = Message(body_text=n.body_text, body_html=n.body_html)
+        externalize_bodies([bodies])
+        msg, created = Message.objects.get_or_create(
+            raw_sha256=n.raw_sha256,
+            defaults={
+                "message_id": n.message_id or None,
+                "content_fingerprint": n.content_fingerprint,
+                "subject": n.subject,
+                "subject_norm": n.subject_norm,
+                "date": n.date_dt,
+                "internal_date": internal_date,
+                "in_reply_to": n.in_reply_to,
+                "references_json": n.references,
+                "body_text": bodies.body_text,
+                "body_html": bodies.body_html,
+                "text_body_id": bodies.text_body_id,
+                "html_body_id": bodies.html_body_id,
+                "size": n.size,
+            }
+        )
 
     # If it already existed, we still might want to update missing message_id
     if not created and n.message_id and not msg.message_id:
@@ -69,6 +82,239 @@ def upsert_message_and_relations(n, internal_date=None):
                 content_type=a.content_type or "",
                 size=a.size or 0,
                 part_id=a.part_id or "",
+                sha256=a.sha256 or "",
+                storage_url=a.storage_url or "",
             )
 
     return msg, created
+
+def upsert_people_bulk(people, cache: Optional[PersonCache] = None) -> Dict[str, int]:
+    """
+    Set-based upsert_person. Takes (email_norm, display_name) pairs and
+    returns {email_norm: person pk}, resolving known people from the cache.
+    """
+    return (cache if cache is not None else default_person_cache).resolve(people)
+
+def _message_from_normalized(n, internal_date=None, thread_id=None) -> Message:
+    return Message(
+        raw_sha256=n.raw_sha256,
+        message_id=n.message_id or None,
+        content_fingerprint=n.content_fingerprint,
+        subject=n.subject,
+        subject_norm=n.subject_norm,
+        date=n.date_dt,
+        internal_date=internal_date,
+        in_reply_to=n.in_reply_to,
+        references_json=n.references,
+        body_text=n.body_text,
+        body_html=n.body_html,
+        size=n.size,
+        has_body=n.has_body,
+        thread_id=thread_id,
+    )
+
+@transaction.atomic
+def upsert_messages_bulk(entries, person_cache: Optional[PersonCache] = None, metrics: Optional[Metrics] = None):
+    """
+    Set-based upsert_message_and_relations.
+    entries: iterable of (normalized, internal_date).
+    Returns ({raw_sha256: message}, set of created raw_sha256)
+    """
+    pending: Dict[str, tuple] = {}
+    for n, internal_date in entries:
+        pending.setdefault(n.raw_sha256, (n, internal_date))
+    if not pending:
+        return {}, set()
+
+    with measure_stage(metrics, "dedup"):
+        messages = Message.objects.only("id", "raw_sha256", "message_id").in_bulk(
+            list(pending), field_name="raw_sha256"
+        )
+
+        # Existing rows might still be missing a message_id
+        fixed = []
+        for sha, msg in messages.items():
+            n = pending[sha][0]
+            if n.message_id and not msg.message_id:
+                msg.message_id = n.message_id
+                fixed.append(msg)
+        if fixed:
+            Message.objects.bulk_update(fixed, ["message_id"])
+
+    created = [sha for sha in pending if sha not in messages]
+    if not created:
+        return messages, set()
+
+    # Thread new messages right away so no full rebuild is needed after an import
+    thread_keys = thread_keys_bulk([pending[sha][0] for sha in created])
+    subjects = {}
+    for sha in created:
+        subjects.setdefault(thread_keys[sha], pending[sha][0].subject_norm)
+    threads = resolve_threads_bulk(subjects)
+
+    new_messages = [_message_from_normalized(*pending[sha], thread_id=threads[thread_keys[sha]]) for sha in created]
+    externalize_bodies(new_messages)
+    inserted = _insert_new_messages(new_messages)
+    messages.update(
+        Message.objects.only("id", "raw_sha256", "message_id").in_bulk(created, field_name="raw_sha256")
+    )
+
+    # Relations only for the messages this batch inserted (avoid duplicates)
+    _create_relations_bulk([(pending[sha][0], messages[sha]) for sha in created if sha in inserted], person_cache)
+    return messages, inserted
+
+def _insert_new_messages(new_messages: List[Message]) -> Set[str]:
+    """
+    Inserts messages looked up as missing and returns the raw_sha256 of those
+    actually inserted. Rows another process inserted since the lookup make
+    the insert fail; it is then retried (in a savepoint) without them.
+    """
+    while new_messages:
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(new_messages)
+            return {m.raw_sha256 for m in new_messages}
+        except IntegrityError:
+            taken = set(
+                Message.objects.filter(raw_sha256__in=[m.raw_sha256 for m in new_messages])
+                .values_list("raw_sha256", flat=True)
+            )
+            if not taken:
+                raise
+            new_messages = [m for m in new_messages if m.raw_sha256 not in taken]
+            for m in new_messages:
+                m.pk = None
+    return set()
+
+def _create_relations_bulk(pairs, person_cache: Optional[PersonCache] = None):
+    """
+    pairs: (normalized, message) of messages without recipients/attachments yet.
+    """
+    people = []
+    for n, _msg in pairs:
+        if n.from_email_norm:
+            people.append((n.from_email_norm, n.from_name))
+        for name, email in n.to_norm + n.cc_norm + n.bcc_norm:
+            people.append((email, name))
+    persons = upsert_people_bulk(people, person_cache)
+
+    recipients = []
+    attachments = []
+    for n, msg in pairs:
+        for rtype, addrs in ((Recipient.TO, n.to_norm), (Recipient.CC, n.cc_norm), (Recipient.BCC, n.bcc_norm)):
+            for name, email in addrs:
+                if email:
+                    recipients.append(Recipient(message=msg, person_id=persons[email], type=rtype))
+        for a in n.attachments:
+            attachments.append(Attachment(
+                message=msg,
+                filename=a.filename or "",
+                content_type=a.content_type or "",
+                size=a.size or 0,
+                part_id=a.part_id or "",
+                sha256=a.sha256 or "",
+                storage_url=a.storage_url or "",
+            ))
+    if recipients:
+        Recipient.objects.bulk_create(recipients)
+    if attachments:
+        Attachment.objects.bulk_create(attachments)
+
+# Message fields derived from the raw bytes; thread, internal_date, size (the
+# source's RFC822.SIZE, which the spool does not keep) and mailbox links are kept
+REFRESH_FIELDS = [
+    "message_id", "content_fingerprint", "subject", "subject_norm", "date",
+    "in_reply_to", "references_json", "body_text", "body_html", "text_body_id", "html_body_id",
+    "has_body",
+]
+
+@transaction.atomic
+def refresh_messages_bulk(normalized, person_cache: Optional[PersonCache] = None) -> int:
+    """
+    Re-derives stored messages from freshly parsed raw bytes (reprocess):
+    overwrites REFRESH_FIELDS and replaces recipients and attachments.
+    Messages no longer in the DB are skipped. Returns how many were updated.
+    """
+    pending = {n.raw_sha256: n for n in normalized}
+    messages = Message.objects.only("id", "raw_sha256").in_bulk(list(pending), field_name="raw_sha256")
+    if not messages:
+        return 0
+    fresh_messages = {sha: _message_from_normalized(pending[sha]) for sha in messages}
+    externalize_bodies(list(fresh_messages.values()))
+    for sha, msg in messages.items():
+        fresh = fresh_messages[sha]
+        for name in REFRESH_FIELDS:
+            setattr(msg, name, getattr(fresh, name))
+    Message.objects.bulk_update(list(messages.values()), REFRESH_FIELDS, batch_size=500)
+
+    pks = [msg.pk for msg in messages.values()]
+    Recipient.objects.filter(message_id__in=pks).delete()
+    Attachment.objects.filter(message_id__in=pks).delete()
+    _create_relations_bulk([(pending[sha], msg) for sha, msg in messages.items()], person_cache)
+    return len(messages)
+
+FILL_FIELDS = ["raw_sha256", "size"] + REFRESH_FIELDS
+
+@transaction.atomic
+def fill_bodies_bulk(pairs, person_cache: Optional[PersonCache] = None) -> Tuple[int, int]:
+    """
+    Backfill of header-only messages (import_imap --mode bodies).
+    pairs: (message pk, normalized from the full raw message). A header-only
+    row takes over the real raw_sha256, size and REFRESH_FIELDS, and gets its
+    recipients and attachments from the full parse. If that raw message is
+    already stored (imported in full from another folder, or filled earlier in
+    the batch), the row's folder links move to the stored message and the row
+    is deleted. Rows that already have a body are skipped.
+    Returns (filled, merged).
+    """
+    pending = dict(pairs)
+    messages = Message.objects.only("id", "raw_sha256").filter(has_body=False).in_bulk(list(pending))
+    if not messages:
+        return 0, 0
+    stored = dict(
+        Message.objects.filter(raw_sha256__in={pending[pk].raw_sha256 for pk in messages})
+        .values_list("raw_sha256", "id")
+    )
+
+    filled = []
+    merged: Dict[int, int] = {}  # header-only pk -> pk of the stored message
+    for pk, msg in messages.items():
+        n = pending[pk]
+        if n.raw_sha256 in stored:
+            merged[pk] = stored[n.raw_sha256]
+            continue
+        stored[n.raw_sha256] = pk
+        filled.append(msg)
+
+    fresh_messages = [_message_from_normalized(pending[msg.pk]) for msg in filled]
+    externalize_bodies(fresh_messages)
+    for msg, fresh in zip(filled, fresh_messages):
+        for name in FILL_FIELDS:
+            setattr(msg, name, getattr(fresh, name))
+
+    for pk, target in merged.items():
+        MailboxMessage.objects.filter(message_id=pk).update(message_id=target)
+    if merged:
+        Message.objects.filter(pk__in=list(merged)).delete()
+    if filled:
+        Message.objects.bulk_update(filled, FILL_FIELDS, batch_size=500)
+        pks = [msg.pk for msg in filled]
+        Recipient.objects.filter(message_id__in=pks).delete()
+        Attachment.objects.filter(message_id__in=pks).delete()
+        _create_relations_bulk([(pending[msg.pk], msg) for msg in filled], person_cache)
+    return len(filled), len(merged)
+
+def find_known_messages(keys) -> Dict[tuple, int]:
+    """
+    keys: iterable of (message_id, size). Returns {(message_id, size): message pk}
+    for messages already stored, so their bodies need not be downloaded again.
+    """
+    wanted = {(mid, size) for mid, size in keys if mid}
+    if not wanted:
+        return {}
+    found: Dict[tuple, int] = {}
+    rows = Message.objects.filter(message_id__in={mid for mid, _ in wanted}).values_list("id", "message_id", "size")
+    for pk, mid, size in rows:
+        if (mid, size) in wanted:
+            found.setdefault((mid, size), pk)
+    return found
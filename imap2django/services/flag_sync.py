@@ -0,0 +1,95 @@
+"""
+Flag and expunge sync for messages that were already imported.
+
+With CONDSTORE only flags changed since the stored HIGHESTMODSEQ are fetched
+(UID FETCH 1:<last_uid> (FLAGS) (CHANGEDSINCE n)), and with QRESYNC the same
+command reports expunged UIDs as VANISHED. The first sync of a folder, or a
+server without CONDSTORE, falls back to one FLAGS pass over the imported UID
+range plus a UID SEARCH diff for expunges. A CONDSTORE server need not move
+HIGHESTMODSEQ on expunge, so without QRESYNC the UID diff also runs when the
+folder's message count differs from the number of linked rows.
+
+The IMAP side runs on the fetch threads (collect_flag_changes); the result
+travels through the pipeline and is written by the DB writer (apply_flag_changes).
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+from django.db import transaction
+from ..models import MailboxMessage
+from .checkpoint import peek_checkpoint, peek_highest_modseq
+from .imap_client import FlagMap, FolderState
+from .import_session import FolderSession
+
+@dataclass
+class FlagChanges:
+    flags: FlagMap = field(default_factory=dict)  # uid -> (flags, modseq)
+    vanished: List[int] = field(default_factory=list)
+    highest_modseq: int = 0  # store this once applied
+    full: bool = False  # True when every imported uid was fetched (no usable modseq)
+
+def collect_flag_changes(imap, account_email: str, folder: str, state: FolderState) -> Optional[FlagChanges]:
+    """
+    Asks the (already selected) folder what changed on imported messages.
+    Returns None when nothing can have changed.
+    """
+    last_uid = peek_checkpoint(account_email, folder)
+    if not last_uid:
+        return None  # nothing imported yet
+    since = peek_highest_modseq(account_email, folder)
+    known = MailboxMessage.objects.filter(
+        mailbox__account__email=account_email, mailbox__name=folder, uid__lte=last_uid
+    ).values_list("uid", flat=True)
+
+    if imap.sync_mode and since and state.highest_modseq:
+        if state.highest_modseq <= since:
+            if imap.sync_mode == "qresync" or state.exists == known.count():
+                return None
+            flags, vanished = {}, None  # no flag changed, but something was expunged
+        else:
+            flags, vanished = imap.fetch_changed_flags(since, last_uid)
+        changes = FlagChanges(flags=flags, highest_modseq=state.highest_modseq)
+    else:
+        flags, vanished = imap.fetch_flags(last_uid), None
+        changes = FlagChanges(flags=flags, highest_modseq=state.highest_modseq, full=True)
+
+    if vanished is None:
+        if changes.full:
+            present = set(flags)
+        else:
+            present = set(imap.search_uids_upto(last_uid))
+        vanished = sorted(uid for uid in known.iterator(chunk_size=10000) if uid not in present)
+    changes.vanished = vanished
+    return changes
+
+@transaction.atomic
+def apply_flag_changes(folder: FolderSession, changes: FlagChanges, chunk_size: int = 2000) -> Tuple[int, int]:
+    """
+    Bulk-updates flags/modseq, drops MailboxMessage rows of expunged UIDs (the
+    Message itself stays, it may live in other folders) and records the new
+    HIGHESTMODSEQ in the same transaction. Returns (updated, removed).
+    """
+    mailbox = folder.mailbox
+    updated = removed = 0
+    uids = sorted(changes.flags)
+    for i in range(0, len(uids), chunk_size):
+        rows = MailboxMessage.objects.filter(mailbox=mailbox, uid__in=uids[i:i + chunk_size]).only(
+            "id", "uid", "flags_json", "modseq"
+        )
+        changed = []
+        for mm in rows:
+            flags, modseq = changes.flags[mm.uid]
+            if set(mm.flags_json or []) != set(flags) or (modseq and mm.modseq != modseq):
+                mm.flags_json = list(flags)
+                mm.modseq = modseq or mm.modseq
+                changed.append(mm)
+        if changed:
+            MailboxMessage.objects.bulk_update(changed, ["flags_json", "modseq"], batch_size=500)
+            updated += len(changed)
+
+    vanished = changes.vanished
+    for i in range(0, len(vanished), chunk_size):
+        removed += MailboxMessage.objects.filter(mailbox=mailbox, uid__in=vanished[i:i + chunk_size]).delete()[0]
+
+    if changes.highest_modseq:
+        folder.set_highest_modseq(changes.highest_modseq)
+    return updated, removed
@@ -0,0 +1,99 @@
+"""
+Plain text from HTML bodies without building a document tree.
+
+html_to_text() runs lxml's HTML parser in target (SAX-style) mode and only
+keeps text events: no element objects are created, script/style/template
+content is dropped as it streams by, and parsing stops once `limit`
+characters are collected. The result is what BeautifulSoup(html, "lxml")
+.get_text("\n") returns, which the parser used before: text nodes joined by
+newlines, whitespace-only nodes collapsed to one space or newline outside
+<pre>/<textarea>. Markup lxml rejects falls back to BeautifulSoup.
+"""
+from typing import List
+from bs4 import BeautifulSoup
+from lxml import etree
+
+# BeautifulSoup keeps the text of these in non-text string classes that get_text() skips
+SKIPPED_TAGS = frozenset({"script", "style", "template", "rt", "rp"})
+PRESERVE_WHITESPACE_TAGS = frozenset({"pre", "textarea"})
+_ASCII_SPACES = " \n\t\x0c\r"
+_FEED_CHUNK = 64 * 1024
+
+class _LimitReached(Exception):
+    pass
+
+class _TextTarget:
+    """
+    lxml parser target collecting text nodes the way BeautifulSoup's tree builder delimits them.
+    """
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.parts: List[str] = []
+        self.size = 0
+        self.pending: List[str] = []
+        self.skip = 0
+        self.preserve = 0
+
+    def _flush(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        if self.skip:
+            return
+        if not self.preserve and not text.strip(_ASCII_SPACES):
+            text = "\n" if "\n" in text else " "
+        self.parts.append(text)
+        self.size += len(text) + 1
+        if self.limit and self.size > self.limit:
+            raise _LimitReached()
+
+    def start(self, tag, attrib):
+        self._flush()
+        if tag in SKIPPED_TAGS:
+            self.skip += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve += 1
+
+    def end(self, tag):
+        self._flush()
+        if tag in SKIPPED_TAGS and self.skip:
+            self.skip -= 1
+        if tag in PRESERVE_WHITESPACE_TAGS and self.preserve:
+            self.preserve -= 1
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def pi(self, target, data=None):
+        self._flush()
+
+    def doctype(self, *args):
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+def _soup_text(html: str, limit: int = 0) -> str:
+    text = BeautifulSoup(html, "lxml").get_text("\n")
+    return text[:limit] if limit else text
+
+def html_to_text(html: str, limit: int = 0) -> str:
+    """
+    Text of an HTML document, truncated to `limit` characters (0 = no limit).
+    """
+    target = _TextTarget(limit)
+    parser = etree.HTMLParser(target=target, recover=True, strip_cdata=False)
+    try:
+        for i in range(0, len(html), _FEED_CHUNK):
+            parser.feed(html[i:i + _FEED_CHUNK])
+        parser.close()
+    except _LimitReached:
+        pass
+    except (etree.LxmlError, UnicodeError, LookupError):
+        return _soup_text(html, limit)
+    text = "\n".join(target.parts)
+    return text[:limit] if limit else text
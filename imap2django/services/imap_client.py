@@ -1,5 +1,15 @@
+import imaplib
+import json
+import random
+import socket
+import ssl
+import time
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional, Iterable, Tuple
+from email import policy
+from email.parser import BytesHeaderParser
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, BinaryIO, Callable
+from datetime import timezone as dt_timezone
+from django.utils import timezone
 from imapclient import IMAPClient
 
 @dataclass
@@ -9,15 +19,94 @@ class ImapConfig:
     ssl: bool = True
     username: str = ""
     password: str = ""
+    timeout: float = 120.0  # socket timeout, so a half-open connection fails instead of hanging
+
+@dataclass
+class AccountConfig:
+    account_email: str
+    provider: str
+    imap: ImapConfig
+
+def load_account_config(path: str) -> AccountConfig:
+    with open(path, "r", encoding="utf-8") as f:
+        account_cfg = json.load(f)
+
+    return AccountConfig(
+        account_email=account_cfg["account_email"],
+        provider=account_cfg.get("provider", ""),
+        imap=ImapConfig(
+            host=account_cfg["imap"]["host"],
+            port=int(account_cfg["imap"].get("port", 993)),
+            ssl=bool(account_cfg["imap"].get("ssl", True)),
+            username=account_cfg["imap"]["username"],
+            password=account_cfg["imap"]["password"],
+            timeout=float(account_cfg["imap"].get("timeout", 120)),
+        ),
+    )
+
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"
+BODY_FIELDS = ["RFC822", "FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+# header-only import: the whole header block and the MIME structure instead of the message
+HEADER_ONLY_FIELDS = ["BODY.PEEK[HEADER]", "BODYSTRUCTURE", "FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+
+class SyncIMAPClient(IMAPClient):
+    """
+    IMAPClient plus fetch_vanished(). IMAPClient.fetch() drops the untagged
+    VANISHED responses a QRESYNC server sends; they stay in the imaplib
+    connection IMAPClient wraps, where IMAP4.response() hands them out.
+    """
+    def fetch_vanished(self, messages, data: List[str], modifiers: List[str]) -> Tuple[Dict[int, Dict[str, Any]], list]:
+        """
+        fetch() that also returns the VANISHED response lines of this command.
+        """
+        self._imap.response("VANISHED")  # drop any left over from earlier commands
+        resp = self.fetch(messages, data, modifiers=modifiers)
+        _typ, lines = self._imap.response("VANISHED")
+        return resp, [line for line in lines or [] if line]
+
+@dataclass
+class FolderState:
+    """
+    What SELECT/EXAMINE reports about a folder. highest_modseq is 0 when the
+    server has no CONDSTORE support (or NOMODSEQ for this folder).
+    """
+    uidvalidity: int = 0
+    highest_modseq: int = 0
+    exists: int = 0
+    uidnext: int = 0
+
+# uid -> (flags, modseq)
+FlagMap = Dict[int, Tuple[List[str], Optional[int]]]
 
 class ImapClient:
-    def __init__(self, cfg: ImapConfig):
+    """
+    sync=True enables QRESYNC (or at least CONDSTORE) right after login, which
+    has to happen before any folder is selected. sync_mode then tells which
+    one the server granted: "qresync", "condstore" or "".
+
+    io="async" swaps the blocking IMAPClient for AioIMAPClient (see aio_imap),
+    which pipelines fetch_batches() on a shared asyncio event loop.
+    """
+    def __init__(self, cfg: ImapConfig, sync: bool = False, io: str = "sync"):
         self.cfg = cfg
+        self.sync = sync
+        self.io = io
+        self.sync_mode = ""
         self.client: Optional[IMAPClient] = None
 
+    def _open(self):
+        timeout = self.cfg.timeout or None
+        if self.io == "async":
+            from .aio_imap import AioIMAPClient
+
+            return AioIMAPClient(self.cfg.host, port=self.cfg.port, ssl=self.cfg.ssl, timeout=timeout)
+        return SyncIMAPClient(self.cfg.host, port=self.cfg.port, ssl=self.cfg.ssl, timeout=timeout)
+
     def __enter__(self):
-        self.client = IMAPClient(self.cfg.host, port=self.cfg.port, ssl=self.cfg.ssl)
+        self.client = self._open()
         self.client.login(self.cfg.username, self.cfg.password)
+        if self.sync:
+            self.enable_sync()
         return self
 
     def __exit__(self, exc_type, exc, tb):
@@ -34,9 +123,31 @@ class ImapClient:
             folders.append(name)
         return folders
 
-    def select_folder(self, folder: str):
+    def capabilities(self) -> set:
+        assert self.client
+        return {_name(c).upper() for c in self.client.capabilities()}
+
+    def enable_sync(self) -> str:
+        assert self.client
+        caps = self.capabilities()
+        wanted = [c for c in ("QRESYNC", "CONDSTORE") if c in caps]
+        enabled = {_name(c).upper() for c in self.client.enable(*wanted)} if wanted and "ENABLE" in caps else set()
+        if "QRESYNC" in enabled:
+            self.sync_mode = "qresync"
+        elif "CONDSTORE" in enabled or "CONDSTORE" in caps:
+            # CHANGEDSINCE works without ENABLE on CONDSTORE servers
+            self.sync_mode = "condstore"
+        return self.sync_mode
+
+    def select_folder(self, folder: str) -> FolderState:
         assert self.client
-        self.client.select_folder(folder, readonly=True)
+        resp = self.client.select_folder(folder, readonly=True)
+        return FolderState(
+            uidvalidity=resp.get(b"UIDVALIDITY", 0),
+            highest_modseq=resp.get(b"HIGHESTMODSEQ", 0),
+            exists=resp.get(b"EXISTS", 0),
+            uidnext=resp.get(b"UIDNEXT", 0),
+        )
 
     def search_uids_since(self, last_uid: int) -> List[int]:
         """
@@ -47,9 +158,343 @@ class ImapClient:
         start = last_uid + 1
         return self.client.search([u"UID", f"{start}:*"])
 
-    def fetch_batch(self, uids: List[int]) -> Dict[int, Dict[str, Any]]:
+    def search_uids_upto(self, max_uid: int) -> List[int]:
+        """
+        UIDs still present in 1..max_uid (used to spot expunges without QRESYNC).
+        """
+        assert self.client
+        if max_uid <= 0:
+            return []
+        return [u for u in self.client.search([u"UID", f"1:{max_uid}"]) if u <= max_uid]
+
+    def fetch_flags(self, max_uid: int, chunk: int = 5000) -> FlagMap:
+        """
+        FLAGS (and MODSEQ if available) of every message in 1..max_uid, in UID range chunks.
+        """
+        assert self.client
+        data = ["FLAGS", "MODSEQ"] if self.sync_mode else ["FLAGS"]
+        flags: FlagMap = {}
+        for lo in range(1, max_uid + 1, chunk):
+            hi = min(lo + chunk - 1, max_uid)
+            for uid, item in self.client.fetch(f"{lo}:{hi}", data).items():
+                flags[uid] = decode_flags_item(item)
+        return flags
+
+    def fetch_changed_flags(self, since_modseq: int, max_uid: int) -> Tuple[FlagMap, Optional[List[int]]]:
+        """
+        CONDSTORE: flags of messages in 1..max_uid changed since since_modseq.
+        With QRESYNC the second value lists the UIDs expunged since then
+        (VANISHED); without it, it is None and the caller has to diff UIDs.
+        """
+        assert self.client and self.sync_mode
+        if max_uid <= 0:
+            return {}, []
+        qresync = self.sync_mode == "qresync"
+        modifier = f"CHANGEDSINCE {since_modseq}" + (" VANISHED" if qresync else "")
+        resp, lines = self.client.fetch_vanished(f"1:{max_uid}", ["FLAGS"], [modifier])
+        flags = {uid: decode_flags_item(item) for uid, item in resp.items()}
+        if not qresync:
+            return flags, None
+        vanished: List[int] = []
+        for line in lines:
+            vanished.extend(u for u in parse_uid_set(_name(line).replace("(EARLIER)", "")) if u <= max_uid)
+        return flags, sorted(set(vanished))
+
+    def fetch_batch(self, uids: List[int], data: Optional[List[str]] = None) -> Dict[int, Dict[str, Any]]:
+        """
+        BODY_FIELDS of each uid, or the given fetch items (e.g. HEADER_ONLY_FIELDS).
+        """
         assert self.client
         if not uids:
             return {}
         # RFC822 gives raw bytes; FLAGS and INTERNALDATE are metadata
-        return self.client.fetch(uids, ["RFC822", "FLAGS", "INTERNALDATE", "RFC822.SIZE"])
+        return self.client.fetch(uids, data or BODY_FIELDS)
+
+    def fetch_batches(
+        self, batches: List[List[int]], window: int = 4, data: Optional[List[str]] = None
+    ) -> Iterator[Dict[int, Dict[str, Any]]]:
+        """
+        fetch_batch() of each uid list, in order. The async transport keeps up
+        to `window` of these commands in flight; the blocking one runs them one by one.
+        """
+        assert self.client
+        pipelined = getattr(self.client, "fetch_pipelined", None)
+        if pipelined is None:
+            for uids in batches:
+                yield ImapClient.fetch_batch(self, uids, data)
+        else:
+            yield from pipelined(batches, data or BODY_FIELDS, window)
+
+    def fetch_headers(self, uids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """
+        Cheap metadata pass: Message-ID header, size, flags and internal date, no body.
+        """
+        assert self.client
+        if not uids:
+            return {}
+        return self.client.fetch(uids, [HEADER_FIELDS, "FLAGS", "INTERNALDATE", "RFC822.SIZE"])
+
+    def fetch_sizes(self, uids: List[int], chunk: int = 1000) -> Dict[int, int]:
+        """
+        RFC822.SIZE for each uid, used to plan batches by bytes.
+        """
+        assert self.client
+        sizes: Dict[int, int] = {}
+        for i in range(0, len(uids), chunk):
+            for uid, item in self.client.fetch(uids[i:i + chunk], ["RFC822.SIZE"]).items():
+                sizes[uid] = _get(item, "RFC822.SIZE") or 0
+        return sizes
+
+    def fetch_to_file(self, uid: int, fp: BinaryIO, chunk_size: int = 4 * 1024 * 1024) -> Dict[str, Any]:
+        """
+        Streams one message into fp using partial fetches (BODY.PEEK[]<offset.length>)
+        so it is never held in memory as a whole. Returns the FLAGS/INTERNALDATE/RFC822.SIZE
+        item, or {} if the server sent no BODY[] for uid (nothing is written then).
+        """
+        assert self.client
+        meta: Dict[str, Any] = {}
+        offset = 0
+        while True:
+            data = [f"BODY.PEEK[]<{offset}.{chunk_size}>"]
+            if not meta:
+                data += ["FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+            item = self.client.fetch([uid], data).get(uid) or {}
+            part = _get_prefixed(item, "BODY[]")
+            if part is None and not offset:
+                return {}  # expunged since it was listed, or not there at all
+            if not meta:
+                meta = {k: v for k, v in item.items() if not _name(k).upper().startswith("BODY[")}
+            part = part or b""
+            fp.write(part)
+            offset += len(part)
+            if len(part) < chunk_size:
+                break
+        fp.flush()
+        return meta
+
+# socket-level failures; IMAP NO/BAD answers (imaplib.IMAP4.error) are not retried, and
+# neither are other OSErrors (a full disk or unwritable spool would fail again the same way)
+RETRYABLE_ERRORS = (imaplib.IMAP4.abort, ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError, EOFError)
+
+class UidValidityChanged(Exception):
+    pass
+
+class ResilientImapClient(ImapClient):
+    """
+    ImapClient that survives dropped connections (e.g. Outlook closing them
+    after ~30 minutes). A command failing with a socket error is retried after
+    reconnecting with exponential backoff: log in again, re-enable sync and
+    re-select the folder that was selected. If the folder's UIDVALIDITY changed
+    in between, UidValidityChanged is raised instead of retrying with stale uids.
+    Every wrapped command is a read, so retrying is safe.
+    """
+    def __init__(
+        self,
+        cfg: ImapConfig,
+        sync: bool = False,
+        io: str = "sync",
+        retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        log: Optional[Callable[[str], None]] = None,
+    ):
+        super().__init__(cfg, sync=sync, io=io)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.log = log or (lambda msg: None)
+        self.folder: Optional[str] = None
+        self.folder_state: Optional[FolderState] = None
+        self.reconnects = 0
+        self.opened = False
+
+    def __enter__(self):
+        self._retry(lambda: None)
+        return self
+
+    def _drop(self):
+        if self.client:
+            try:
+                self.client.shutdown()
+            except Exception:
+                pass
+        self.client = None
+
+    def _connect(self):
+        ImapClient.__enter__(self)
+        if self.opened:
+            self.reconnects += 1
+        self.opened = True
+        if self.folder:
+            state = ImapClient.select_folder(self, self.folder)
+            if self.folder_state and state.uidvalidity != self.folder_state.uidvalidity:
+                raise UidValidityChanged(
+                    f"{self.folder}: UIDVALIDITY changed from {self.folder_state.uidvalidity} "
+                    f"to {state.uidvalidity} while reconnecting"
+                )
+
+    def _retry(self, fn: Callable, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                if self.client is None:
+                    self._connect()
+                return fn(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                self._drop()
+                attempt += 1
+                if not self._wait(e, attempt):
+                    raise
+
+    def _wait(self, e: BaseException, attempt: int) -> bool:
+        """
+        Sleeps before reconnect number `attempt`; False once retries are used up.
+        """
+        if attempt > self.retries:
+            return False
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        self.log(
+            f"IMAP connection to {self.cfg.host} lost ({e.__class__.__name__}: {e}); "
+            f"reconnecting in {delay:.1f}s ({attempt}/{self.retries})"
+        )
+        time.sleep(delay)
+        return True
+
+    def list_folders(self) -> List[str]:
+        return self._retry(ImapClient.list_folders, self)
+
+    def select_folder(self, folder: str) -> FolderState:
+        state = self._retry(ImapClient.select_folder, self, folder)
+        self.folder, self.folder_state = folder, state
+        return state
+
+    def search_uids_since(self, last_uid: int) -> List[int]:
+        return self._retry(ImapClient.search_uids_since, self, last_uid)
+
+    def search_uids_upto(self, max_uid: int) -> List[int]:
+        return self._retry(ImapClient.search_uids_upto, self, max_uid)
+
+    def fetch_flags(self, max_uid: int, chunk: int = 5000) -> FlagMap:
+        return self._retry(ImapClient.fetch_flags, self, max_uid, chunk)
+
+    def fetch_changed_flags(self, since_modseq: int, max_uid: int) -> Tuple[FlagMap, Optional[List[int]]]:
+        return self._retry(ImapClient.fetch_changed_flags, self, since_modseq, max_uid)
+
+    def fetch_batch(self, uids: List[int], data: Optional[List[str]] = None) -> Dict[int, Dict[str, Any]]:
+        return self._retry(ImapClient.fetch_batch, self, uids, data)
+
+    def fetch_batches(
+        self, batches: List[List[int]], window: int = 4, data: Optional[List[str]] = None
+    ) -> Iterator[Dict[int, Dict[str, Any]]]:
+        # a dropped connection loses the commands in flight; start over at the first batch not yet returned
+        done = 0
+        attempt = 0
+        while done < len(batches):
+            self._retry(lambda: None)
+            client = self.client
+            try:
+                for result in ImapClient.fetch_batches(self, batches[done:], window, data):
+                    done += 1
+                    attempt = 0
+                    yield result
+            except RETRYABLE_ERRORS as e:
+                if self.client is client:  # not already replaced by another command's retry
+                    self._drop()
+                attempt += 1
+                if not self._wait(e, attempt):
+                    raise
+
+    def fetch_headers(self, uids: List[int]) -> Dict[int, Dict[str, Any]]:
+        return self._retry(ImapClient.fetch_headers, self, uids)
+
+    def fetch_sizes(self, uids: List[int], chunk: int = 1000) -> Dict[int, int]:
+        return self._retry(ImapClient.fetch_sizes, self, uids, chunk)
+
+    def fetch_to_file(self, uid: int, fp: BinaryIO, chunk_size: int = 4 * 1024 * 1024) -> Dict[str, Any]:
+        start = fp.tell()
+
+        def attempt():
+            # a retry starts the message over
+            fp.seek(start)
+            fp.truncate()
+            return ImapClient.fetch_to_file(self, uid, fp, chunk_size)
+
+        return self._retry(attempt)
+
+def _get(item: Dict, key: str):
+    return item.get(key.encode()) or item.get(key)
+
+def _name(key) -> str:
+    return key.decode("ascii", errors="ignore") if isinstance(key, bytes) else str(key)
+
+def _get_prefixed(item: Dict, prefix: str):
+    # section keys are echoed back in server-specific spelling, e.g. quoted field names
+    for key, value in item.items():
+        if _name(key).upper().startswith(prefix):
+            return value
+    return None
+
+def _decode_meta(item: Dict[Any, Any]) -> Tuple[List[str], Any, int]:
+    raw_flags = _get(item, "FLAGS") or []
+    flags = [
+        f.decode("utf-8", errors="ignore") if isinstance(f, (bytes, bytearray)) else str(f)
+        for f in raw_flags
+    ]
+
+    internal_date = _get(item, "INTERNALDATE")
+    if internal_date and timezone.is_naive(internal_date):
+        internal_date = timezone.make_aware(internal_date, dt_timezone.utc)
+
+    size = _get(item, "RFC822.SIZE") or 0
+    return flags, internal_date, size
+
+def decode_flags_item(item: Dict[Any, Any]) -> Tuple[List[str], Optional[int]]:
+    """
+    Unpacks a FLAGS/MODSEQ fetch response into (flags, modseq).
+    """
+    flags, _internal_date, _size = _decode_meta(item)
+    modseq = _get(item, "MODSEQ")
+    if isinstance(modseq, (tuple, list)):
+        modseq = modseq[0] if modseq else None
+    return flags, int(modseq) if modseq else None
+
+def parse_uid_set(text: str) -> List[int]:
+    """
+    Expands an IMAP sequence set such as "3,5:7" into [3, 5, 6, 7].
+    """
+    uids: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition(":")
+        a, b = int(lo), int(hi or lo)
+        uids.extend(range(min(a, b), max(a, b) + 1))
+    return uids
+
+def decode_fetch_item(item: Dict[Any, Any]) -> Tuple[bytes, List[str], Any, int]:
+    """
+    Unpacks one imapclient FETCH response into (raw, flags, internal_date, size).
+    """
+    raw = _get(item, "RFC822") or b""
+    flags, internal_date, size = _decode_meta(item)
+    return raw, flags, internal_date, size
+
+def decode_header_item(item: Dict[Any, Any]) -> Tuple[str, List[str], Any, int]:
+    """
+    Unpacks one fetch_headers response into (message_id, flags, internal_date, size).
+    """
+    # servers answer BODY.PEEK[...] as BODY[...]
+    header = _get_prefixed(item, "BODY[HEADER") or b""
+    msg = BytesHeaderParser(policy=policy.default).parsebytes(header)
+    message_id = (msg.get("Message-ID", "") or "").strip()
+    flags, internal_date, size = _decode_meta(item)
+    return message_id, flags, internal_date, size
+
+def decode_header_only_item(item: Dict[Any, Any]) -> Tuple[bytes, Any, List[str], Any, int]:
+    """
+    Unpacks one HEADER_ONLY_FIELDS response into (header, bodystructure, flags, internal_date, size).
+    """
+    header = _get_prefixed(item, "BODY[HEADER") or b""
+    structure = _get(item, "BODYSTRUCTURE")
+    flags, internal_date, size = _decode_meta(item)
+    return header, structure, flags, internal_date, size
@@ -0,0 +1,108 @@
+"""
+Per-run cache of the Account, Mailbox and ImportCheckpoint rows the DB writer
+touches, so they are resolved once per folder instead of once per batch.
+
+FolderSession writes checkpoint changes with a single UPDATE inside the
+caller's transaction (the one holding the batch data), so data and checkpoint
+commit or roll back together. The in-memory copy only moves once that
+transaction has committed.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from django.db import transaction
+from django.utils import timezone
+from ..models import Account, ArchiveFile, ImportCheckpoint, Mailbox
+
+@dataclass
+class FolderSession:
+    account: Account
+    mailbox: Mailbox
+    checkpoint: ImportCheckpoint
+
+    @property
+    def last_uid(self) -> int:
+        return self.checkpoint.last_uid
+
+    def _save(self, **fields):
+        # update() bypasses auto_now, so updated_at is set here
+        fields["updated_at"] = timezone.now()
+        ImportCheckpoint.objects.filter(pk=self.checkpoint.pk).update(**fields)
+
+        def remember():
+            for name, value in fields.items():
+                setattr(self.checkpoint, name, value)
+
+        transaction.on_commit(remember)
+
+    def advance(self, last_uid: int) -> bool:
+        """
+        Moves last_uid forward (never back). Call inside the batch's transaction.
+        """
+        if last_uid <= self.checkpoint.last_uid:
+            return False
+        self._save(last_uid=last_uid)
+        return True
+
+    def record_state(self, uidvalidity: int, highest_modseq: int = 0, reset: bool = False):
+        """
+        Stores UIDVALIDITY. reset=True means it changed: the checkpoint starts
+        over at 0 (forgetting the archive files it has read) and stays in
+        re-link mode until finish_relink().
+        """
+        if reset:
+            self._save(uidvalidity=uidvalidity, last_uid=0, highest_modseq=highest_modseq, relinking=True)
+            ArchiveFile.objects.filter(checkpoint=self.checkpoint).delete()
+        elif uidvalidity != self.checkpoint.uidvalidity:
+            self._save(uidvalidity=uidvalidity)
+
+    def finish_relink(self):
+        """
+        The folder was walked once since its UIDVALIDITY reset.
+        """
+        if self.checkpoint.relinking:
+            self._save(relinking=False)
+
+    def record_files(self, uids: List[int]):
+        """
+        Marks archive files (by file_uid) as read. Call inside the batch's transaction.
+        """
+        ArchiveFile.objects.bulk_create(
+            [ArchiveFile(checkpoint=self.checkpoint, uid=uid) for uid in uids], ignore_conflicts=True
+        )
+
+    def set_highest_modseq(self, highest_modseq: int):
+        if highest_modseq != self.checkpoint.highest_modseq:
+            self._save(highest_modseq=highest_modseq)
+
+class ImportSession:
+    """
+    Usage (DB writer thread only):
+        session = ImportSession()
+        folder = session.folder(account_email, provider, mailbox_name)
+        with transaction.atomic():
+            ...write the batch...
+            folder.advance(batch_max_uid)
+    """
+    def __init__(self):
+        self.accounts: Dict[str, Account] = {}
+        self.folders: Dict[Tuple[str, str], FolderSession] = {}
+
+    def account(self, account_email: str, provider: str = "") -> Account:
+        account = self.accounts.get(account_email)
+        if account is None:
+            account, _ = Account.objects.get_or_create(email=account_email, defaults={"provider": provider or ""})
+            self.accounts[account_email] = account
+        return account
+
+    def folder(self, account_email: str, provider: str, mailbox_name: str) -> FolderSession:
+        key = (account_email, mailbox_name)
+        folder = self.folders.get(key)
+        if folder is None:
+            account = self.account(account_email, provider)
+            mailbox, _ = Mailbox.objects.get_or_create(account=account, name=mailbox_name)
+            checkpoint, _ = ImportCheckpoint.objects.get_or_create(
+                account=account, mailbox_name=mailbox_name, defaults={"last_uid": 0}
+            )
+            folder = FolderSession(account, mailbox, checkpoint)
+            self.folders[key] = folder
+        return folder
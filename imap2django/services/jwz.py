@@ -0,0 +1,188 @@
+"""
+JWZ threading (https://www.jwz.org/doc/threading.html) over compact tuples.
+
+Messages are streamed in as (id, message_id, in_reply_to, references,
+subject_norm, thread_id) and linked through a Message-ID -> container index,
+so replies whose References chain is truncated still find their parent.
+Containers live in parallel arrays rather than one Python object each, and
+Message-IDs and subjects are kept as fixed-size hashes, which keeps a
+5M-message corpus within a few hundred MB.
+
+The thread key of a container is sha256("ref:<message-id>")[:40] of its root,
+the key thread_key_for() gives a message whose first reference is that root;
+imports also reuse the stored thread of a referenced message
+(thread_keys_bulk), so new replies join the threads a rebuild found.
+"""
+import hashlib
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+KEY_BYTES = 20  # 40 hex chars, Thread.thread_key
+
+def _key_digest(seed: str) -> bytes:
+    return hashlib.sha256(seed.encode("utf-8", errors="replace")).digest()[:KEY_BYTES]
+
+def _subject_hash(subject_norm: str) -> int:
+    if not subject_norm:
+        return 0
+    digest = hashlib.blake2b(subject_norm.encode("utf-8", errors="replace"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True) or 1
+
+def _clean_id(mid: Optional[str]) -> str:
+    return (mid or "").strip()
+
+class ContainerTable:
+    """
+    Array-backed JWZ containers. Container i is described by parent[i],
+    message[i] (message pk, 0 for a phantom only known from references),
+    subject[i], reply[i], current[i] (thread_id before the rebuild) and the
+    key digest at keys[i*20:(i+1)*20]. order lists message containers in the
+    order they were added (message id order when streamed ordered by id).
+    """
+    __slots__ = ("index", "keys", "parent", "message", "subject", "reply", "current", "order", "roots", "merged")
+
+    def __init__(self):
+        self.index: Dict[int, int] = {}
+        self.keys = bytearray()
+        self.parent = array("q")
+        self.message = array("q")
+        self.subject = array("q")
+        self.reply = bytearray()
+        self.current = array("q")
+        self.order = array("q")
+        self.roots: Optional[array] = None
+        self.merged: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _new(self, digest: bytes) -> int:
+        self.keys += digest
+        self.parent.append(-1)
+        self.message.append(0)
+        self.subject.append(0)
+        self.reply.append(0)
+        self.current.append(0)
+        return len(self.parent) - 1
+
+    def container_for(self, mid: str) -> int:
+        digest = _key_digest(f"ref:{mid}")
+        slot = int.from_bytes(digest[:8], "little", signed=True)
+        c = self.index.get(slot)
+        if c is None:
+            c = self._new(digest)
+            self.index[slot] = c
+        return c
+
+    def _reaches(self, start: int, target: int) -> bool:
+        # True if target is start or one of start's ancestors
+        c = start
+        while c >= 0:
+            if c == target:
+                return True
+            c = self.parent[c]
+        return False
+
+    def _link(self, parent: int, child: int, force: bool = False):
+        if parent == child or self._reaches(parent, child):
+            return  # would create a loop
+        if force or self.parent[child] < 0:
+            self.parent[child] = parent
+
+    def add(self, pk: int, message_id: str, in_reply_to: str, references, subject_norm: str, thread_id: Optional[int]):
+        mid = _clean_id(message_id)
+        c = self.container_for(mid) if mid else -1
+        if c < 0 or self.message[c]:
+            # no Message-ID, or a duplicate one: give the message a private container
+            c = self._new(_key_digest(f"msg:{pk}"))
+        self.message[c] = pk
+        self.order.append(c)
+        self.subject[c] = _subject_hash(subject_norm)
+        self.current[c] = thread_id or 0
+
+        refs = [_clean_id(r) for r in (references or []) if _clean_id(r)]
+        irt = _clean_id(in_reply_to)
+        if irt and irt not in refs:
+            refs.append(irt)
+        self.reply[c] = 1 if refs else 0
+
+        prev = -1
+        for ref in refs:
+            rc = self.container_for(ref)
+            if prev >= 0:
+                self._link(prev, rc)
+            prev = rc
+        if prev >= 0:
+            # the message's own References/In-Reply-To win over earlier guesses
+            self._link(prev, c, force=True)
+
+    def finish(self):
+        """
+        Computes roots and merges root sets that share a subject across broken chains.
+        """
+        n = len(self)
+        roots = array("q", [-1]) * n
+        for c in range(n):
+            if roots[c] >= 0:
+                continue
+            path = []
+            x = c
+            while x >= 0 and roots[x] < 0 and self.parent[x] >= 0:
+                path.append(x)
+                x = self.parent[x]
+            root = roots[x] if x >= 0 and roots[x] >= 0 else x
+            roots[x] = root
+            for p in path:
+                roots[p] = root
+        self.roots = roots
+
+        # subject of a root: its own message, or the first message below a phantom root
+        root_subject: Dict[int, int] = {}
+        for c in range(n):
+            if self.message[c] and self.subject[c]:
+                r = roots[c]
+                if r == c or r not in root_subject:
+                    root_subject[r] = self.subject[c]
+
+        # thread starters (real, non-reply roots) own their subject; phantom roots and
+        # replies whose parent is missing join them. Unrelated starters sharing a
+        # subject ("hello") stay separate.
+        starters: Dict[int, int] = {}
+        orphans: Dict[int, int] = {}
+        mergeable: List[Tuple[int, int]] = []
+        for r, subj in root_subject.items():
+            if self.message[r] and not self.reply[r]:
+                starters.setdefault(subj, r)
+            else:
+                mergeable.append((r, subj))
+        for r, subj in mergeable:
+            target = starters.get(subj)
+            if target is None:
+                target = orphans.setdefault(subj, r)
+            if target != r:
+                self.merged[r] = target
+
+    def thread_root(self, c: int) -> int:
+        r = self.roots[c]
+        return self.merged.get(r, r)
+
+    def thread_key(self, root: int) -> str:
+        return self.keys[root * KEY_BYTES:(root + 1) * KEY_BYTES].hex()
+
+    def assignments(self) -> Iterator[Tuple[int, int, int]]:
+        """
+        Yields (message pk, thread root container, current thread_id) for every
+        message, in the order the messages were added.
+        """
+        for c in self.order:
+            yield self.message[c], self.thread_root(c), self.current[c]
+
+def build_index(rows) -> ContainerTable:
+    """
+    rows: iterable of (id, message_id, in_reply_to, references_json, subject_norm, thread_id).
+    """
+    table = ContainerTable()
+    for pk, message_id, in_reply_to, references, subject_norm, thread_id in rows:
+        table.add(pk, message_id, in_reply_to, references, subject_norm, thread_id)
+    table.finish()
+    return table
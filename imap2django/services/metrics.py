@@ -0,0 +1,384 @@
+"""
+Measurement helpers for the import benchmark (testing/benchmark.py) and the
+import commands: wall time, SQL statements and resident memory, accumulated
+per named stage, plus a rolling progress/ETA tracker, a Prometheus textfile
+writer and a small all-threads sampling profiler.
+
+Queries are counted with a connection execute_wrapper, so DEBUG does not need
+to be on; like the connection itself, the count covers the current thread only.
+"""
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+from django.db import DEFAULT_DB_ALIAS, connections
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes. Without /proc (macOS) this
+    falls back to the peak RSS, which never goes down.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class RssSampler:
+    """
+    Polls current_rss() on a background thread; peak is the highest value
+    seen between __enter__ and __exit__ (short spikes can fall between samples).
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        self.peak = max(self.peak, current_rss())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+class QueryCounter:
+    """
+    Counts statements sent through this thread's connection while active
+    (an executemany counts once).
+    """
+    def __init__(self, using: str = DEFAULT_DB_ALIAS):
+        self.using = using
+        self.count = 0
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connections[self.using].execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._wrapper.__exit__(exc_type, exc, tb)
+
+@dataclass
+class StageStats:
+    name: str
+    seconds: float = 0.0
+    messages: int = 0
+    bytes: int = 0
+    queries: int = 0
+    calls: int = 0
+    peak_rss: int = 0  # bytes, whole process
+    rss_growth: int = 0  # largest peak - start of a single call
+
+    def as_dict(self) -> dict:
+        seconds = self.seconds or 1e-9
+        return {
+            "seconds": round(self.seconds, 4),
+            "calls": self.calls,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "msg_per_s": round(self.messages / seconds, 1),
+            "bytes_per_s": round(self.bytes / seconds, 1),
+            "queries": self.queries,
+            "queries_per_msg": round(self.queries / self.messages, 3) if self.messages else None,
+            # None for figures recorded elsewhere (parser workers)
+            "peak_rss_mb": round(self.peak_rss / 1024 ** 2, 1) if self.peak_rss else None,
+            "rss_growth_mb": round(self.rss_growth / 1024 ** 2, 1) if self.peak_rss else None,
+        }
+
+class Metrics:
+    """
+    Usage:
+        metrics = Metrics()
+        with metrics.measure("parse", messages=len(rows)) as stage:
+            ...
+            stage.bytes += n  # counts can also be added inside the block
+        metrics.as_dict()
+
+    Stages measured inside another one (on the same Metrics) are taken out of
+    the outer stage's time and queries, so every stage reports its own share.
+    One Metrics is used by one thread at a time.
+    """
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self._open: List[List[float]] = []  # [seconds, queries] of finished inner stages, per open stage
+
+    def stage(self, name: str) -> StageStats:
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+        return self.stages[name]
+
+    @contextmanager
+    def measure(self, name: str, messages: int = 0, nbytes: int = 0, sample_rss: bool = False) -> Iterator[StageStats]:
+        """
+        sample_rss=True tracks the peak with an RssSampler thread, otherwise
+        RSS is read once at the end (enough for short, repeated calls).
+        """
+        stats = self.stage(name)
+        stats.messages += messages
+        stats.bytes += nbytes
+        sampler = RssSampler() if sample_rss else None
+        queries = QueryCounter()
+        inner = [0.0, 0]
+        self._open.append(inner)
+        started = time.perf_counter()
+        try:
+            with queries, sampler or nullcontext():
+                yield stats
+        finally:
+            elapsed = time.perf_counter() - started
+            self._open.pop()
+            if self._open:
+                self._open[-1][0] += elapsed
+                self._open[-1][1] += queries.count
+            # a failed call is recorded too, its time was taken out of the outer stage
+            stats.seconds += elapsed - inner[0]
+            stats.calls += 1
+            stats.queries += queries.count - inner[1]
+            if sampler:
+                stats.peak_rss = max(stats.peak_rss, sampler.peak)
+                stats.rss_growth = max(stats.rss_growth, sampler.peak - sampler.start)
+            else:
+                stats.peak_rss = max(stats.peak_rss, current_rss())
+
+    def record(self, name: str, seconds: float, messages: int = 0, nbytes: int = 0, queries: int = 0):
+        """
+        Adds figures measured elsewhere, e.g. by parser worker processes.
+        """
+        stats = self.stage(name)
+        stats.seconds += seconds
+        stats.messages += messages
+        stats.bytes += nbytes
+        stats.queries += queries
+        stats.calls += 1
+
+    def merge(self, other: "Metrics"):
+        for name, o in other.stages.items():
+            stats = self.stage(name)
+            stats.seconds += o.seconds
+            stats.messages += o.messages
+            stats.bytes += o.bytes
+            stats.queries += o.queries
+            stats.calls += o.calls
+            stats.peak_rss = max(stats.peak_rss, o.peak_rss)
+            stats.rss_growth = max(stats.rss_growth, o.rss_growth)
+
+    def as_dict(self) -> dict:
+        return {name: stats.as_dict() for name, stats in self.stages.items()}
+
+    def totals(self) -> dict:
+        """
+        Compact per-stage figures, e.g. for one line per batch.
+        """
+        return {
+            name: {"seconds": round(s.seconds, 4), "messages": s.messages, "bytes": s.bytes, "queries": s.queries}
+            for name, s in self.stages.items()
+        }
+
+    def brief(self) -> str:
+        return ", ".join(f"{name} {s.seconds:.2f}s" + (f"/{s.queries}q" if s.queries else "") for name, s in self.stages.items())
+
+def measure_stage(metrics: Optional[Metrics], name: str, **kwargs):
+    """
+    metrics.measure(name, ...), or a no-op when metrics is None.
+    """
+    return metrics.measure(name, **kwargs) if metrics else nullcontext()
+
+class ImportProgress:
+    """
+    Rolling throughput and ETA of an import. Producers report each folder
+    plan (thread-safe); the writer reports every committed batch. The ETA
+    only covers folders planned so far.
+    """
+    def __init__(self, window: float = 60.0, interval: float = 10.0):
+        self.window = window
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.plans: Dict[tuple, List[int]] = {}
+        self.done_uid: Dict[tuple, int] = {}
+        self.messages = 0
+        self.bytes = 0
+        self.recent: deque = deque()  # (monotonic time, messages, bytes)
+        self.started = time.monotonic()
+        self.last_line = self.started
+
+    def plan(self, key: tuple, last_uid: int, uids: List[int]):
+        with self.lock:
+            self.plans[key] = sorted(uids)
+            self.done_uid[key] = last_uid
+
+    def advance(self, key: tuple, last_uid: int, messages: int, nbytes: int):
+        now = time.monotonic()
+        with self.lock:
+            self.done_uid[key] = max(self.done_uid.get(key, 0), last_uid)
+            self.messages += messages
+            self.bytes += nbytes
+            self.recent.append((now, messages, nbytes))
+            while now - self.recent[0][0] > self.window:
+                self.recent.popleft()
+
+    def remaining(self) -> int:
+        with self.lock:
+            return sum(len(uids) - bisect.bisect_right(uids, self.done_uid.get(key, 0)) for key, uids in self.plans.items())
+
+    def rate(self) -> Tuple[float, float]:
+        """
+        (messages/s, bytes/s) over the last `window` seconds.
+        """
+        now = time.monotonic()
+        with self.lock:
+            recent = [r for r in self.recent if now - r[0] <= self.window]
+        span = max(min(now - self.started, self.window), 1e-3)
+        return sum(r[1] for r in recent) / span, sum(r[2] for r in recent) / span
+
+    def due(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_line < self.interval:
+            return False
+        self.last_line = now
+        return True
+
+    def line(self) -> str:
+        rate, byte_rate = self.rate()
+        remaining = self.remaining()
+        eta = _format_seconds(remaining / rate) if rate and remaining else "-"
+        return (
+            f"Progress: {self.messages} done, {remaining} to go, "
+            f"{rate:.1f} msg/s {byte_rate / 1e6:.2f} MB/s (last {int(self.window)}s), ETA {eta}"
+        )
+
+def _format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def write_textfile(path: str, metrics: Metrics, progress: Optional[ImportProgress] = None, counters: Optional[Dict[str, float]] = None):
+    """
+    Writes the counters in the Prometheus text format, atomically, for the
+    node_exporter textfile collector (or anything else that scrapes files).
+    """
+    lines = [
+        "# TYPE imap2django_import_stage_seconds_total counter",
+        *(f'imap2django_import_stage_seconds_total{{stage="{n}"}} {s.seconds:.6f}' for n, s in metrics.stages.items()),
+        "# TYPE imap2django_import_stage_queries_total counter",
+        *(f'imap2django_import_stage_queries_total{{stage="{n}"}} {s.queries}' for n, s in metrics.stages.items()),
+        "# TYPE imap2django_import_stage_bytes_total counter",
+        *(f'imap2django_import_stage_bytes_total{{stage="{n}"}} {s.bytes}' for n, s in metrics.stages.items()),
+    ]
+    if progress:
+        lines += [
+            "# TYPE imap2django_import_messages_total counter",
+            f"imap2django_import_messages_total {progress.messages}",
+            "# TYPE imap2django_import_bytes_total counter",
+            f"imap2django_import_bytes_total {progress.bytes}",
+            "# TYPE imap2django_import_remaining_messages gauge",
+            f"imap2django_import_remaining_messages {progress.remaining()}",
+        ]
+    for name, value in (counters or {}).items():
+        lines += [f"# TYPE imap2django_import_{name} gauge", f"imap2django_import_{name} {value}"]
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+class MetricsLog:
+    """
+    Appends one JSON object per line: a record per batch, then a summary.
+    """
+    def __init__(self, path: str):
+        self.fp = open(path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, record: dict):
+        record = {"time": round(time.time(), 3), **record}
+        self.fp.write(json.dumps(record, sort_keys=False) + "\n")
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+class StackSampler:
+    """
+    Sampling profiler over all threads of the process: every interval it
+    records each thread's Python stack (sys._current_frames), so IMAP waits,
+    parsing and DB writes all show up. Time blocked on queues is sampled too,
+    which is what a wall-clock profile should show. Parser worker processes
+    are not covered. write() saves the collapsed-stack format
+    ("thread;outer;...;inner count") read by flamegraph.pl and speedscope.
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.ticks = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        me = threading.get_ident()
+        names: Dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if any(ident not in names for ident in frames):
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.ticks += 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
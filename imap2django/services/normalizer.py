@@ -1,6 +1,8 @@
+import time
 from dataclasses import dataclass
-from typing import List, Tuple
-from ..utils import norm_email, norm_subject, sha256_bytes
+from typing import Dict, List, Optional, Tuple
+from ..utils import norm_email, norm_subject, sha256_bytes, sha256_file
+from .parser import ParseOptions, parse_headers, parse_rfc822, parse_rfc822_file, parse_date_to_dt
 
 @dataclass
 class NormalizedEmail:
@@ -21,6 +23,41 @@ class NormalizedEmail:
     body_html: str
     attachments: list
     size: int
+    has_body: bool = True
+
+@dataclass
+class SpooledRaw:
+    """
+    A raw message too large to keep in memory, spooled to a temp file by the fetcher.
+    """
+    path: str
+    size: int
+
+@dataclass
+class HeaderOnly:
+    """
+    What a header-only fetch returns in place of the raw message: the header
+    block and the BODYSTRUCTURE (as imapclient parses it).
+    """
+    header: bytes
+    structure: object = None
+
+def header_only_sha256(header: bytes) -> str:
+    """
+    Stand-in raw_sha256 of a header-only message until its body is backfilled
+    (prefixed so it can't collide with the hash of a real raw message).
+    """
+    return sha256_bytes(b"header-only\n" + header)
+
+@dataclass
+class ImportItem:
+    """
+    One fetched UID of a batch, ready to be handed to a loader.
+    """
+    uid: int
+    flags: List[str]
+    internal_date: object
+    normalized: NormalizedEmail
 
 def compute_content_fingerprint(subject_norm: str, from_email: str, body_text: str) -> str:
     # Small stable “semantic-ish” hash (not perfect, but useful fallback).
@@ -28,7 +65,7 @@ def compute_content_fingerprint(subject_norm: str, from_email: str, body_text: s
     payload = f"{subject_norm}|{from_email}|{snippet}".encode("utf-8", errors="replace")
     return sha256_bytes(payload)
 
-def normalize(parsed, raw_bytes: bytes, size: int, date_dt):
+def normalize(parsed, raw_bytes: bytes, size: int, date_dt, raw_sha256: str = ""):
     from_email_norm = norm_email(parsed.from_email)
     subject_norm = norm_subject(parsed.subject)
 
@@ -36,7 +73,7 @@ def normalize(parsed, raw_bytes: bytes, size: int, date_dt):
     cc_norm = [(n, norm_email(e)) for n, e in parsed.cc if e]
     bcc_norm = [(n, norm_email(e)) for n, e in parsed.bcc if e]
 
-    raw_sha = sha256_bytes(raw_bytes)
+    raw_sha = raw_sha256 or sha256_bytes(raw_bytes)
     content_fp = compute_content_fingerprint(subject_norm, from_email_norm, parsed.body_text)
 
     return NormalizedEmail(
@@ -58,3 +95,34 @@ def normalize(parsed, raw_bytes: bytes, size: int, date_dt):
         attachments=parsed.attachments or [],
         size=size,
     )
+
+def parse_and_normalize(
+    raw_bytes, size: int, options: Optional[ParseOptions] = None, timings: Optional[Dict[str, float]] = None
+) -> NormalizedEmail:
+    """
+    Full CPU-bound step for one raw message (bytes, SpooledRaw or HeaderOnly).
+    Top-level so it can run in a worker process. Seconds spent in each half are
+    added to timings["parse"] and timings["normalize"] when given.
+    """
+    started = time.perf_counter()
+    if isinstance(raw_bytes, HeaderOnly):
+        parsed = parse_headers(raw_bytes.header, raw_bytes.structure)
+    elif isinstance(raw_bytes, SpooledRaw):
+        with open(raw_bytes.path, "rb") as f:
+            parsed = parse_rfc822_file(f, options)
+    else:
+        parsed = parse_rfc822(raw_bytes, options)
+    date_dt = parse_date_to_dt(parsed.date or "")
+    parsed_at = time.perf_counter()
+
+    if isinstance(raw_bytes, HeaderOnly):
+        norm = normalize(parsed, b"", size=size, date_dt=date_dt, raw_sha256=header_only_sha256(raw_bytes.header))
+        norm.has_body = False
+    elif isinstance(raw_bytes, SpooledRaw):
+        norm = normalize(parsed, b"", size=size, date_dt=date_dt, raw_sha256=sha256_file(raw_bytes.path))
+    else:
+        norm = normalize(parsed, raw_bytes, size=size, date_dt=date_dt)
+    if timings is not None:
+        timings["parse"] = timings.get("parse", 0.0) + parsed_at - started
+        timings["normalize"] = timings.get("normalize", 0.0) + time.perf_counter() - parsed_at
+    return norm
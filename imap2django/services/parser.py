@@ -1,9 +1,15 @@
+import binascii
+import hashlib
+import re
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, BinaryIO, Iterator
 from email.parser import BytesParser
 from email import policy
 from email.message import Message as EmailMessage
-from bs4 import BeautifulSoup
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from urllib.parse import unquote
+from .attachment_store import AttachmentStore
+from .html_text import html_to_text
 from dateutil import parser as dateparser
 
 @dataclass
@@ -12,6 +18,17 @@ class ParsedAttachment:
     content_type: str
     size: int
     part_id: str
+    sha256: str = ""
+    storage_url: str = ""
+
+@dataclass
+class ParseOptions:
+    # stream-decode attachment payloads to fill ParsedAttachment.sha256
+    hash_attachments: bool = False
+    # root of a content-addressed AttachmentStore; payloads are written there when set
+    attachment_store: str = ""
+    # max characters of body_text derived from an HTML-only body (0 = no limit)
+    html_text_limit: int = 1_000_000
 
 @dataclass
 class ParsedEmail:
@@ -43,7 +60,98 @@ def _get_from(msg: EmailMessage) -> Tuple[str, str]:
     name, email = parseaddr(msg.get("From", "") or "")
     return (name or "", email or "")
 
-def _extract_bodies(msg: EmailMessage) -> Tuple[str, str, List[ParsedAttachment]]:
+_DECODE_CHUNK = 1024 * 1024
+
+def estimate_decoded_size(part: EmailMessage) -> int:
+    """
+    Decoded size of a leaf part computed from its encoded payload and
+    Content-Transfer-Encoding, without decoding (or copying) the payload.
+    """
+    payload = part.get_payload(decode=False)
+    if not isinstance(payload, str):
+        return 0
+    cte = (part.get("Content-Transfer-Encoding") or "").strip().lower()
+    if cte == "base64":
+        whitespace = payload.count("\n") + payload.count("\r") + payload.count(" ") + payload.count("\t")
+        chars = len(payload) - whitespace
+        padding = payload.rstrip()[-2:].count("=")
+        return max(0, chars * 3 // 4 - padding)
+    if cte == "quoted-printable":
+        # soft line breaks vanish: "=\n" (2 chars) or "=\r\n" (3 chars); "=XX" escapes become 1 byte
+        soft_lf = payload.count("=\n")
+        soft_crlf = payload.count("=\r\n")
+        escapes = payload.count("=") - soft_lf - soft_crlf
+        return max(0, len(payload) - 2 * escapes - 2 * soft_lf - 3 * soft_crlf)
+    # 7bit/8bit/binary: one char per byte (8bit data is kept as surrogate escapes)
+    return len(payload)
+
+def _to_bytes(text: str) -> bytes:
+    # same fallback as email.message.Message.get_payload(decode=True)
+    try:
+        return text.encode("ascii", errors="surrogateescape")
+    except UnicodeEncodeError:
+        return text.encode("raw-unicode-escape")
+
+def iter_decoded_chunks(part: EmailMessage, chunk_chars: int = _DECODE_CHUNK) -> Iterator[bytes]:
+    """
+    Yields the decoded payload of a leaf part in bounded chunks, so it is
+    never materialized as one bytes object.
+    """
+    payload = part.get_payload(decode=False)
+    if not isinstance(payload, str):
+        return
+    cte = (part.get("Content-Transfer-Encoding") or "").strip().lower()
+
+    if cte == "base64":
+        carry = ""
+        for start in range(0, len(payload), chunk_chars):
+            chars = carry + "".join(payload[start:start + chunk_chars].split())
+            usable = len(chars) - len(chars) % 4
+            carry = chars[usable:]
+            if usable:
+                try:
+                    yield binascii.a2b_base64(chars[:usable])
+                except binascii.Error:
+                    return
+        if carry:
+            # tolerate missing padding like email's own decoder does
+            try:
+                yield binascii.a2b_base64(carry + "=" * (-len(carry) % 4))
+            except binascii.Error:
+                pass
+        return
+
+    if cte == "quoted-printable":
+        start = 0
+        while start < len(payload):
+            end = min(len(payload), start + chunk_chars)
+            if end < len(payload):
+                # cut on a line boundary so no =XX escape is split
+                newline = payload.rfind("\n", start, end)
+                if newline < start:
+                    newline = payload.find("\n", end)
+                end = newline + 1 if newline >= 0 else len(payload)
+            yield binascii.a2b_qp(_to_bytes(payload[start:end]))
+            start = end
+        return
+
+    for start in range(0, len(payload), chunk_chars):
+        yield _to_bytes(payload[start:start + chunk_chars])
+
+def hash_part(part: EmailMessage) -> Tuple[str, int]:
+    """
+    Streamed (sha256 hex, decoded size) of a leaf part.
+    """
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter_decoded_chunks(part):
+        h.update(chunk)
+        size += len(chunk)
+    return h.hexdigest(), size
+
+def _extract_bodies(msg: EmailMessage, options: Optional[ParseOptions] = None) -> Tuple[str, str, List[ParsedAttachment]]:
+    options = options or ParseOptions()
+    store = AttachmentStore(options.attachment_store) if options.attachment_store else None
     body_text = ""
     body_html = ""
     attachments: List[ParsedAttachment] = []
@@ -56,12 +164,22 @@ def _extract_bodies(msg: EmailMessage) -> Tuple[str, str, List[ParsedAttachment]
             is_attachment = "attachment" in disp or (filename != "")
 
             if is_attachment:
-                payload = part.get_payload(decode=True) or b""
+                # metadata only: never decode the whole payload just to measure it
+                sha256 = ""
+                storage_url = ""
+                if store and not part.is_multipart():
+                    sha256, size, storage_url = store.put(lambda: iter_decoded_chunks(part))
+                elif options.hash_attachments and not part.is_multipart():
+                    sha256, size = hash_part(part)
+                else:
+                    size = estimate_decoded_size(part)
                 attachments.append(ParsedAttachment(
                     filename=filename,
                     content_type=ctype,
-                    size=len(payload),
+                    size=size,
                     part_id=str(i),
+                    sha256=sha256,
+                    storage_url=storage_url,
                 ))
                 continue
 
@@ -90,16 +208,32 @@ def _extract_bodies(msg: EmailMessage) -> Tuple[str, str, List[ParsedAttachment]
         else:
             body_text = text
 
-    # If no plain text but have html, derive text
+    # If no plain text but have html, derive text (streaming, see html_text)
     if not body_text and body_html:
-        soup = BeautifulSoup(body_html, "lxml")
-        body_text = soup.get_text("\n")
+        body_text = html_to_text(body_html, options.html_text_limit)
 
     return body_text, body_html, attachments
 
-def parse_rfc822(raw_bytes: bytes) -> ParsedEmail:
+def parse_rfc822(raw_bytes: bytes, options: Optional[ParseOptions] = None) -> ParsedEmail:
     msg = BytesParser(policy=policy.default).parsebytes(raw_bytes)
+    return _parsed_from_message(msg, options)
 
+def parse_rfc822_file(fp: BinaryIO, options: Optional[ParseOptions] = None) -> ParsedEmail:
+    """
+    Same as parse_rfc822 but feeds the parser from a binary file, so large
+    spooled messages are never materialized as one bytes object. The parsed
+    message tree still holds every part's encoded payload as a string, so
+    parse memory remains O(message size); only the download is bounded.
+    """
+    msg = BytesParser(policy=policy.default).parse(fp)
+    return _parsed_from_message(msg, options)
+
+def _parsed_from_message(msg: EmailMessage, options: Optional[ParseOptions] = None) -> ParsedEmail:
+    body_text, body_html, attachments = _extract_bodies(msg, options)
+    return _parsed_from_headers(msg, body_text, body_html, attachments)
+
+def _parsed_from_headers(msg, body_text: str = "", body_html: str = "", attachments=None) -> ParsedEmail:
+    # msg: an email Message or a HeaderBlock
     message_id = (msg.get("Message-ID", "") or "").strip()
     subject = (msg.get("Subject", "") or "").strip()
     date_raw = (msg.get("Date", "") or "").strip()
@@ -115,8 +249,6 @@ def parse_rfc822(raw_bytes: bytes) -> ParsedEmail:
     if refs:
         references = [r.strip() for r in refs.split() if r.strip()]
 
-    body_text, body_html, attachments = _extract_bodies(msg)
-
     return ParsedEmail(
         message_id=message_id,
         subject=subject,
@@ -130,9 +262,193 @@ def parse_rfc822(raw_bytes: bytes) -> ParsedEmail:
         references=references,
         body_text=body_text,
         body_html=body_html,
-        attachments=attachments,
+        attachments=attachments or [],
     )
 
+# the headers ParsedEmail is built from
+HEADER_ONLY_FIELDS = frozenset({"message-id", "subject", "date", "from", "to", "cc", "bcc", "in-reply-to", "references"})
+_HEADER_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+$")
+_HEADER_NAME_RE = re.compile(r"([\041-\071\073-\176]*):")
+# Values policy.default gives back unchanged (just unfolded), so its header
+# classes can be skipped: printable ASCII without encoded words, quotes,
+# comments or escapes, and for structured fields only their plain forms.
+_PLAIN_VALUE_RE = re.compile(r"[ \t\r\n!#-'*-\[\]-~]*")
+_ATOM = r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+"
+_ADDR_SPEC = rf"{_ATOM}(?:\.{_ATOM})*@{_ATOM}(?:\.{_ATOM})*"
+_MAILBOX = rf"(?:{_ATOM}(?:[ \t.]+{_ATOM})*\s*<{_ADDR_SPEC}>|{_ADDR_SPEC})"
+_PLAIN_STRUCTURED = {
+    "from": re.compile(rf"\s*{_MAILBOX}\s*"),
+    "message-id": re.compile(rf"\s*<{_ADDR_SPEC}>\s*"),
+    **{name: re.compile(rf"\s*{_MAILBOX}(?:\s*,\s*{_MAILBOX})*\s*") for name in ("to", "cc", "bcc")},
+}
+_LINESEP_RE = re.compile(r"\r\n|\r|\n")
+
+def _is_plain(name: str, value: str) -> bool:
+    if name == "date" or "=?" in value or not _PLAIN_VALUE_RE.fullmatch(value):
+        return False
+    structured = _PLAIN_STRUCTURED.get(name)
+    return structured is None or bool(structured.fullmatch(value))
+
+class HeaderBlock:
+    """
+    Selected fields of a raw header block, split and unfolded without running
+    the email package's feed parser over every header. Values are what the
+    policy.default header classes of an email Message return (plain values
+    bypass them), and get()/get_all() behave like the Message methods, so
+    _parsed_from_headers gives what parse_rfc822 would for the same header.
+    """
+    def __init__(self, header: bytes, names=HEADER_ONLY_FIELDS):
+        self.fields: Dict[str, List[List[str]]] = {}
+        current: Optional[List[str]] = None
+        text = header.decode("ascii", errors="surrogateescape")
+        for line in _HEADER_LINE_RE.findall(text):
+            if line[0] in " \t":
+                if current is not None:
+                    current.append(line)
+                continue
+            if not line.strip("\r\n"):
+                break  # end of the header block
+            if line.startswith("From "):
+                current = None  # mbox envelope line
+                continue
+            m = _HEADER_NAME_RE.match(line)
+            if not m:
+                break  # the feed parser starts the body here too
+            name = m.group(1).lower()
+            current = [line] if name in names else None
+            if current is not None:
+                self.fields.setdefault(name, []).append(current)
+
+    def get_all(self, name: str, failobj=None):
+        sources = self.fields.get(name.lower())
+        if not sources:
+            return failobj
+        values = []
+        for lines in sources:
+            hname, value = policy.default.header_source_parse(lines)
+            if _is_plain(hname.lower(), value):
+                values.append(_LINESEP_RE.sub("", value))
+            else:
+                values.append(policy.default.header_fetch_parse(hname, value))
+        return values
+
+    def get(self, name: str, failobj=None):
+        values = self.get_all(name)
+        return values[0] if values else failobj
+
+def _structure_text(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value if isinstance(value, str) else ""
+
+def _structure_params(value) -> Dict[str, str]:
+    # body-fld-param: ("name" "value" ...) or NIL
+    if not isinstance(value, (tuple, list)):
+        return {}
+    return {_structure_text(k).lower(): _structure_text(v) for k, v in zip(value[0::2], value[1::2])}
+
+def _structure_param(params: Dict[str, str], name: str) -> str:
+    """
+    A MIME parameter with RFC 2231 extended (name*) and continued (name*0, name*1*, ...) values decoded.
+    """
+    if name in params:
+        return params[name]
+    sections = []
+    for key, value in params.items():
+        m = re.fullmatch(re.escape(name) + r"(?:\*(\d+))?(\*?)", key)
+        if m:
+            sections.append((int(m.group(1) or 0), value, bool(m.group(2))))
+    if not sections:
+        return ""
+    sections.sort()
+    charset, lang = None, None
+    if sections[0][2]:
+        first = decode_rfc2231(sections[0][1])
+        if len(first) == 3:
+            charset, lang = first[0], first[1]
+        sections[0] = (0, first[-1], True)
+    # like email's decode_params: %XX escapes of extended sections are bytes in the declared charset
+    value = "".join(unquote(v, encoding="latin-1") if extended else v for _i, v, extended in sections)
+    return collapse_rfc2231_value((charset or "us-ascii", lang, value)) if charset else value
+
+def _structure_node(node) -> Tuple[list, list]:
+    """
+    (child parts, fields) of a BODYSTRUCTURE node. imapclient's BodyData keeps
+    multipart children in a list at [0]; nested message/rfc822 bodies come as
+    plain tuples that start with the children instead. Leaf parts have no children.
+    """
+    if node and isinstance(node[0], list):
+        return node[0], list(node[1:])
+    children = []
+    for i, value in enumerate(node):
+        if not isinstance(value, (tuple, list)):
+            return children, list(node[i:])
+        children.append(value)
+    return children, []
+
+def _walk_structure(node) -> Iterator[Tuple[bool, str, list]]:
+    """
+    (is_multipart, content type, fields) of every part, in the order msg.walk()
+    visits them, so indexes line up with the part_id of _extract_bodies.
+    """
+    children, fields = _structure_node(node)
+    if children:
+        yield True, "multipart/" + _structure_text(fields[0] if fields else "").lower(), fields
+        for child in children:
+            yield from _walk_structure(child)
+        return
+    ctype = f"{_structure_text(fields[0])}/{_structure_text(fields[1])}".lower() if len(fields) > 1 else "text/plain"
+    yield False, ctype, fields
+    if ctype == "message/rfc822" and len(fields) > 8 and isinstance(fields[8], (tuple, list)):
+        yield from _walk_structure(fields[8])
+
+def _estimate_encoded_size(encoding: str, size: int) -> int:
+    # BODYSTRUCTURE sizes are of the encoded body; base64 lines are 76 chars + CRLF
+    if encoding == "base64":
+        return max(0, (size - 2 * (size // 78)) * 3 // 4)
+    return size
+
+def attachments_from_bodystructure(structure) -> List[ParsedAttachment]:
+    """
+    Attachment metadata from an IMAP BODYSTRUCTURE, by the rules _extract_bodies
+    applies to a parsed message: same part_id numbering, sizes estimated from
+    the encoded size instead of the payload.
+    """
+    if not structure or not _structure_node(structure)[0]:
+        return []  # single-part messages have no attachments
+    attachments: List[ParsedAttachment] = []
+    for i, (multipart, ctype, fields) in enumerate(_walk_structure(structure)):
+        if multipart:
+            # subtype, params, disposition, ...
+            params_at, disposition_at = 1, 2
+        else:
+            # type, subtype, params, id, description, encoding, size, [text: lines |
+            # message/rfc822: envelope, body, lines], md5, disposition, ...
+            params_at = 2
+            disposition_at = 11 if ctype == "message/rfc822" else 9 if ctype.startswith("text/") else 8
+        params = _structure_params(fields[params_at] if len(fields) > params_at else None)
+        disposition = fields[disposition_at] if len(fields) > disposition_at else None
+        disp_type, disp_params = "", {}
+        if isinstance(disposition, (tuple, list)) and disposition:
+            disp_type = _structure_text(disposition[0]).lower()
+            disp_params = _structure_params(disposition[1] if len(disposition) > 1 else None)
+        filename = _structure_param(disp_params, "filename") or _structure_param(params, "name")
+        if "attachment" not in disp_type and not filename:
+            continue
+        size = 0
+        if not multipart and ctype != "message/rfc822" and len(fields) > 6:
+            size = _estimate_encoded_size(_structure_text(fields[5]).lower(), int(fields[6] or 0))
+        attachments.append(ParsedAttachment(filename=filename, content_type=ctype, size=size, part_id=str(i)))
+    return attachments
+
+def parse_headers(header: bytes, structure=None) -> ParsedEmail:
+    """
+    Metadata-only parse for header-only imports: the envelope fields from a raw
+    header block (BODY[HEADER]) and, given the message's BODYSTRUCTURE,
+    attachment metadata. Bodies stay empty.
+    """
+    return _parsed_from_headers(HeaderBlock(header), attachments=attachments_from_bodystructure(structure))
+
 def parse_date_to_dt(date_str: str):
     if not date_str:
         return None
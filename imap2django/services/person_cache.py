@@ -0,0 +1,102 @@
+"""
+In-process LRU cache of Person rows for the address upsert path.
+
+Known people resolve to their pk with zero queries; unknown ones are created
+in one bulk insert per batch. Inserts ignore conflicts and are re-read, so
+several importer processes can create the same person concurrently. Entries
+only enter the cache once the surrounding transaction commits, so a rolled
+back batch never leaves dangling pks behind.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from django.db import transaction
+from django.db.models import Case, Value, When
+from ..models import Person
+
+class PersonCache:
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()  # person_hash -> (pk, display_name)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remember(self, rows: Dict[str, Tuple[int, str]]):
+        with self.lock:
+            for key, value in rows.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def warm(self, limit: Optional[int] = None) -> int:
+        """
+        Pre-loads up to limit (default: max_size) people from the DB. Returns the count loaded.
+        """
+        limit = min(limit or self.max_size, self.max_size)
+        rows = Person.objects.order_by("-id").values_list("person_hash", "id", "display_name")[:limit]
+        loaded = {key: (pk, name) for key, pk, name in rows.iterator(chunk_size=5000)}
+        self._remember(loaded)
+        return len(loaded)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def resolve(self, people: Iterable[Tuple[str, str]]) -> Dict[str, int]:
+        """
+        people: (email_norm, display_name) pairs. Returns {email_norm: person pk},
+        creating missing Person rows and filling empty display names.
+        """
+        names: Dict[str, str] = {}
+        for email, name in people:
+            if email and not names.get(email):
+                names[email] = name or ""
+        if not names:
+            return {}
+
+        resolved: Dict[str, Tuple[int, str]] = {}
+        with self.lock:
+            for key in names:
+                hit = self.entries.get(key)
+                if hit:
+                    self.entries.move_to_end(key)
+                    resolved[key] = hit
+        self.hits += len(resolved)
+        missing = [key for key in names if key not in resolved]
+        self.misses += len(missing)
+
+        if missing:
+            fetched = self._fetch(missing)
+            new = [
+                Person(person_hash=key, primary_email=key, display_name=names[key])
+                for key in missing if key not in fetched
+            ]
+            if new:
+                # ignore_conflicts: another importer may insert the same person concurrently
+                Person.objects.bulk_create(new, ignore_conflicts=True)
+                fetched.update(self._fetch([p.person_hash for p in new]))
+            resolved.update(fetched)
+
+        # Keep best display name if we get a better one later
+        better = {key: names[key] for key, (_pk, name) in resolved.items() if names[key] and not name}
+        if better:
+            # the cached name can be stale: only fill names still empty in the DB (another
+            # importer may have set one meanwhile), then re-read what is stored
+            Person.objects.filter(pk__in=[resolved[key][0] for key in better], display_name="").update(
+                display_name=Case(*[When(pk=resolved[key][0], then=Value(name)) for key, name in better.items()])
+            )
+            resolved.update(self._fetch(list(better)))
+
+        transaction.on_commit(lambda: self._remember(resolved))
+        return {key: pk for key, (pk, _name) in resolved.items()}
+
+    def _fetch(self, keys) -> Dict[str, Tuple[int, str]]:
+        rows = Person.objects.filter(person_hash__in=keys).values_list("person_hash", "id", "display_name")
+        return {key: (pk, name) for key, pk, name in rows}
+
+default_person_cache = PersonCache()
@@ -0,0 +1,399 @@
+"""
+Three-stage import pipeline: IMAP fetcher thread(s) -> parser thread (backed
+by ParsePool) -> caller (DB writer), connected by bounded queues.
+
+The next IMAP batch is downloaded while the current one is parsed and the
+previous one is committed. Each folder is fetched by exactly one producer and
+the queues are FIFO, so a folder's batches reach the writer in UID order and
+the writer can advance that folder's checkpoint right after committing a
+batch: everything below it has already been written.
+
+FetchOptions.mode "headers" fetches only header blocks and BODYSTRUCTUREs
+(parsed into metadata-only messages); "bodies" fetches the full messages of
+those header-only ones to fill them in.
+"""
+import imaplib
+import os
+import queue
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional
+from .dedup import find_known_messages
+from .flag_sync import FlagChanges
+from .imap_client import HEADER_ONLY_FIELDS, FolderState, decode_fetch_item, decode_header_item, decode_header_only_item
+from .metrics import Metrics, measure_stage
+from .normalizer import HeaderOnly, ImportItem, SpooledRaw
+from .parse_pool import ParsePool
+from .parser import HeaderBlock
+from .raw_spool import RawSpool
+
+@dataclass
+class FetchOptions:
+    batch_size: int = 200
+    prefetch: bool = False  # header pass, skip bodies of already-stored messages
+    batch_bytes: int = 0  # byte budget per batch (0 = count only)
+    large_bytes: int = 0  # messages above this are streamed to a temp file (0 = never)
+    chunk_bytes: int = 4 * 1024 * 1024  # partial fetch size for large messages
+    pipeline: int = 4  # UID FETCH commands kept in flight per connection (async io only)
+    mode: str = "full"  # "full", "headers" (metadata only) or "bodies" (backfill header-only messages)
+
+@dataclass
+class FolderPlan:
+    account_email: str
+    provider: str
+    folder: str
+    last_uid: int
+    uids: List[int]
+
+@dataclass
+class RawBatch:
+    account_email: str
+    provider: str
+    folder: str
+    uids: List[int]
+    rows: list  # (uid, raw, flags, internal_date, size); raw is bytes, SpooledRaw or HeaderOnly
+    links: list = field(default_factory=list)  # (uid, message_pk, flags) of already-stored messages
+    flag_changes: Optional[FlagChanges] = None  # flag/expunge sync of already-imported uids
+    folder_state: Optional[FolderState] = None  # UIDVALIDITY to record before the folder's batches
+    reset: bool = False  # UIDVALIDITY changed: drop the folder's uids and restart its checkpoint
+    metrics: Optional[Metrics] = None  # per-stage figures of this batch, extended by every stage
+    backfill: bool = False  # bodies of header-only messages already linked to these uids
+    relinked: bool = False  # the folder's re-link pass after a UIDVALIDITY reset is complete
+
+@dataclass
+class ParsedBatch:
+    account_email: str
+    provider: str
+    folder: str
+    uids: List[int]
+    items: List[ImportItem] = field(default_factory=list)
+    links: list = field(default_factory=list)
+    bytes: int = 0
+    flag_changes: Optional[FlagChanges] = None
+    folder_state: Optional[FolderState] = None
+    reset: bool = False
+    metrics: Optional[Metrics] = None
+    backfill: bool = False
+    relinked: bool = False
+
+    @property
+    def max_uid(self) -> int:
+        return max([it.uid for it in self.items] + [uid for uid, _pk, _flags in self.links], default=0)
+
+class _Done:
+    pass
+
+@dataclass
+class _Failed:
+    exc: BaseException
+
+# A producer is called on its own thread as producer(emit, stop). It pushes
+# RawBatch objects through emit(), which returns False once the pipeline is
+# shutting down, and should also return early when stop is set.
+Producer = Callable[[Callable[[RawBatch], bool], threading.Event], None]
+
+def _prefetch_known(imap, uids: List[int], metrics: Optional[Metrics] = None):
+    """
+    Header-only pass: returns (links for already-stored messages, uids whose body is still needed).
+    """
+    meta = {}
+    for uid, item in imap.fetch_headers(uids).items():
+        meta[uid] = decode_header_item(item)
+    with measure_stage(metrics, "dedup"):
+        known = find_known_messages((mid, size) for mid, _flags, _idate, size in meta.values())
+
+    links = []
+    unknown = []
+    for uid in uids:
+        if uid not in meta:
+            unknown.append(uid)
+            continue
+        mid, flags, _idate, size = meta[uid]
+        pk = known.get((mid, size))
+        if pk:
+            links.append((uid, pk, flags))
+        else:
+            unknown.append(uid)
+    return links, unknown
+
+def _header_only_rows(uids: List[int], fetched: Dict[int, dict], metrics: Optional[Metrics] = None):
+    """
+    Splits a HEADER_ONLY_FIELDS fetch into (links for already-stored messages,
+    rows of HeaderOnly for the rest), matching by Message-ID and size like the prefetch pass.
+    """
+    meta = {}
+    message_ids = {}
+    for uid in uids:
+        if uid in fetched:
+            meta[uid] = decode_header_only_item(fetched[uid])
+            message_ids[uid] = (HeaderBlock(meta[uid][0]).get("Message-ID", "") or "").strip()
+    with measure_stage(metrics, "dedup"):
+        known = find_known_messages((message_ids[uid], m[4]) for uid, m in meta.items())
+
+    links = []
+    rows = []
+    for uid, (header, structure, flags, internal_date, size) in meta.items():
+        pk = known.get((message_ids[uid], size))
+        if pk:
+            links.append((uid, pk, flags))
+        elif header:
+            rows.append((uid, HeaderOnly(header, structure), flags, internal_date, size))
+    return links, rows
+
+def _row_bytes(raw, size: int) -> int:
+    # what was downloaded for a row
+    if isinstance(raw, SpooledRaw):
+        return size
+    if isinstance(raw, HeaderOnly):
+        return len(raw.header)
+    return len(raw)
+
+def plan_batches(uids: List[int], sizes: Dict[int, int], opts: FetchOptions) -> List[List[int]]:
+    """
+    Splits uids (kept in order) into batches bounded by count and, if set, by bytes.
+    Messages above opts.large_bytes always get a batch of their own.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_bytes = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if opts.large_bytes and size > opts.large_bytes:
+            if current:
+                batches.append(current)
+                current, current_bytes = [], 0
+            batches.append([uid])
+            continue
+        if current and (
+            len(current) >= opts.batch_size
+            or (opts.batch_bytes and current_bytes + size > opts.batch_bytes)
+        ):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(uid)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def _fetch_spooled(imap, uid: int, opts: FetchOptions):
+    """
+    Streams a large message to a temp file. Returns its row, or None if the
+    server no longer lists uid (expunged since the search); raises
+    IMAP4.abort if it does but sent no body, like _refetch_missing().
+    """
+    fd, path = tempfile.mkstemp(prefix="imap2django-", suffix=".eml")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            meta = imap.fetch_to_file(uid, f, chunk_size=opts.chunk_bytes)
+        if not meta:
+            os.unlink(path)
+            if uid in imap.search_uids_upto(uid):
+                raise imaplib.IMAP4.abort(f"no FETCH data for UID {uid}")
+            return None
+        _raw, flags, internal_date, size = decode_fetch_item(meta)
+        size = size or os.path.getsize(path)
+        return (uid, SpooledRaw(path=path, size=size), flags, internal_date, size)
+    except BaseException:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+
+def _refetch_missing(imap, uids: List[int], fetched: Dict[int, dict], data: Optional[List[str]] = None) -> Dict[int, dict]:
+    """
+    fetched, plus a second fetch of the uids the server returned nothing for.
+    Those still missing then are skipped only if the server no longer lists
+    them (expunged meanwhile); otherwise IMAP4.abort is raised, so the job is
+    retried from the checkpoint instead of stepping over them.
+    """
+    missing = [uid for uid in uids if uid not in fetched]
+    if not missing:
+        return fetched
+    fetched = {**fetched, **imap.fetch_batch(missing, data)}
+    missing = [uid for uid in missing if uid not in fetched]
+    listed = sorted(set(imap.search_uids_upto(missing[-1])).intersection(missing)) if missing else []
+    if listed:
+        raise imaplib.IMAP4.abort(f"no FETCH data for UIDs {listed[:10]} ({len(listed)} in all)")
+    return fetched
+
+def fetch_folder(imap, plan: FolderPlan, opts: FetchOptions, emit: Callable[[RawBatch], bool]) -> bool:
+    """
+    Selects plan.folder and emits its UIDs batch by batch. Returns False if emit was refused.
+    With opts.prefetch, bodies are only downloaded for messages not already stored.
+    In headers mode only header blocks and BODYSTRUCTUREs are fetched (and
+    already-stored messages linked); batches are then bounded by count only.
+    """
+    imap.select_folder(plan.folder)
+    headers_only = opts.mode == "headers"
+    sizes: Dict[int, int] = {}
+    if (opts.batch_bytes or opts.large_bytes) and not headers_only:
+        sizes = imap.fetch_sizes(plan.uids)
+
+    def is_large(uid: int) -> bool:
+        return bool(opts.large_bytes) and sizes.get(uid, 0) > opts.large_bytes
+
+    batches = plan_batches(plan.uids, sizes, opts)
+    # without a header pass every batch's body fetch is known up front, so it can be pipelined
+    bodies = None
+    if headers_only:
+        bodies = imap.fetch_batches(batches, opts.pipeline, HEADER_ONLY_FIELDS)
+    elif not opts.prefetch:
+        bodies = imap.fetch_batches([[uid for uid in b if not is_large(uid)] for b in batches], opts.pipeline)
+
+    for batch_uids in batches:
+        metrics = Metrics()
+        with metrics.measure("fetch") as stage:
+            links: list = []
+            rows = []
+            if headers_only:
+                fetched = _refetch_missing(imap, batch_uids, next(bodies), HEADER_ONLY_FIELDS)
+                links, rows = _header_only_rows(batch_uids, fetched, metrics)
+            else:
+                body_uids = batch_uids
+                if opts.prefetch:
+                    links, body_uids = _prefetch_known(imap, batch_uids, metrics)
+
+                large = [uid for uid in body_uids if is_large(uid)]
+                small = [uid for uid in body_uids if uid not in large]
+                fetched = next(bodies) if bodies is not None else imap.fetch_batch(small)
+                fetched = _refetch_missing(imap, small, fetched)
+                for uid in small:
+                    raw, flags, internal_date, size = decode_fetch_item(fetched.get(uid) or {})
+                    if raw:
+                        rows.append((uid, raw, flags, internal_date, size))
+                for uid in large:
+                    row = _fetch_spooled(imap, uid, opts)
+                    if row:
+                        rows.append(row)
+            stage.messages += len(rows)
+            stage.bytes += sum(_row_bytes(row[1], row[4]) for row in rows)
+
+        batch = RawBatch(
+            plan.account_email, plan.provider, plan.folder, batch_uids, rows, links,
+            metrics=metrics, backfill=opts.mode == "bodies",
+        )
+        if not emit(batch):
+            for row in rows:
+                if isinstance(row[1], SpooledRaw):
+                    os.unlink(row[1].path)
+            if bodies is not None:
+                bodies.close()
+            return False
+    return True
+
+class ImportPipeline:
+    """
+    Usage:
+        pipeline = ImportPipeline(pool, depth=2)
+        for batch in pipeline.run([producer, ...]):
+            ...write batch, then checkpoint batch.max_uid...
+
+    With a spool, the parse stage also keeps every raw message it parses there.
+    """
+    def __init__(self, pool: ParsePool, depth: int = 2, spool: Optional[RawSpool] = None):
+        self.pool = pool
+        self.spool = spool
+        self.raw_q: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+        self.parsed_q: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+        self.stop = threading.Event()
+
+    def _put(self, q: "queue.Queue", obj) -> bool:
+        # Blocking put that gives up once the pipeline is being torn down
+        while not self.stop.is_set():
+            try:
+                q.put(obj, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: "queue.Queue"):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return _Done()
+
+    def _fetch_stage(self, producer: Producer):
+        try:
+            producer(lambda batch: self._put(self.raw_q, batch), self.stop)
+            self._put(self.raw_q, _Done())
+        except BaseException as e:
+            self._put(self.raw_q, _Failed(e))
+
+    def _parse_stage(self, producers: int):
+        try:
+            remaining = producers
+            while remaining:
+                batch = self._get(self.raw_q)
+                if isinstance(batch, _Done):
+                    remaining -= 1
+                    continue
+                if isinstance(batch, _Failed):
+                    self._put(self.parsed_q, batch)
+                    return
+                metrics = batch.metrics or Metrics()
+                nbytes = sum(_row_bytes(raw, size) for _uid, raw, _f, _d, size in batch.rows)
+                if self.spool:
+                    # temp files are gone once parsed
+                    with metrics.measure("spool"):
+                        for _uid, raw, _flags, _idate, _size in batch.rows:
+                            if isinstance(raw, SpooledRaw):
+                                self.spool.put_file(raw.path)
+                normalized = self.pool.map([(raw, size) for _uid, raw, _flags, _idate, size in batch.rows])
+                if batch.rows:
+                    for name, seconds in self.pool.timings.items():
+                        metrics.record(name, seconds, messages=len(batch.rows), nbytes=nbytes)
+                if self.spool:
+                    with metrics.measure("spool"):
+                        self.spool.put_many(
+                            (norm.raw_sha256, raw)
+                            for (_uid, raw, _flags, _idate, _size), norm in zip(batch.rows, normalized)
+                            if isinstance(raw, bytes)
+                        )
+                items = [
+                    ImportItem(uid=uid, flags=flags, internal_date=internal_date, normalized=norm)
+                    for (uid, _raw, flags, internal_date, _size), norm in zip(batch.rows, normalized)
+                ]
+                parsed = ParsedBatch(
+                    batch.account_email, batch.provider, batch.folder, batch.uids, items, batch.links,
+                    bytes=nbytes,
+                    flag_changes=batch.flag_changes,
+                    folder_state=batch.folder_state,
+                    reset=batch.reset,
+                    metrics=metrics,
+                    backfill=batch.backfill,
+                    relinked=batch.relinked,
+                )
+                if not self._put(self.parsed_q, parsed):
+                    return
+            self._put(self.parsed_q, _Done())
+        except BaseException as e:
+            self._put(self.parsed_q, _Failed(e))
+
+    def run(self, producers: List[Producer]) -> Iterator[ParsedBatch]:
+        """
+        Yields ParsedBatch objects on the calling thread, per-folder in fetch order.
+        Exceptions from the fetch/parse stages are re-raised here.
+        """
+        threads = [
+            threading.Thread(target=self._fetch_stage, args=(producer,), name=f"imap-fetch-{i}", daemon=True)
+            for i, producer in enumerate(producers)
+        ]
+        threads.append(threading.Thread(target=self._parse_stage, args=(len(producers),), name="parse", daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                batch = self._get(self.parsed_q)
+                if isinstance(batch, _Done):
+                    return
+                if isinstance(batch, _Failed):
+                    raise batch.exc
+                yield batch
+        finally:
+            self.stop.set()
+            for t in threads:
+                t.join()
@@ -0,0 +1,260 @@
+"""
+Local spool of raw RFC822 bytes, keyed by raw_sha256, so messages can be
+re-parsed (reprocess command) without downloading them again.
+
+Messages are compressed (zstandard if installed, zlib otherwise) and appended
+to segment files of ~1 GiB instead of one file per message; a SQLite index
+maps raw_sha256 -> (segment, offset, length). Records are written before
+their index rows are committed, so a crash can leave unindexed bytes at the
+end of a segment but never an index row pointing at nothing. Each record
+starts with a small header (magic, codec, sha256, size), which keeps segments
+readable without the index. Index ids grow in append order, so iterating by
+id reads the segments sequentially.
+
+Several processes (e.g. import_imap and import_archive) may share a spool:
+appends hold an exclusive lock on spool.lock, pick up the segment and end
+offset other processes left, and fsync the segment before committing the
+index rows that point into it.
+"""
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Tuple
+from . import compression
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+SEGMENT_BYTES = 1024 ** 3
+_HEADER = struct.Struct(">4sB32sQ")  # magic, codec, sha256 digest, raw size
+_MAGIC = b"RSP1"
+ZLIB, ZSTD = 1, 2  # codec byte of a record
+_CODEC_NAMES = {ZLIB: compression.ZLIB, ZSTD: compression.ZSTD}
+_READ_CHUNK = 1024 * 1024
+
+def _lock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def _unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class RawSpool:
+    """
+    Usage:
+        with RawSpool(settings.RAW_SPOOL_DIR) as spool:
+            spool.put_many([(raw_sha256, raw_bytes), ...])
+            raw = spool.get(raw_sha256)
+    Safe to share between threads and processes.
+    """
+    def __init__(self, root: str, segment_bytes: int = SEGMENT_BYTES, level: int = 6):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.level = level
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.lock_fp = open(os.path.join(root, "spool.lock"), "a+b")
+        self.db = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " id INTEGER PRIMARY KEY, sha256 TEXT NOT NULL UNIQUE, segment INTEGER NOT NULL,"
+            " offset INTEGER NOT NULL, length INTEGER NOT NULL, size INTEGER NOT NULL, codec INTEGER NOT NULL)"
+        )
+        self.db.commit()
+        # put_many() runs under self.lock, so one compressor is enough
+        codec, self._compress = compression.compressor(level)
+        self.codec = ZSTD if codec == compression.ZSTD else ZLIB
+        self.segment: Optional[int] = None
+        self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+            self.db.close()
+            self.lock_fp.close()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.root, f"segment-{segment:06d}.rsp")
+
+    @contextmanager
+    def _appending(self):
+        """
+        Holds the thread and the cross-process lock while records are appended.
+        Call with self.lock held.
+        """
+        _lock_file(self.lock_fp)
+        try:
+            # another process may have appended or rolled over since our last write:
+            # reopen the newest segment, positioned at its current end
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+            last = self.db.execute("SELECT MAX(segment) FROM blobs").fetchone()[0]
+            self.segment = max(last or 1, self.segment or 1)
+            yield
+        finally:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+            _unlock_file(self.lock_fp)
+
+    def _sync(self, fp):
+        # the records must be on disk before an index row points at them
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def _writer(self, incoming: int):
+        # the file to append to, rolling over to a new segment when this one is full
+        if self.fp is None:
+            self.fp = open(self._path(self.segment), "ab")
+        if self.fp.tell() and self.fp.tell() + incoming > self.segment_bytes:
+            self._sync(self.fp)
+            self.fp.close()
+            self.segment += 1
+            self.fp = open(self._path(self.segment), "ab")
+        return self.fp
+
+    def known(self, shas: Iterable[str]) -> set:
+        with self.lock:
+            return self._known(shas)
+
+    def _known(self, shas: Iterable[str]) -> set:
+        shas = list(shas)
+        found = set()
+        for i in range(0, len(shas), 500):
+            chunk = shas[i:i + 500]
+            rows = self.db.execute(
+                f"SELECT sha256 FROM blobs WHERE sha256 IN ({','.join('?' * len(chunk))})", chunk
+            )
+            found.update(sha for (sha,) in rows)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> int:
+        """
+        Appends (raw_sha256, raw bytes) pairs not spooled yet. Returns how many were new.
+        """
+        items = dict(items)
+        with self.lock, self._appending():
+            known = self._known(items)
+            new = [(sha, raw) for sha, raw in items.items() if sha not in known]
+            if not new:
+                return 0
+            rows = []
+            for sha, raw in new:
+                payload = self._compress(raw)
+                fp = self._writer(_HEADER.size + len(payload))
+                offset = fp.tell() + _HEADER.size
+                fp.write(_HEADER.pack(_MAGIC, self.codec, bytes.fromhex(sha), len(raw)))
+                fp.write(payload)
+                rows.append((sha, self.segment, offset, len(payload), len(raw), self.codec))
+            self._sync(self.fp)
+            self.db.executemany(
+                "INSERT OR IGNORE INTO blobs (sha256, segment, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.commit()
+            return len(rows)
+
+    def put_file(self, path: str) -> str:
+        """
+        Spools a message that was streamed to a temp file, without reading it
+        into memory (always zlib). Returns its raw_sha256.
+        """
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_READ_CHUNK), b""):
+                h.update(chunk)
+        sha = h.hexdigest()
+        size = os.path.getsize(path)
+        with self.lock, self._appending():
+            if self._known([sha]):
+                return sha
+            fp = self._writer(size)
+            fp.write(_HEADER.pack(_MAGIC, ZLIB, bytes.fromhex(sha), size))
+            offset = fp.tell()
+            compressor = zlib.compressobj(self.level)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(_READ_CHUNK), b""):
+                    fp.write(compressor.compress(chunk))
+            fp.write(compressor.flush())
+            self._sync(fp)
+            self.db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, segment, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                (sha, self.segment, offset, fp.tell() - offset, size, ZLIB),
+            )
+            self.db.commit()
+        return sha
+
+    def _decompress(self, codec: int, payload: bytes) -> bytes:
+        return compression.decompress(_CODEC_NAMES[codec], payload)
+
+    def get(self, sha256: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT segment, offset, length, codec FROM blobs WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        if row is None:
+            return None
+        segment, offset, length, codec = row
+        with open(self._path(segment), "rb") as f:
+            f.seek(offset)
+            return self._decompress(codec, f.read(length))
+
+    def count(self, after_id: int = 0) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM blobs WHERE id > ?", (after_id,)).fetchone()[0]
+
+    def iter_raw(self, after_id: int = 0, limit: int = 0, batch: int = 1000) -> Iterator[Tuple[int, str, bytes]]:
+        """
+        Yields (id, raw_sha256, raw bytes) in append order, i.e. reading segments front to back.
+        """
+        fp = None
+        open_segment = None
+        remaining = limit or -1
+        try:
+            while remaining:
+                with self.lock:
+                    rows: List[tuple] = self.db.execute(
+                        "SELECT id, sha256, segment, offset, length, codec FROM blobs WHERE id > ? ORDER BY id LIMIT ?",
+                        (after_id, batch if remaining < 0 else min(batch, remaining)),
+                    ).fetchall()
+                if not rows:
+                    return
+                for blob_id, sha, segment, offset, length, codec in rows:
+                    if segment != open_segment:
+                        if fp:
+                            fp.close()
+                        fp = open(self._path(segment), "rb")
+                        open_segment = segment
+                    fp.seek(offset)
+                    yield blob_id, sha, self._decompress(codec, fp.read(length))
+                    after_id = blob_id
+                    remaining -= 1
+                    if not remaining:
+                        return
+        finally:
+            if fp:
+                fp.close()
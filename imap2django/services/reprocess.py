@@ -0,0 +1,70 @@
+"""
+Re-parses spooled raw messages (see raw_spool) with the current parser and
+normalizer and rewrites the stored Message rows, recipients and attachments,
+without touching IMAP.
+
+The spool is read in append order (sequential segment reads) by a producer of
+the regular ImportPipeline, so reading, parsing (ParsePool workers) and DB
+writes overlap. Progress is a RebuildProgress row ("reprocess") whose last_id
+is the spool id of the last written batch, saved in that batch's transaction;
+resume=True continues from there.
+"""
+from typing import Callable, Optional
+from django.db import transaction
+from ..models import RebuildProgress
+from .dedup import refresh_messages_bulk
+from .parse_pool import ParsePool
+from .person_cache import PersonCache
+from .pipeline import ImportPipeline, RawBatch
+from .raw_spool import RawSpool
+
+def reprocess_spool(
+    spool: RawSpool,
+    pool: ParsePool,
+    batch_size: int = 500,
+    limit: int = 0,
+    resume: bool = False,
+    depth: int = 2,
+    person_cache: Optional[PersonCache] = None,
+    progress_name: str = "reprocess",
+    log: Optional[Callable[[str], None]] = None,
+) -> int:
+    """
+    Returns how many messages were re-derived.
+    """
+    log = log or (lambda msg: None)
+    progress, _ = RebuildProgress.objects.get_or_create(name=progress_name)
+    if not resume or progress.finished:
+        progress.last_id = progress.processed = progress.changed = 0
+    progress.engine = "spool"
+    progress.finished = False
+    progress.save()
+    start = progress.last_id
+    log(f"{spool.count(start)} spooled messages after id {start}")
+
+    def produce(emit, stop):
+        rows = []
+        for blob_id, _sha, raw in spool.iter_raw(after_id=start, limit=limit):
+            if stop.is_set():
+                return
+            rows.append((blob_id, raw, [], None, len(raw)))
+            if len(rows) >= batch_size:
+                if not emit(RawBatch("", "", "", [r[0] for r in rows], rows)):
+                    return
+                rows = []
+        if rows:
+            emit(RawBatch("", "", "", [r[0] for r in rows], rows))
+
+    pipeline = ImportPipeline(pool, depth=depth)
+    for batch in pipeline.run([produce]):
+        with transaction.atomic():
+            updated = refresh_messages_bulk([it.normalized for it in batch.items], person_cache)
+            progress.last_id = max(batch.uids)
+            progress.processed += len(batch.items)
+            progress.changed += updated
+            progress.save(update_fields=["last_id", "processed", "changed", "updated_at"])
+        log(f"Reprocessed {progress.processed} (updated {progress.changed}), spool id {progress.last_id}")
+
+    progress.finished = True
+    progress.save(update_fields=["finished", "updated_at"])
+    return progress.processed
@@ -0,0 +1,290 @@
+"""
+Schedules many accounts and their folders over a fixed pool of IMAP
+connections, with a per-host cap so providers like Gmail don't throttle us.
+
+Each connection is one producer of an ImportPipeline: it takes jobs from a
+shared queue ("list" an account's folders, or "fetch" one folder) and pushes
+raw batches into the pipeline, which feeds the single DB writer. With
+sync_flags, a fetch job first emits the flag/expunge changes of the folder's
+already-imported messages (see flag_sync).
+
+Every fetch job compares the folder's UIDVALIDITY with the checkpoint. If the
+server reset it, the stored uids are meaningless: the writer drops the folder's
+MailboxMessage rows, and the folder is walked again with a header-only pass
+that re-links messages already stored (matched by Message-ID and size), so
+only bodies that are really new get downloaded. The checkpoint stays in
+re-link mode (ImportCheckpoint.relinking) until that pass has been written in
+full, so a run interrupted mid-relink is continued with the header-only pass
+too, from the checkpoint it reached.
+
+With fetch_options.mode "bodies", a fetch job plans the folder's header-only
+messages instead of the uids above the checkpoint, and the checkpoint stays
+where it is: the backfill is driven by Message.has_body, so an interrupted
+run just picks up the messages still missing their body.
+
+Connections are ResilientImapClients: a dropped connection is re-opened and
+the failed command retried in place. If that keeps failing, the job goes back
+on the queue (up to job_retries times) and is re-planned from the checkpoint,
+so batches already written are not fetched again.
+"""
+import glob
+import os
+import queue
+import threading
+from dataclasses import replace
+from typing import Callable, Dict, List, Optional, Tuple
+from django.db import connection as db_connection
+from .checkpoint import peek_checkpoint, peek_header_only_uids, peek_relinking, peek_uidvalidity
+from .flag_sync import collect_flag_changes
+from .imap_client import (
+    RETRYABLE_ERRORS, AccountConfig, FolderState, ImapClient, ResilientImapClient, UidValidityChanged,
+    load_account_config,
+)
+from .pipeline import FetchOptions, FolderPlan, Producer, RawBatch, fetch_folder
+
+def load_account_configs(config_dir: str) -> List[AccountConfig]:
+    return [load_account_config(p) for p in sorted(glob.glob(os.path.join(config_dir, "*.json")))]
+
+class ImportScheduler:
+    def __init__(
+        self,
+        accounts: List[AccountConfig],
+        fetch_options: Optional[FetchOptions] = None,
+        connections: int = 1,
+        per_host: int = 4,
+        folder_filter: Optional[List[str]] = None,
+        max_per_folder: int = 0,
+        sync_flags: bool = False,
+        relink: bool = True,
+        io: str = "sync",
+        retries: int = 5,
+        job_retries: int = 2,
+        log: Optional[Callable[[str], None]] = None,
+        on_plan: Optional[Callable[[FolderPlan], None]] = None,
+    ):
+        self.fetch_options = fetch_options or FetchOptions()
+        self.connections = max(1, connections)
+        self.per_host = max(1, per_host)
+        self.folder_filter = folder_filter or []
+        self.max_per_folder = max_per_folder
+        self.sync_flags = sync_flags
+        self.relink = relink  # header-only re-link after a UIDVALIDITY change (needs the SQL tables)
+        self.io = io  # "sync" (imapclient) or "async" (aio_imap, pipelined fetches)
+        self.retries = retries  # reconnects per failing IMAP command
+        self.job_retries = job_retries  # re-queues per job once those are used up
+        self.log = log or (lambda msg: None)
+        self.on_plan = on_plan or (lambda plan: None)  # called on fetch threads, e.g. for progress/ETA
+
+        self.jobs: "queue.Queue" = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.failures: List[Tuple[str, str, str]] = []  # (account, folder, error)
+        self.reconnects = 0
+        for acc in accounts:
+            self._add_job(("list", acc, "", 0))
+        if not accounts:
+            self._finish()
+
+    def producers(self) -> List[Producer]:
+        return [self._worker for _ in range(self.connections)]
+
+    # --- job bookkeeping ---
+
+    def _add_job(self, job):
+        with self.lock:
+            self.pending += 1
+        self.jobs.put(job)
+
+    def _job_done(self):
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        for _ in range(self.connections):
+            self.jobs.put(None)
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_slots[host]
+
+    # --- per-connection worker ---
+
+    def _select(self, imap: ImapClient, acc: AccountConfig, folder: str) -> Optional[FolderState]:
+        try:
+            return imap.select_folder(folder)
+        except RETRYABLE_ERRORS:
+            raise  # the connection is gone, not the folder
+        except Exception as e:
+            self.log(f"[{acc.account_email}] Skipping folder '{folder}' (not selectable): {e}")
+            return None
+
+    def _sync(self, imap: ImapClient, acc: AccountConfig, folder: str, state: FolderState, emit) -> bool:
+        changes = collect_flag_changes(imap, acc.account_email, folder, state)
+        if changes is None:
+            return True
+        self.log(
+            f"[{acc.account_email}] {folder}: flags of {len(changes.flags)} messages to sync, "
+            f"{len(changes.vanished)} expunged{' (full pass)' if changes.full else ''}"
+        )
+        return emit(RawBatch(acc.account_email, acc.provider, folder, [], [], flag_changes=changes))
+
+    def _check_uidvalidity(self, imap: ImapClient, acc: AccountConfig, folder: str, state: FolderState, emit) -> Optional[bool]:
+        """
+        Returns None if the stored uids are still valid, otherwise the result of
+        re-linking the folder (False if the pipeline refused a batch).
+        """
+        stored = peek_uidvalidity(acc.account_email, folder)
+        if not state.uidvalidity or stored == state.uidvalidity:
+            return None
+        reset = stored != 0
+        if not emit(RawBatch(acc.account_email, acc.provider, folder, [], [], folder_state=state, reset=reset)):
+            return False
+        if not reset:
+            return None  # first time we see it: just recorded
+
+        uids = sorted(imap.search_uids_since(0))
+        if self.max_per_folder and len(uids) > self.max_per_folder:
+            uids = uids[:self.max_per_folder]
+        self.log(
+            f"[{acc.account_email}] {folder}: UIDVALIDITY changed ({stored} -> {state.uidvalidity}), "
+            f"re-linking {len(uids)} messages by Message-ID/size"
+        )
+        plan = FolderPlan(acc.account_email, acc.provider, folder, 0, uids)
+        self.on_plan(plan)
+        return self._relink(imap, acc, folder, plan, emit)
+
+    def _relink(self, imap: ImapClient, acc: AccountConfig, folder: str, plan: Optional[FolderPlan], emit) -> bool:
+        """
+        Fetches plan (if any) with the header-only re-link pass, then tells the
+        writer the folder's re-link is complete. Returns False if a batch was refused.
+        """
+        # a backfill run re-links (or imports) in full; header-only rows are re-linked like any other
+        mode = "full" if self.fetch_options.mode == "bodies" else self.fetch_options.mode
+        opts = replace(self.fetch_options, prefetch=self.fetch_options.prefetch or self.relink, mode=mode)
+        if plan and not fetch_folder(imap, plan, opts, emit):
+            return False
+        return emit(RawBatch(acc.account_email, acc.provider, folder, [], [], relinked=True))
+
+    def _plan(self, imap: ImapClient, acc: AccountConfig, folder: str) -> Optional[FolderPlan]:
+        last_uid = peek_checkpoint(acc.account_email, folder)
+        uids = sorted(u for u in imap.search_uids_since(last_uid) if u > last_uid)
+        if not uids:
+            self.log(f"[{acc.account_email}] {folder}: no new messages.")
+            return None
+        if self.max_per_folder and len(uids) > self.max_per_folder:
+            uids = uids[:self.max_per_folder]
+        self.log(f"[{acc.account_email}] {folder}: {len(uids)} new messages after last_uid={last_uid}")
+        plan = FolderPlan(acc.account_email, acc.provider, folder, last_uid, uids)
+        self.on_plan(plan)
+        return plan
+
+    def _plan_backfill(self, acc: AccountConfig, folder: str) -> Optional[FolderPlan]:
+        uids = peek_header_only_uids(acc.account_email, folder)
+        if not uids:
+            self.log(f"[{acc.account_email}] {folder}: no header-only messages.")
+            return None
+        if self.max_per_folder and len(uids) > self.max_per_folder:
+            uids = uids[:self.max_per_folder]
+        self.log(f"[{acc.account_email}] {folder}: fetching bodies of {len(uids)} header-only messages")
+        plan = FolderPlan(acc.account_email, acc.provider, folder, 0, uids)
+        self.on_plan(plan)
+        return plan
+
+    def _worker(self, emit, stop: threading.Event):
+        imap: Optional[ResilientImapClient] = None
+        imap_account: Optional[AccountConfig] = None
+        slot: Optional[threading.BoundedSemaphore] = None
+
+        def disconnect():
+            nonlocal imap, imap_account, slot
+            if imap:
+                with self.lock:
+                    self.reconnects += imap.reconnects
+                imap.__exit__(None, None, None)
+            if slot:
+                slot.release()
+            imap, imap_account, slot = None, None, None
+
+        try:
+            while not stop.is_set():
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    # never sit on a host slot while idle, another worker may need it
+                    disconnect()
+                    try:
+                        job = self.jobs.get(timeout=0.2)
+                    except queue.Empty:
+                        continue
+                if job is None:
+                    return
+                kind, acc, folder, attempt = job
+
+                if imap_account is not acc:
+                    disconnect()
+                    host_slot = self._slot(acc.imap.host)
+                    if not host_slot.acquire(timeout=0.5):
+                        # host is at its connection limit; let another job through
+                        self.jobs.put(job)
+                        continue
+                    slot = host_slot
+                    imap_account = acc
+
+                try:
+                    if imap is None:
+                        imap = ResilientImapClient(
+                            acc.imap, sync=self.sync_flags, io=self.io, retries=self.retries, log=self.log
+                        ).__enter__()
+                    if kind == "list":
+                        folders = imap.list_folders()
+                        if self.folder_filter:
+                            folders = [f for f in folders if f in self.folder_filter]
+                        self.log(f"[{acc.account_email}] Folders: {folders}")
+                        for f in folders:
+                            self._add_job(("fetch", acc, f, 0))
+                    else:
+                        state = self._select(imap, acc, folder)
+                        if state is None:
+                            continue
+                        relinked = self._check_uidvalidity(imap, acc, folder, state, emit)
+                        if relinked is False:
+                            return
+                        if relinked:
+                            continue
+                        if self.sync_flags and not self._sync(imap, acc, folder, state, emit):
+                            return
+                        if self.relink and peek_relinking(acc.account_email, folder):
+                            # an earlier run died mid-relink: continue it from the checkpoint
+                            if not self._relink(imap, acc, folder, self._plan(imap, acc, folder), emit):
+                                return
+                            continue
+                        if self.fetch_options.mode == "bodies":
+                            plan = self._plan_backfill(acc, folder)
+                        else:
+                            plan = self._plan(imap, acc, folder)
+                        if plan and not fetch_folder(imap, plan, self.fetch_options, emit):
+                            return
+                except (UidValidityChanged, *RETRYABLE_ERRORS) as e:
+                    disconnect()
+                    if attempt < self.job_retries:
+                        self.log(f"[{acc.account_email}] {kind} {folder or ''} interrupted ({e}), re-queued")
+                        self._add_job((kind, acc, folder, attempt + 1))
+                    else:
+                        self.log(f"[{acc.account_email}] {kind} {folder or ''} failed: {e}")
+                        self.failures.append((acc.account_email, folder, str(e)))
+                except Exception as e:
+                    # one broken account/folder must not take the whole run down
+                    self.log(f"[{acc.account_email}] {kind} {folder or ''} failed: {e}")
+                    self.failures.append((acc.account_email, folder, str(e)))
+                    disconnect()
+                finally:
+                    self._job_done()
+        finally:
+            disconnect()
+            db_connection.close()
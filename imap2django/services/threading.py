@@ -1,44 +1,353 @@
-from ..models import Message, Thread
-from django.db import transaction
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from ..models import Message, RebuildProgress, Thread
+from django.db import connection, connections, transaction
+from .jwz import build_index
 import hashlib
 
-def _thread_key_for_message(msg: Message) -> str:
+def thread_key_for(references, in_reply_to: str, subject_norm: str, date, message_id: str = "") -> str:
     """
     Header-first approach:
     - If references exist => hash of first reference (often root)
-    - Else if in_reply_to exists => hash of that
+    - Else if in_reply_to exists => hash of that (the parent is usually the root)
+    - Else if the message has a Message-ID => it starts a thread, hash of its own id
     - Else fallback => hash of normalized subject + sender + date bucket
+    A "ref:<message-id>" key is the key the JWZ engine gives a thread rooted at
+    that message; when the first reference is not the real root (truncated
+    chain) the two differ until thread_keys_bulk or a rebuild joins them.
     """
-    refs = msg.references_json or []
+    refs = references or []
     if refs:
         root = refs[0]
         return hashlib.sha256(f"ref:{root}".encode("utf-8")).hexdigest()[:40]
 
-    if msg.in_reply_to:
-        return hashlib.sha256(f"irt:{msg.in_reply_to}".encode("utf-8")).hexdigest()[:40]
+    if in_reply_to:
+        return hashlib.sha256(f"ref:{in_reply_to.strip()}".encode("utf-8")).hexdigest()[:40]
+
+    if message_id and message_id.strip():
+        return hashlib.sha256(f"ref:{message_id.strip()}".encode("utf-8")).hexdigest()[:40]
 
     # fallback
     sender = ""
     # we stored sender person separately but not linked; keep simple fallback:
-    subject = msg.subject_norm or ""
-    bucket = (msg.date.date().isoformat() if msg.date else "nodate")
+    subject = subject_norm or ""
+    bucket = (date.date().isoformat() if date else "nodate")
     return hashlib.sha256(f"fallback:{subject}:{bucket}:{sender}".encode("utf-8")).hexdigest()[:40]
 
-@transaction.atomic
-def rebuild_threads(limit: int = 0):
-    qs = Message.objects.all().order_by("id")
+def thread_keys_bulk(normalized) -> Dict[str, str]:
+    """
+    {raw_sha256: thread key} for new messages (import time). A message that
+    references a stored message (or one earlier in the batch) takes that
+    message's thread key, so replies join the thread a rebuild gave their
+    parent even when their References chain is truncated. Other messages get
+    thread_key_for(). One query per batch.
+    """
+    keys: Dict[str, str] = {}
+    parents: Dict[str, List[str]] = {}
+    for n in normalized:
+        keys[n.raw_sha256] = thread_key_for(n.references, n.in_reply_to, n.subject_norm, n.date_dt, n.message_id)
+        # root first, as in References
+        ids = [mid.strip() for mid in list(n.references or []) + [n.in_reply_to] if mid and mid.strip()]
+        parents[n.raw_sha256] = list(dict.fromkeys(ids))
+    wanted = {mid for ids in parents.values() for mid in ids}
+    if not wanted:
+        return keys
+
+    known: Dict[str, str] = {}
+    wanted_list = list(wanted)
+    for start in range(0, len(wanted_list), 2000):
+        known.update(
+            Message.objects.filter(message_id__in=wanted_list[start:start + 2000], thread__isnull=False)
+            .values_list("message_id", "thread__thread_key")
+        )
+    for n in normalized:
+        for mid in parents[n.raw_sha256]:
+            if mid in known:
+                keys[n.raw_sha256] = known[mid]
+                break
+        if n.message_id and n.message_id.strip():
+            known.setdefault(n.message_id.strip(), keys[n.raw_sha256])
+    return keys
+
+def _thread_key_for_message(msg: Message) -> str:
+    return thread_key_for(msg.references_json, msg.in_reply_to, msg.subject_norm, msg.date, msg.message_id)
+
+THREAD_FIELDS = ("id", "message_id", "references_json", "in_reply_to", "subject_norm", "date", "thread")
+JWZ_FIELDS = ("id", "message_id", "in_reply_to", "references_json", "subject_norm", "thread_id")
+
+def resolve_threads_bulk(subjects: Dict[str, str]) -> Dict[str, int]:
+    """
+    subjects: {thread_key: subject_norm}. Returns {thread_key: thread pk},
+    creating missing Thread rows in one conflict-tolerant insert.
+    """
+    if not subjects:
+        return {}
+    found = dict(Thread.objects.filter(thread_key__in=list(subjects)).values_list("thread_key", "id"))
+    missing = [key for key in subjects if key not in found]
+    if missing:
+        Thread.objects.bulk_create(
+            [Thread(thread_key=key, subject_norm=subjects[key] or "") for key in missing],
+            ignore_conflicts=True,
+        )
+        found.update(Thread.objects.filter(thread_key__in=missing).values_list("thread_key", "id"))
+    return found
+
+def assign_threads(messages: List[Message]) -> int:
+    """
+    Computes thread keys for messages (loaded with THREAD_FIELDS), resolves
+    their threads in bulk and saves the ones that changed. Returns how many changed.
+    """
+    keys = {msg.pk: _thread_key_for_message(msg) for msg in messages}
+    subjects: Dict[str, str] = {}
+    for msg in messages:
+        subjects.setdefault(keys[msg.pk], msg.subject_norm or "")
+    threads = resolve_threads_bulk(subjects)
+
+    changed = []
+    for msg in messages:
+        thread_id = threads[keys[msg.pk]]
+        if msg.thread_id != thread_id:
+            msg.thread_id = thread_id
+            changed.append(msg)
+    if changed:
+        Message.objects.bulk_update(changed, ["thread"])
+    return len(changed)
+
+# (message pk, thread key, pk of the message whose subject names a new thread, current thread_id)
+Assignment = Tuple[int, str, int, Optional[int]]
+
+def set_message_threads(pairs: List[Tuple[int, int]]):
+    """
+    pairs: (message pk, thread pk). One UPDATE ... FROM (VALUES ...) on
+    PostgreSQL, a CASE-based bulk_update elsewhere.
+    """
+    if not pairs:
+        return
+    if connection.vendor != "postgresql":
+        Message.objects.bulk_update([Message(pk=pk, thread_id=tid) for pk, tid in pairs], ["thread"], batch_size=500)
+        return
+    qn = connection.ops.quote_name
+    values = ",".join(["(%s::bigint, %s::bigint)"] * len(pairs))
+    sql = (
+        f"UPDATE {qn(Message._meta.db_table)} AS m SET {qn('thread_id')} = v.thread_id "
+        f"FROM (VALUES {values}) AS v(id, thread_id) WHERE m.{qn('id')} = v.id"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [x for pair in pairs for x in pair])
+
+def apply_assignments(chunk: List[Assignment]) -> int:
+    """
+    Resolves the chunk's threads and writes the messages whose thread changed.
+    Returns how many changed. Idempotent, so a chunk can safely be re-applied.
+    """
+    keys = {key for _pk, key, _rep, _current in chunk}
+    threads = dict(Thread.objects.filter(thread_key__in=list(keys)).values_list("thread_key", "id"))
+    reps: Dict[str, int] = {}
+    for _pk, key, rep, _current in chunk:
+        if key not in threads:
+            reps.setdefault(key, rep)
+    if reps:
+        subjects = dict(Message.objects.filter(pk__in=list(reps.values())).values_list("id", "subject_norm"))
+        threads.update(resolve_threads_bulk({key: subjects.get(rep, "") for key, rep in reps.items()}))
+
+    pairs = [(pk, threads[key]) for pk, key, _rep, current in chunk if current != threads[key]]
+    set_message_threads(pairs)
+    return len(pairs)
+
+def _chunks(rows, chunk_size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _header_chunks(limit: int, since, unthreaded: bool, after_id: int, chunk_size: int) -> Iterator[List[Assignment]]:
+    qs = Message.objects.filter(id__gt=after_id).order_by("id")
+    if since:
+        qs = qs.filter(created_at__gte=since)
+    if unthreaded:
+        qs = qs.filter(thread__isnull=True)
     if limit and limit > 0:
         qs = qs[:limit]
+    fields = ("id", "message_id", "references_json", "in_reply_to", "subject_norm", "date", "thread_id")
+    rows = (
+        (pk, thread_key_for(refs, irt, subject, date, mid), pk, thread_id)
+        for pk, mid, refs, irt, subject, date, thread_id in qs.values_list(*fields).iterator(chunk_size=chunk_size)
+    )
+    return _chunks(rows, chunk_size)
 
-    count = 0
-    for msg in qs.iterator(chunk_size=500):
-        tkey = _thread_key_for_message(msg)
-        thread, _ = Thread.objects.get_or_create(
-            thread_key=tkey,
-            defaults={"subject_norm": msg.subject_norm or ""}
-        )
-        if msg.thread_id != thread.id:
-            msg.thread = thread
-            msg.save(update_fields=["thread"])
-        count += 1
-    return count
+def _jwz_delta_rows(delta, chunk_size: int) -> Tuple[List[tuple], Set[int]]:
+    """
+    JWZ_FIELDS rows of the delta plus everything it is linked to: messages
+    whose Message-ID it references (transitively) and the other members of
+    the threads those messages are already in, sorted by id; and the delta's pks.
+    """
+    rows: Dict[int, tuple] = {}
+
+    def add(qs) -> List[tuple]:
+        new = []
+        for row in qs.values_list(*JWZ_FIELDS).iterator(chunk_size=chunk_size):
+            if row[0] not in rows:
+                rows[row[0]] = row
+                new.append(row)
+        return new
+
+    frontier = add(delta)
+    pks = {row[0] for row in frontier}
+    seen_ids: Set[str] = set()
+    seen_threads: Set[int] = set()
+    while frontier:
+        ids: Set[str] = set()
+        threads: Set[int] = set()
+        for _pk, mid, irt, refs, _subject, thread_id in frontier:
+            seen_ids.add((mid or "").strip())
+            for ref in list(refs or []) + [irt]:
+                ref = (ref or "").strip()
+                if ref and ref not in seen_ids:
+                    ids.add(ref)
+            if thread_id and thread_id not in seen_threads:
+                threads.add(thread_id)
+        seen_ids |= ids
+        seen_threads |= threads
+        frontier = []
+        ids_list, threads_list = sorted(ids), sorted(threads)
+        for i in range(0, len(ids_list), 1000):
+            frontier += add(Message.objects.filter(message_id__in=ids_list[i:i + 1000]))
+        for i in range(0, len(threads_list), 1000):
+            frontier += add(Message.objects.filter(thread_id__in=threads_list[i:i + 1000]))
+    return [rows[pk] for pk in sorted(rows)], pks
+
+def _jwz_chunks(limit: int, since, unthreaded: bool, after_id: int, chunk_size: int) -> Iterator[List[Assignment]]:
+    only_roots: Optional[Set[int]] = None
+    if since or unthreaded:
+        # index the delta and what it links to, not the whole corpus; since/unthreaded
+        # also narrow which threads get written back
+        delta = Message.objects.order_by("id")
+        if since:
+            delta = delta.filter(created_at__gte=since)
+        if unthreaded:
+            delta = delta.filter(thread__isnull=True)
+        if limit and limit > 0:
+            delta = delta[:limit]
+        rows, pks = _jwz_delta_rows(delta, chunk_size)
+        table = build_index(rows)
+        only_roots = {root for pk, root, _current in table.assignments() if pk in pks}
+    else:
+        # the whole corpus is indexed so parents and broken chains are found
+        qs = Message.objects.order_by("id")
+        if limit and limit > 0:
+            qs = qs[:limit]
+        table = build_index(qs.values_list(*JWZ_FIELDS).iterator(chunk_size=chunk_size))
+
+    first_pk: Dict[int, int] = {}
+    def rows():
+        for pk, root, current in table.assignments():
+            if only_roots is not None and root not in only_roots:
+                continue
+            rep = table.message[root] or first_pk.setdefault(root, pk)
+            if pk > after_id:
+                yield pk, table.thread_key(root), rep, current or None
+
+    return _chunks(rows(), chunk_size)
+
+def delete_empty_threads() -> int:
+    """
+    Deletes Thread rows no message belongs to any more. Returns how many.
+    """
+    deleted, _ = Thread.objects.filter(messages__isnull=True).delete()
+    return deleted
+
+ENGINES: Dict[str, Callable[..., Iterator[List[Assignment]]]] = {
+    "jwz": _jwz_chunks,
+    "headers": _header_chunks,
+}
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+def _apply_job(chunk: List[Assignment]) -> int:
+    with transaction.atomic():
+        return apply_assignments(chunk)
+
+def rebuild_threads(
+    limit: int = 0,
+    since=None,
+    unthreaded: bool = False,
+    chunk_size: int = 2000,
+    engine: str = "jwz",
+    workers: int = 0,
+    resume: bool = False,
+    progress_name: str = "threads",
+    log: Optional[Callable[[str], None]] = None,
+) -> int:
+    """
+    Re-threads messages. since (datetime) limits it to messages created since
+    then and unthreaded to messages without a thread, so a run after an import
+    only touches the delta. New messages are already threaded at import time.
+
+    engine="jwz" links messages through their parents (see services/jwz.py);
+    engine="headers" only hashes each message's own headers. Assignments are
+    computed first and then applied in id-ordered chunks, each in its own
+    transaction, optionally across worker processes. Progress is kept in
+    RebuildProgress(name=progress_name); resume=True skips chunks a killed
+    run already applied, if that run had the same engine, since and
+    unthreaded (otherwise it starts over). Returns how many messages were processed.
+    """
+    log = log or (lambda msg: None)
+    progress, _ = RebuildProgress.objects.get_or_create(name=progress_name)
+    same_scope = (progress.engine, progress.since, progress.unthreaded) == (engine, since, unthreaded)
+    if resume and not progress.finished and progress.last_id and not same_scope:
+        log("The interrupted rebuild had other options (engine/since/unthreaded), starting over")
+    if not resume or progress.finished or not same_scope:
+        progress.last_id = progress.processed = progress.changed = 0
+    progress.engine = engine
+    progress.since = since
+    progress.unthreaded = unthreaded
+    progress.finished = False
+    progress.save()
+    if progress.last_id:
+        log(f"Resuming after message id {progress.last_id}")
+
+    chunks = ENGINES[engine](limit, since, unthreaded, progress.last_id, chunk_size)
+    if workers > 1 and connection.vendor == "sqlite":
+        log("SQLite allows a single writer, applying chunks inline")
+        workers = 0
+
+    def done(chunk: List[Assignment], changed: int):
+        progress.last_id = chunk[-1][0]
+        progress.processed += len(chunk)
+        progress.changed += changed
+        progress.save(update_fields=["last_id", "processed", "changed", "updated_at"])
+        log(f"{progress.processed} messages, {progress.changed} re-threaded (up to id {progress.last_id})")
+
+    if workers > 1:
+        # the parent's connection must not be shared with forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            # start the workers now, before the parent reconnects to read chunks
+            executor.submit(int).result()
+            inflight: deque = deque()
+            for chunk in chunks:
+                inflight.append((chunk, executor.submit(_apply_job, chunk)))
+                # completing in submission order keeps last_id a safe resume point
+                while len(inflight) > workers * 2:
+                    c, future = inflight.popleft()
+                    done(c, future.result())
+            while inflight:
+                c, future = inflight.popleft()
+                done(c, future.result())
+    else:
+        for chunk in chunks:
+            with transaction.atomic():
+                changed = apply_assignments(chunk)
+                done(chunk, changed)
+
+    progress.finished = True
+    progress.save(update_fields=["finished", "updated_at"])
+    return progress.processed
@@ -0,0 +1,135 @@
+"""
+Import benchmark: serves a synthetic corpus (see corpus) from FakeImapServer
+and runs the import stages one after the other over all of it, so each gets
+its own throughput, query and memory figures:
+
+- fetch: UID SEARCH + UID FETCH of every folder (ImapClient, sync or async io)
+- parse_rfc822 / normalize: the two halves of a ParsePool job, inline
+- load_sql: load_sql_batch per folder batch, with checkpoints
+- rebuild_threads: a full rebuild with the chosen engine
+
+Messages are held in memory between stages, so keep corpora to a few
+thousand messages. Queries are those of the calling thread, RSS is the whole
+process. Writes go to the current database; the benchmark_import command
+runs it against a throwaway test database.
+"""
+import platform
+import sys
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import django
+from django.conf import settings
+from django.db import connection
+from ..loaders.sql_loader import load_sql_batch
+from ..services.imap_client import ImapClient, decode_fetch_item
+from ..services.import_session import ImportSession
+from ..services.metrics import Metrics
+from ..services.normalizer import ImportItem, normalize
+from ..services.parser import ParseOptions, parse_date_to_dt, parse_rfc822
+from ..services.person_cache import PersonCache
+from ..services.threading import rebuild_threads
+from .corpus import CorpusSpec, load_corpus
+from .fake_imap import FakeImapServer
+
+REPORT_VERSION = 1
+STAGES = ("fetch", "parse_rfc822", "normalize", "load_sql", "rebuild_threads")
+
+def run_benchmark(
+    spec: CorpusSpec,
+    batch_size: int = 200,
+    io: str = "sync",
+    pipeline: int = 4,
+    latency: float = 0.0,
+    engine: str = "jwz",
+    parse_options: Optional[ParseOptions] = None,
+    log: Optional[Callable[[str], None]] = None,
+) -> dict:
+    """
+    Returns the report as a JSON-serialisable dict.
+    """
+    log = log or (lambda msg: None)
+    metrics = Metrics()
+    with FakeImapServer(latency=latency) as server:
+        log(f"Generating {spec.messages} messages (seed {spec.seed})")
+        corpus = load_corpus(server, spec)
+        account_email = server.username
+
+        # (folder, uid, raw, flags, internal_date, size)
+        rows: List[tuple] = []
+        log("fetch")
+        with metrics.measure("fetch", sample_rss=True) as stage:
+            with ImapClient(server.imap_config(), io=io) as imap:
+                for folder in imap.list_folders():
+                    imap.select_folder(folder)
+                    uids = imap.search_uids_since(0)
+                    batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+                    for fetched in imap.fetch_batches(batches, window=pipeline):
+                        for uid in sorted(fetched):
+                            raw, flags, internal_date, size = decode_fetch_item(fetched[uid])
+                            rows.append((folder, uid, raw, flags, internal_date, size))
+            stage.messages = len(rows)
+            stage.bytes = sum(len(r[2]) for r in rows)
+        fetched_bytes = metrics.stage("fetch").bytes
+
+    log("parse_rfc822")
+    with metrics.measure("parse_rfc822", messages=len(rows), nbytes=fetched_bytes, sample_rss=True):
+        parsed = [parse_rfc822(raw, parse_options) for _f, _u, raw, *_rest in rows]
+
+    log("normalize")
+    with metrics.measure("normalize", messages=len(rows), nbytes=fetched_bytes, sample_rss=True):
+        normalized = [
+            normalize(p, row[2], size=row[5], date_dt=parse_date_to_dt(p.date or ""))
+            for p, row in zip(parsed, rows)
+        ]
+    del parsed
+
+    log("load_sql")
+    by_folder: Dict[str, List[ImportItem]] = {}
+    for (folder, uid, _raw, flags, internal_date, _size), norm in zip(rows, normalized):
+        by_folder.setdefault(folder, []).append(ImportItem(uid=uid, flags=flags, internal_date=internal_date, normalized=norm))
+    session = ImportSession()
+    person_cache = PersonCache()
+    with metrics.measure("load_sql", messages=len(rows), nbytes=fetched_bytes, sample_rss=True):
+        for folder, items in by_folder.items():
+            folder_session = session.folder(account_email, "benchmark", folder)
+            for i in range(0, len(items), batch_size):
+                load_sql_batch(
+                    account_email=account_email,
+                    provider="benchmark",
+                    mailbox_name=folder,
+                    items=items[i:i + batch_size],
+                    person_cache=person_cache,
+                    folder=folder_session,
+                )
+    del rows, normalized, by_folder
+
+    log("rebuild_threads")
+    with metrics.measure("rebuild_threads", sample_rss=True) as stage:
+        stage.messages = rebuild_threads(engine=engine, progress_name="benchmark")
+
+    stages = metrics.as_dict()
+    total_seconds = sum(s.seconds for s in metrics.stages.values())
+    return {
+        "version": REPORT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": sys.version.split()[0],
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "platform": platform.platform(),
+        },
+        "settings": {
+            "batch": batch_size,
+            "io": io,
+            "pipeline": pipeline,
+            "latency": latency,
+            "engine": engine,
+            "body_storage": getattr(settings, "BODY_STORAGE", "inline"),
+        },
+        "corpus": {"spec": {**vars(spec), "folders": list(spec.folders), "attachment_types": list(spec.attachment_types)}, **corpus},
+        "stages": stages,
+        "total": {
+            "seconds": round(total_seconds, 4),
+            "msg_per_s": round(corpus["stored"] / total_seconds, 1) if total_seconds else None,
+        },
+    }
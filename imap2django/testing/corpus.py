@@ -0,0 +1,187 @@
+"""
+Reproducible synthetic mailboxes for benchmarks.
+
+generate_corpus(spec) yields the same messages, byte for byte, for the same
+CorpusSpec: body sizes and attachment sizes are log-normal, a share of the
+messages is HTML-only or multipart/alternative, some carry attachments, and
+replies build threads up to max_thread_depth deep. duplicate_rate of the
+messages is stored in a second folder too (same bytes, as Gmail labels or an
+IMAP COPY produce).
+
+Usage:
+    with FakeImapServer() as server:
+        summary = load_corpus(server, CorpusSpec(messages=5000, seed=7))
+"""
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+from typing import Iterator, List, Tuple
+
+_WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from at which but have an they you "
+    "were her she there been one all we their has would when if so no will more out up into do any your what some can "
+    "meeting invoice report project deadline review budget schedule update release server customer contract draft "
+    "attached please thanks regards question proposal agenda forecast quarter team office travel delivery order "
+    "payment account support ticket issue migration backup database network security policy training"
+).split()
+
+_ATTACHMENTS = {
+    "application/pdf": "report.pdf",
+    "image/png": "screenshot.png",
+    "text/csv": "export.csv",
+    "application/zip": "archive.zip",
+}
+
+@dataclass
+class CorpusSpec:
+    messages: int = 2000  # distinct messages; duplicates come on top
+    seed: int = 1
+    folders: Tuple[str, ...] = ("INBOX", "Archive", "Sent")
+    body_median: int = 2000  # bytes of body text (log-normal)
+    body_sigma: float = 1.0
+    html_ratio: float = 0.2  # text/html only
+    multipart_ratio: float = 0.4  # multipart/alternative, text + html
+    attachment_ratio: float = 0.15
+    attachment_median: int = 40_000  # bytes before base64 (log-normal)
+    attachment_sigma: float = 1.2
+    attachment_types: Tuple[str, ...] = tuple(_ATTACHMENTS)
+    reply_ratio: float = 0.5  # messages answering an earlier one
+    max_thread_depth: int = 8
+    duplicate_rate: float = 0.1  # messages also stored in a second folder
+    participants: int = 50
+
+@dataclass
+class CorpusMessage:
+    folders: List[str]
+    raw: bytes
+    flags: List[str]
+    internal_date: datetime
+
+class _Generator:
+    def __init__(self, spec: CorpusSpec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.people = [(f"Person {i}", f"person{i}@example.com") for i in range(spec.participants)]
+        self.threads: List[Tuple[str, List[str], str, int]] = []  # (message-id, references, subject, depth)
+
+    def size(self, median: int, sigma: float) -> int:
+        return max(16, int(self.rng.lognormvariate(0, sigma) * median))
+
+    def text(self, size: int) -> str:
+        words = self.rng.choices(_WORDS, k=max(1, size // 6))
+        return "\n".join(" ".join(words[i:i + 12]) for i in range(0, len(words), 12)) + "\n"
+
+    def html(self, text: str) -> str:
+        paragraphs = "".join(f"<p>{p}</p>\n" for p in text.split("\n") if p)
+        return (
+            "<html><head><style>p { margin: 0 0 1em; }</style></head><body>\n"
+            f"<div class=\"content\">{paragraphs}</div>\n"
+            "<table><tr><td>Sent from the benchmark corpus</td></tr></table></body></html>\n"
+        )
+
+    def attachment(self, msg: EmailMessage):
+        ctype = self.rng.choice(self.spec.attachment_types)
+        filename = _ATTACHMENTS.get(ctype, "attachment.bin")
+        size = self.size(self.spec.attachment_median, self.spec.attachment_sigma)
+        if ctype.startswith("text/"):
+            rows = (",".join(str(self.rng.randrange(10 ** 6)) for _ in range(6)) for _ in range(max(1, size // 40)))
+            msg.add_attachment("\n".join(rows) + "\n", subtype=ctype.split("/")[1], filename=filename)
+        else:
+            maintype, subtype = ctype.split("/")
+            msg.add_attachment(self.rng.randbytes(size), maintype=maintype, subtype=subtype, filename=filename)
+
+    def parent(self):
+        # replies go to recent messages, like a live mailbox
+        spec = self.spec
+        if not self.threads or self.rng.random() >= spec.reply_ratio:
+            return None
+        candidates = [t for t in self.threads[-200:] if t[3] < spec.max_thread_depth]
+        return self.rng.choice(candidates) if candidates else None
+
+    def message(self, i: int, date: datetime) -> EmailMessage:
+        spec, rng = self.spec, self.rng
+        sender = rng.choice(self.people)
+        recipients = rng.sample(self.people, k=min(len(self.people), rng.randint(1, 4)))
+        message_id = f"<bench.{spec.seed}.{i}@example.com>"
+
+        msg = EmailMessage()
+        msg["From"] = f"{sender[0]} <{sender[1]}>"
+        msg["To"] = ", ".join(f"{name} <{email}>" for name, email in recipients[:2])
+        if len(recipients) > 2:
+            msg["Cc"] = ", ".join(f"{name} <{email}>" for name, email in recipients[2:])
+        msg["Date"] = format_datetime(date)
+        msg["Message-ID"] = message_id
+
+        parent = self.parent()
+        if parent:
+            parent_id, parent_refs, subject, depth = parent
+            references = (parent_refs + [parent_id])[-10:]
+            msg["Subject"] = subject if subject.startswith("Re: ") else f"Re: {subject}"
+            msg["In-Reply-To"] = parent_id
+            msg["References"] = " ".join(references)
+            self.threads.append((message_id, references, msg["Subject"], depth + 1))
+        else:
+            msg["Subject"] = " ".join(rng.choices(_WORDS, k=rng.randint(2, 8))).capitalize()
+            self.threads.append((message_id, [], msg["Subject"], 1))
+
+        text = self.text(self.size(spec.body_median, spec.body_sigma))
+        kind = rng.random()
+        if kind < spec.html_ratio:
+            msg.set_content(self.html(text), subtype="html")
+        elif kind < spec.html_ratio + spec.multipart_ratio:
+            msg.set_content(text)
+            msg.add_alternative(self.html(text), subtype="html")
+        else:
+            msg.set_content(text)
+        if rng.random() < spec.attachment_ratio:
+            for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                self.attachment(msg)
+        # fixed boundaries; the email package would pick random ones
+        for n, part in enumerate(p for p in msg.walk() if p.is_multipart()):
+            part.set_boundary(f"==bench{spec.seed}.{i}.{n}==")
+        return msg
+
+    def folders(self) -> List[str]:
+        folders = list(self.spec.folders)
+        # the first folder (INBOX) holds about half the mail
+        primary = folders[0] if self.rng.random() < 0.5 else self.rng.choice(folders)
+        result = [primary]
+        others = [f for f in folders if f != primary]
+        if others and self.rng.random() < self.spec.duplicate_rate:
+            result.append(self.rng.choice(others))
+        return result
+
+    def flags(self) -> List[str]:
+        flags = []
+        if self.rng.random() < 0.7:
+            flags.append("\\Seen")
+        if self.rng.random() < 0.05:
+            flags.append("\\Flagged")
+        return flags
+
+def generate_corpus(spec: CorpusSpec) -> Iterator[CorpusMessage]:
+    gen = _Generator(spec)
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(spec.messages):
+        date += timedelta(seconds=gen.rng.randint(60, 3600))
+        msg = gen.message(i, date)
+        yield CorpusMessage(folders=gen.folders(), raw=msg.as_bytes(), flags=gen.flags(), internal_date=date)
+
+def load_corpus(server, spec: CorpusSpec) -> dict:
+    """
+    Appends the corpus to a FakeImapServer. Returns counts for the benchmark report.
+    """
+    summary = {"messages": 0, "stored": 0, "bytes": 0, "stored_bytes": 0, "folders": {}}
+    for folder in spec.folders:
+        server.add_folder(folder)
+    for message in generate_corpus(spec):
+        summary["messages"] += 1
+        summary["bytes"] += len(message.raw)
+        for folder in message.folders:
+            server.append(folder, message.raw, flags=message.flags, internal_date=message.internal_date)
+            summary["stored"] += 1
+            summary["stored_bytes"] += len(message.raw)
+            summary["folders"][folder] = summary["folders"].get(folder, 0) + 1
+    return summary
@@ -0,0 +1,609 @@
+"""
+In-process IMAP4rev1 server for tests and benchmarks.
+
+Speaks just enough of the protocol for ImapClient over plain TCP on
+localhost: LOGIN, CAPABILITY, ENABLE, LIST, SELECT/EXAMINE, UID SEARCH,
+UID FETCH (full, header-field and partial bodies, BODYSTRUCTURE, CONDSTORE
+CHANGEDSINCE and QRESYNC VANISHED), NOOP and LOGOUT. Folders and messages are plain Python
+objects that tests mutate between import runs; drop_on() closes connections
+mid-command to exercise reconnects, and latency delays every response as a
+network round trip would (pipelined commands overlap it, sequential ones don't).
+
+Usage:
+    with FakeImapServer() as server:
+        server.append("INBOX", raw_bytes, flags=["\\Seen"])
+        with ImapClient(server.imap_config()) as imap:
+            ...
+"""
+import queue
+import re
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email import message_from_bytes, policy
+from email.message import Message
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+from imapclient import imap_utf7
+
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "LITERAL+", "ENABLE", "UIDPLUS", "CONDSTORE", "QRESYNC")
+
+_BODY_RE = re.compile(r"^(BODY(?:\.PEEK)?)\[(?P<section>[^\]]*)\](?:<(?P<offset>\d+)\.(?P<length>\d+)>)?$", re.I)
+_LITERAL_RE = re.compile(rb"\{(\d+)(\+?)\}\r\n$")
+
+@dataclass
+class FakeMessage:
+    uid: int
+    raw: bytes
+    flags: List[str]
+    internal_date: datetime
+    modseq: int
+
+@dataclass
+class FakeFolder:
+    name: str
+    uidvalidity: int
+    uidnext: int = 1
+    highest_modseq: int = 1
+    messages: Dict[int, FakeMessage] = field(default_factory=dict)
+    expunged: List[Tuple[int, int]] = field(default_factory=list)  # (uid, modseq)
+
+    def sorted_uids(self) -> List[int]:
+        return sorted(self.messages)
+
+    def bump(self) -> int:
+        self.highest_modseq += 1
+        return self.highest_modseq
+
+class FakeImapServer:
+    def __init__(
+        self,
+        username: str = "user@example.com",
+        password: str = "secret",
+        capabilities: Iterable[str] = DEFAULT_CAPABILITIES,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+    ):
+        self.username = username
+        self.password = password
+        self.capabilities = [c.upper() for c in capabilities]
+        self.latency = latency  # seconds added to every response
+        self.lock = threading.RLock()
+        self.folders: Dict[str, FakeFolder] = {}
+        self.commands: List[str] = []  # every command name received, for assertions
+        self.drops: Dict[str, int] = {}  # command name -> connections still to drop on it
+        self._next_validity = int(time.time())
+        self.add_folder("INBOX")
+
+        server = self
+
+        class Handler(_Session):
+            fake = server
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.thread: Optional[threading.Thread] = None
+
+    # --- lifecycle ---
+
+    @property
+    def host(self) -> str:
+        return self.server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-imap", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def imap_config(self):
+        from ..services.imap_client import ImapConfig
+
+        return ImapConfig(host=self.host, port=self.port, ssl=False, username=self.username, password=self.password)
+
+    def drop_on(self, command: str, times: int = 1):
+        """
+        The next `times` sessions sending `command` (e.g. "UID FETCH") are
+        disconnected instead of answered, like a server timing out mid-transfer.
+        """
+        with self.lock:
+            self.drops[command.upper()] = self.drops.get(command.upper(), 0) + times
+
+    # --- mailbox state ---
+
+    def add_folder(self, name: str) -> FakeFolder:
+        with self.lock:
+            if name not in self.folders:
+                self._next_validity += 1
+                self.folders[name] = FakeFolder(name=name, uidvalidity=self._next_validity)
+            return self.folders[name]
+
+    def append(self, folder: str, raw: bytes, flags: Iterable[str] = (), internal_date: Optional[datetime] = None) -> int:
+        with self.lock:
+            f = self.add_folder(folder)
+            uid = f.uidnext
+            f.uidnext += 1
+            f.messages[uid] = FakeMessage(
+                uid=uid,
+                raw=raw,
+                flags=list(flags),
+                internal_date=internal_date or datetime.now(timezone.utc),
+                modseq=f.bump(),
+            )
+            return uid
+
+    def set_flags(self, folder: str, uid: int, flags: Iterable[str]):
+        with self.lock:
+            f = self.folders[folder]
+            msg = f.messages[uid]
+            msg.flags = list(flags)
+            msg.modseq = f.bump()
+
+    def expunge(self, folder: str, uids: Iterable[int]):
+        with self.lock:
+            f = self.folders[folder]
+            for uid in uids:
+                if f.messages.pop(uid, None):
+                    f.expunged.append((uid, f.bump()))
+
+    def reset_uidvalidity(self, folder: str):
+        """
+        Simulates a server-side rebuild: new UIDVALIDITY and every message renumbered from 1.
+        """
+        with self.lock:
+            f = self.folders[folder]
+            self._next_validity += 1
+            f.uidvalidity = self._next_validity
+            messages = [f.messages[uid] for uid in f.sorted_uids()]
+            f.messages = {}
+            f.expunged = []
+            for i, msg in enumerate(messages, start=1):
+                msg.uid = i
+                f.messages[i] = msg
+            f.uidnext = len(messages) + 1
+
+class _Session(socketserver.StreamRequestHandler):
+    fake: FakeImapServer
+
+    def setup(self):
+        super().setup()
+        self.authenticated = False
+        self.enabled: set = set()
+        self.selected: Optional[str] = None
+        self.outbox: Optional[queue.Queue] = None
+        if self.fake.latency:
+            # responses leave `latency` seconds after they are produced, without holding up the next command
+            self.outbox = queue.Queue()
+            self.writer = threading.Thread(target=self._deliver, daemon=True)
+            self.writer.start()
+
+    def finish(self):
+        if self.outbox:
+            self.outbox.put(None)
+            self.writer.join()
+        super().finish()
+
+    # --- wire helpers ---
+
+    def _deliver(self):
+        while True:
+            entry = self.outbox.get()
+            if entry is None:
+                return
+            due, data = entry
+            time.sleep(max(0.0, due - time.monotonic()))
+            try:
+                self.wfile.write(data)
+            except OSError:
+                return
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.outbox:
+            self.outbox.put((time.monotonic() + self.fake.latency, data))
+        else:
+            self.wfile.write(data)
+
+    def untagged(self, text: str):
+        self.send(f"* {text}\r\n")
+
+    def read_command(self) -> Optional[str]:
+        # joins client literals ({n} / {n+}) into one line, quoting their content
+        line = self.rfile.readline()
+        if not line:
+            return None
+        parts = []
+        while True:
+            m = _LITERAL_RE.search(line)
+            if not m:
+                parts.append(line.rstrip(b"\r\n"))
+                break
+            parts.append(line[:m.start()])
+            if not m.group(2):
+                self.send("+ go ahead\r\n")
+            literal = self.rfile.read(int(m.group(1)))
+            parts.append(b'"' + literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"')
+            line = self.rfile.readline()
+        return b"".join(parts).decode("utf-8", errors="replace")
+
+    def handle(self):
+        self.send(f"* OK [CAPABILITY {' '.join(self.fake.capabilities)}] fake IMAP ready\r\n")
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tokens = _tokenize(line)
+            if len(tokens) < 2:
+                self.send(f"{tokens[0] if tokens else '*'} BAD empty command\r\n")
+                continue
+            tag, command, args = tokens[0], str(tokens[1]).upper(), tokens[2:]
+            uid = False
+            if command == "UID" and args:
+                uid, command, args = True, str(args[0]).upper(), args[1:]
+            name = ("UID " if uid else "") + command
+            with self.fake.lock:
+                self.fake.commands.append(name)
+                drop = self.fake.drops.get(name, 0) > 0
+                if drop:
+                    self.fake.drops[name] -= 1
+            if drop:
+                return
+            handler = getattr(self, f"cmd_{command.lower()}", None)
+            try:
+                if handler is None:
+                    raise _No(f"BAD unknown command {command}")
+                if command not in ("CAPABILITY", "NOOP", "LOGOUT", "LOGIN") and not self.authenticated:
+                    raise _No("NO not authenticated")
+                result = handler(args, uid) or "OK completed"
+            except _No as e:
+                result = str(e)
+            except Exception as e:
+                result = f"BAD {e}"
+            self.send(f"{tag} {result}\r\n")
+            if command == "LOGOUT":
+                return
+
+    # --- commands ---
+
+    def cmd_capability(self, args, uid):
+        self.untagged("CAPABILITY " + " ".join(self.fake.capabilities))
+
+    def cmd_noop(self, args, uid):
+        return None
+
+    def cmd_logout(self, args, uid):
+        self.untagged("BYE logging out")
+
+    def cmd_login(self, args, uid):
+        if len(args) != 2 or args[0] != self.fake.username or args[1] != self.fake.password:
+            raise _No("NO [AUTHENTICATIONFAILED] invalid credentials")
+        self.authenticated = True
+        return f"OK [CAPABILITY {' '.join(self.fake.capabilities)}] logged in"
+
+    def cmd_enable(self, args, uid):
+        enabled = [str(a).upper() for a in args if str(a).upper() in self.fake.capabilities]
+        if "QRESYNC" in enabled:
+            enabled.append("CONDSTORE")
+        self.enabled.update(enabled)
+        self.untagged("ENABLED " + " ".join(dict.fromkeys(enabled)))
+
+    def cmd_list(self, args, uid):
+        with self.fake.lock:
+            names = list(self.fake.folders)
+        for name in names:
+            # folder names travel in modified UTF-7 (RFC 3501 5.1.3)
+            self.untagged(f'LIST (\\HasNoChildren) "/" {_quote(imap_utf7.encode(name).decode("ascii"))}')
+
+    def cmd_select(self, args, uid, readonly=False):
+        with self.fake.lock:
+            folder = self.fake.folders.get(imap_utf7.decode(str(args[0]).encode("ascii")) if args else "")
+            if folder is None:
+                self.selected = None
+                raise _No("NO no such mailbox")
+            self.selected = folder.name
+            self.untagged("FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+            self.untagged("OK [PERMANENTFLAGS ()] read-only")
+            self.untagged(f"{len(folder.messages)} EXISTS")
+            self.untagged("0 RECENT")
+            self.untagged(f"OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid")
+            self.untagged(f"OK [UIDNEXT {folder.uidnext}] predicted next UID")
+            if "CONDSTORE" in self.fake.capabilities:
+                self.untagged(f"OK [HIGHESTMODSEQ {folder.highest_modseq}] highest")
+        return "OK [READ-ONLY] selected" if readonly else "OK [READ-WRITE] selected"
+
+    def cmd_examine(self, args, uid):
+        return self.cmd_select(args, uid, readonly=True)
+
+    def _folder(self) -> FakeFolder:
+        if not self.selected or self.selected not in self.fake.folders:
+            raise _No("BAD no mailbox selected")
+        return self.fake.folders[self.selected]
+
+    def cmd_search(self, args, uid):
+        with self.fake.lock:
+            folder = self._folder()
+            uids = folder.sorted_uids()
+            matches = list(enumerate(uids, start=1))
+            i = 0
+            while i < len(args):
+                key = str(args[i]).upper()
+                if key == "UID":
+                    ranges = _parse_set(str(args[i + 1]), uids[-1] if uids else 0)
+                    matches = [(seq, u) for seq, u in matches if _in_set(u, ranges)]
+                    i += 2
+                elif key == "ALL":
+                    i += 1
+                elif re.match(r"^[\d:*,]+$", key):
+                    ranges = _parse_set(key, len(uids))
+                    matches = [(seq, u) for seq, u in matches if _in_set(seq, ranges)]
+                    i += 1
+                else:
+                    raise _No(f"BAD unsupported search key {key}")
+        found = [u if uid else seq for seq, u in matches]
+        self.untagged("SEARCH" + "".join(f" {n}" for n in found))
+
+    def cmd_fetch(self, args, uid):
+        if len(args) < 2:
+            raise _No("BAD missing arguments")
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [str(i) for i in items]
+        modifiers = [str(m).upper() for m in (args[2] if len(args) > 2 and isinstance(args[2], list) else [])]
+        changed_since = None
+        vanished = False
+        for j, mod in enumerate(modifiers):
+            if mod == "CHANGEDSINCE":
+                changed_since = int(modifiers[j + 1])
+            elif mod == "VANISHED":
+                vanished = True
+        if vanished and ("QRESYNC" not in self.enabled or changed_since is None):
+            raise _No("BAD VANISHED needs QRESYNC and CHANGEDSINCE")
+        if changed_since is not None and "MODSEQ" not in [i.upper() for i in items]:
+            items.append("MODSEQ")
+
+        with self.fake.lock:
+            folder = self._folder()
+            uids = folder.sorted_uids()
+            if uid:
+                last = max(uids[-1] if uids else 0, folder.uidnext - 1)
+                ranges = _parse_set(str(args[0]), last)
+                if vanished:
+                    gone = sorted(u for u, modseq in folder.expunged if modseq > changed_since and _in_set(u, ranges))
+                    if gone:
+                        self.untagged("VANISHED (EARLIER) " + _format_set(gone))
+                selected = [(seq, u) for seq, u in enumerate(uids, start=1) if _in_set(u, ranges)]
+            else:
+                ranges = _parse_set(str(args[0]), len(uids))
+                selected = [(seq, u) for seq, u in enumerate(uids, start=1) if _in_set(seq, ranges)]
+            out = bytearray()
+            for seq, u in selected:
+                msg = folder.messages[u]
+                if changed_since is not None and msg.modseq <= changed_since:
+                    continue
+                out += _render_fetch(seq, msg, items)
+        self.send(bytes(out))
+
+class _No(Exception):
+    pass
+
+def _quote(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _tokenize(line: str) -> list:
+    """
+    Splits an IMAP command into atoms, quoted strings and nested lists.
+    Brackets stay inside their atom, e.g. BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)].
+    """
+    stack: List[list] = [[]]
+    pos = 0
+    while pos < len(line):
+        c = line[pos]
+        if c == " ":
+            pos += 1
+        elif c == "(":
+            stack.append([])
+            pos += 1
+        elif c == ")":
+            top = stack.pop()
+            stack[-1].append(top)
+            pos += 1
+        elif c == '"':
+            pos += 1
+            buf = []
+            while pos < len(line) and line[pos] != '"':
+                if line[pos] == "\\":
+                    pos += 1
+                buf.append(line[pos])
+                pos += 1
+            pos += 1
+            stack[-1].append("".join(buf))
+        else:
+            start = pos
+            depth = 0
+            while pos < len(line) and (depth or line[pos] not in " ()"):
+                if line[pos] == "[":
+                    depth += 1
+                elif line[pos] == "]":
+                    depth -= 1
+                pos += 1
+            stack[-1].append(line[start:pos])
+    while len(stack) > 1:
+        top = stack.pop()
+        stack[-1].append(top)
+    return stack[0]
+
+def _parse_set(text: str, star: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in text.split(","):
+        lo, _, hi = part.partition(":")
+        a = star if lo == "*" else int(lo)
+        b = a if not hi else (star if hi == "*" else int(hi))
+        ranges.append((min(a, b), max(a, b)))
+    return ranges
+
+def _in_set(n: int, ranges: List[Tuple[int, int]]) -> bool:
+    return any(lo <= n <= hi for lo, hi in ranges)
+
+def _format_set(nums: List[int]) -> str:
+    parts = []
+    start = prev = nums[0]
+    for n in nums[1:] + [None]:
+        if n is not None and n == prev + 1:
+            prev = n
+            continue
+        parts.append(str(start) if start == prev else f"{start}:{prev}")
+        if n is not None:
+            start = prev = n
+    return ",".join(parts)
+
+def _split_message(raw: bytes) -> Tuple[bytes, bytes]:
+    for sep in (b"\r\n\r\n", b"\n\n"):
+        i = raw.find(sep)
+        if i >= 0:
+            return raw[:i + len(sep)], raw[i + len(sep):]
+    return raw, b""
+
+def _header_fields(header: bytes, names: List[str], exclude: bool = False) -> bytes:
+    wanted = {n.upper() for n in names}
+    out = []
+    keep = False
+    for line in header.splitlines(keepends=True):
+        if line.strip() == b"":
+            continue
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                out.append(line)
+            continue
+        name = line.split(b":", 1)[0].decode("ascii", errors="replace").strip().upper()
+        keep = (name in wanted) != exclude
+        if keep:
+            out.append(line)
+    return b"".join(out) + b"\r\n"
+
+def _section(raw: bytes, section: str) -> bytes:
+    header, text = _split_message(raw)
+    upper = section.upper()
+    if upper == "":
+        return raw
+    if upper == "HEADER":
+        return header
+    if upper == "TEXT":
+        return text
+    m = re.match(r"^HEADER\.FIELDS(\.NOT)?\s*\((.*)\)$", section, re.I)
+    if m:
+        return _header_fields(header, m.group(2).split(), exclude=bool(m.group(1)))
+    raise _No(f"BAD unsupported section {section}")
+
+def _literal(key: str, data: bytes) -> bytes:
+    return f"{key} {{{len(data)}}}\r\n".encode() + data
+
+def _nstring(value) -> str:
+    # quoted strings can't span lines; folded header values are joined
+    return "NIL" if value is None else _quote(re.sub(r"\r?\n", "", str(value)))
+
+def _body_params(part: Message, header: str) -> str:
+    pairs = []
+    for k, v in (part.get_params(header=header) or [])[1:]:  # [0] is the type itself
+        if isinstance(v, tuple):
+            # RFC 2231 value, sent back as written: NAME* "charset'lang'%XX..."
+            charset, lang, text = v
+            k, v = f"{k}*", f"{charset or ''}'{lang or ''}'{quote(text.encode('latin-1', errors='replace'), safe='')}"
+        pairs.append(f"{_nstring(k.upper())} {_nstring(v)}")
+    return f"({' '.join(pairs)})" if pairs else "NIL"
+
+def _body_disposition(part: Message) -> str:
+    disposition = part.get_content_disposition()
+    if not disposition:
+        return "NIL"
+    return f"({_nstring(disposition.upper())} {_body_params(part, 'content-disposition')})"
+
+def _bodystructure(part: Message) -> str:
+    """
+    RFC 3501 BODYSTRUCTURE of a parsed message, with extension data but
+    without envelopes (NIL) or MD5s.
+    """
+    if part.get_content_maintype() == "multipart" and part.is_multipart():
+        children = "".join(_bodystructure(p) for p in part.get_payload())
+        return (
+            f"({children} {_nstring(part.get_content_subtype().upper())} "
+            f"{_body_params(part, 'content-type')} {_body_disposition(part)} NIL NIL)"
+        )
+    payload = part.get_payload()
+    inner = payload[0] if isinstance(payload, list) and payload else None
+    if inner is not None:
+        body = inner.as_bytes()
+    else:
+        body = str(payload or "").encode("ascii", errors="surrogateescape")
+    fields = [
+        _nstring(part.get_content_maintype().upper()),
+        _nstring(part.get_content_subtype().upper()),
+        _body_params(part, "content-type"),
+        _nstring(part.get("Content-ID")),
+        _nstring(part.get("Content-Description")),
+        _nstring((part.get("Content-Transfer-Encoding") or "7BIT").strip().upper()),
+        str(len(body)),
+    ]
+    lines = str(body.count(b"\n"))
+    if inner is not None:
+        fields += ["NIL", _bodystructure(inner), lines]
+    elif part.get_content_maintype() == "text":
+        fields.append(lines)
+    fields += ["NIL", _body_disposition(part), "NIL", "NIL"]
+    return f"({' '.join(fields)})"
+
+def _render_fetch(seq: int, msg: FakeMessage, items: List[str]) -> bytes:
+    parts: List[bytes] = [f"UID {msg.uid}".encode()]
+    for item in items:
+        upper = item.upper()
+        if upper == "UID":
+            continue
+        if upper == "FLAGS":
+            parts.append(f"FLAGS ({' '.join(msg.flags)})".encode())
+        elif upper == "INTERNALDATE":
+            parts.append(f'INTERNALDATE "{msg.internal_date.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode())
+        elif upper == "RFC822.SIZE":
+            parts.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+        elif upper == "MODSEQ":
+            parts.append(f"MODSEQ ({msg.modseq})".encode())
+        elif upper == "RFC822":
+            parts.append(_literal("RFC822", msg.raw))
+        elif upper == "RFC822.HEADER":
+            parts.append(_literal("RFC822.HEADER", _split_message(msg.raw)[0]))
+        elif upper == "BODYSTRUCTURE":
+            structure = _bodystructure(message_from_bytes(msg.raw, policy=policy.compat32))
+            parts.append(f"BODYSTRUCTURE {structure}".encode("utf-8", errors="surrogateescape"))
+        else:
+            m = _BODY_RE.match(item)
+            if not m:
+                raise _No(f"BAD unsupported fetch item {item}")
+            section = m.group("section")
+            data = _section(msg.raw, section)
+            key = f"BODY[{section.upper()}]"
+            if m.group("offset") is not None:
+                offset = int(m.group("offset"))
+                data = data[offset:offset + int(m.group("length"))]
+                key += f"<{offset}>"
+            parts.append(_literal(key, data))
+    return f"* {seq} FETCH (".encode() + b" ".join(parts) + b")\r\n"
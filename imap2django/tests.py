@@ -1,3 +1,1112 @@
-from django.test import TestCase
+import asyncio
+import base64
+import errno
+import imaplib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from types import SimpleNamespace
+from unittest import mock
+from bs4 import BeautifulSoup
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from imap2django.loaders.neo4j_loader import BATCH_CYPHER, CONSTRAINTS, Neo4jLoader, RecordingDriver, load_neo4j
+from imap2django.loaders.sql_loader import load_bodies_batch, load_sql_batch
+from imap2django.models import (
+    ArchiveFile, ImportCheckpoint, MailboxMessage, Message, MessageBody, Person, RebuildProgress, Recipient, Thread,
+)
+from imap2django.services.aio_imap import AsyncImapConnection
+from imap2django.services.attachment_store import AttachmentStore
+from imap2django.services import compression
+from imap2django.services.checkpoint import peek_relinking
+from imap2django.services import dedup
+from imap2django.services.dedup import upsert_message_and_relations, upsert_messages_bulk
+from imap2django.services.flag_sync import apply_flag_changes, collect_flag_changes
+from imap2django.services.html_text import html_to_text
+from imap2django.services.imap_client import AccountConfig, HEADER_ONLY_FIELDS, ImapClient, ImapConfig, ResilientImapClient
+from imap2django.services.import_session import ImportSession
+from imap2django.services.metrics import ImportProgress, Metrics
+from imap2django.services.normalizer import HeaderOnly, ImportItem, SpooledRaw, parse_and_normalize
+from imap2django.services import parser as parser_service
+from imap2django.services.parser import HeaderBlock, estimate_decoded_size
+from imap2django.services.person_cache import PersonCache
+from imap2django.services.pipeline import FetchOptions, FolderPlan, ImportPipeline, RawBatch, _refetch_missing, fetch_folder
+from imap2django.services.parse_pool import ParsePool
+from imap2django.services.raw_spool import RawSpool
+from imap2django.services.reprocess import reprocess_spool
+from imap2django.services.scheduler import ImportScheduler
+from imap2django.services import threading as threading_service
+from imap2django.testing.benchmark import STAGES, run_benchmark
+from imap2django.testing.corpus import CorpusSpec
+from imap2django.testing.fake_imap import DEFAULT_CAPABILITIES, FakeImapServer
 
-# Create your tests here.
+def _part(body: str, cte: str, newline: str = "\n"):
+    raw = f"Content-Type: text/plain; charset=utf-8\nContent-Transfer-Encoding: {cte}\n\n{body}"
+    return BytesParser(policy=policy.default).parsebytes(raw.replace("\n", newline).encode("utf-8"))
+
+def make_raw(i: int, subject: str = "Hello", in_reply_to: str = "", html: bool = False) -> bytes:
+    m = EmailMessage()
+    m["From"] = f"Alice <alice{i % 3}@example.com>"
+    m["To"] = "Bob <bob@example.com>, carol@example.com"
+    m["Subject"] = subject
+    m["Date"] = f"Mon, 1 Jan 2024 10:{i % 60:02d}:00 +0000"
+    m["Message-ID"] = f"<m{i}@example.com>"
+    if in_reply_to:
+        m["In-Reply-To"] = in_reply_to
+        m["References"] = in_reply_to
+    if html:
+        m.set_content(f"<html><body><p>Hi {i}</p></body></html>", subtype="html")
+    else:
+        m.set_content(f"body {i}")
+    return m.as_bytes()
+
+class EstimateDecodedSizeTests(SimpleTestCase):
+    def test_quoted_printable_soft_breaks(self):
+        body = "caf=C3=A9 and a soft =\nbroken line\nan =3D sign\n" * 20
+        for newline in ("\n", "\r\n"):
+            with self.subTest(newline=newline):
+                part = _part(body, "quoted-printable", newline)
+                self.assertEqual(estimate_decoded_size(part), len(part.get_payload(decode=True)))
+
+    def test_base64(self):
+        body = base64.encodebytes(bytes(range(256)) * 3 + b"xy").decode("ascii")
+        for newline in ("\n", "\r\n"):
+            with self.subTest(newline=newline):
+                part = _part(body, "base64", newline)
+                self.assertEqual(estimate_decoded_size(part), len(part.get_payload(decode=True)))
+
+HTML_SAMPLES = {
+    "malformed": "<html><body><p>Unclosed <b>bold <i>both</p><div>after</span> text<td>cell</table>&amp; &nbsp;end",
+    "script_style": (
+        "<head><style>p{color:red}</style><script>var x = '<p>no</p>';</script></head>"
+        "<body><p>Hi</p><template><p>t</p></template>\n\n<ruby>漢<rt>kan</rt></ruby></body>"
+    ),
+    "pre_textarea": "<p>a</p>   \n  <pre>  keep\n   spaces  </pre>\n \n<textarea>\n  x  y\n</textarea><p> </p>",
+    "comments_entities": "<!DOCTYPE html><!-- c --><p>x&lt;y &#233;</p><?pi x?><br/>tail",
+}
+
+class HtmlToTextTests(SimpleTestCase):
+    def _soup(self, html: str) -> str:
+        return BeautifulSoup(html, "lxml").get_text("\n")
+
+    def test_same_text_as_beautifulsoup(self):
+        for name, html in HTML_SAMPLES.items():
+            with self.subTest(name):
+                self.assertEqual(html_to_text(html), self._soup(html))
+
+    def test_over_limit(self):
+        # several feed chunks, cut at and between text nodes
+        html = "".join(f"<div><p>para {i}</p> <span>x</span></div>\n" for i in range(20000))
+        for limit in (1, 100, 1000, 65537):
+            with self.subTest(limit=limit):
+                self.assertEqual(html_to_text(html, limit), self._soup(html)[:limit])
+
+class PersonCacheTests(TestCase):
+    def test_fills_empty_display_name(self):
+        cache = PersonCache()
+        pk = cache.resolve([("a@example.com", "")])["a@example.com"]
+        cache.resolve([("a@example.com", "Alice")])
+        self.assertEqual(Person.objects.get(pk=pk).display_name, "Alice")
+
+    def test_keeps_name_set_by_another_process(self):
+        cache = PersonCache()
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = cache.resolve([("a@example.com", "")])["a@example.com"]
+        # another importer names the person after it was cached with an empty name
+        Person.objects.filter(pk=pk).update(display_name="Alice Smith")
+        with self.captureOnCommitCallbacks(execute=True):
+            cache.resolve([("a@example.com", "alice")])
+        self.assertEqual(Person.objects.get(pk=pk).display_name, "Alice Smith")
+        self.assertEqual(cache.entries["a@example.com"], (pk, "Alice Smith"))
+
+class Neo4jLoaderTests(SimpleTestCase):
+    def _item(self, i: int) -> ImportItem:
+        raw = make_raw(i)
+        return ImportItem(uid=i, flags=["\\Seen"], internal_date=None, normalized=parse_and_normalize(raw, len(raw)))
+
+    def test_batch_is_one_unwind_query(self):
+        driver = RecordingDriver()
+        with Neo4jLoader(driver=driver) as loader:
+            loader.load_batch("u@example.com", "fake", "INBOX", [self._item(1), self._item(2)])
+            loader.load_batch("u@example.com", "fake", "INBOX", [self._item(3)])
+        self.assertTrue(driver.closed)
+
+        # constraints once per loader, then one query per batch
+        self.assertEqual([cypher for cypher, _params in driver.queries[:len(CONSTRAINTS)]], CONSTRAINTS)
+        batches = driver.queries[len(CONSTRAINTS):]
+        self.assertEqual([cypher for cypher, _params in batches], [BATCH_CYPHER, BATCH_CYPHER])
+
+        params = batches[0][1]
+        self.assertEqual(params["account_email"], "u@example.com")
+        self.assertEqual(params["provider"], "fake")
+        self.assertEqual(params["mailbox_key"], "u@example.com:INBOX")
+        self.assertEqual(params["mailbox_name"], "INBOX")
+        self.assertEqual([row["uid"] for row in params["rows"]], [1, 2])
+        row = params["rows"][0]
+        self.assertEqual(row["message_id"], "<m1@example.com>")
+        self.assertEqual(row["flags"], ["\\Seen"])
+        self.assertEqual(row["sender"], [{"email": "alice1@example.com", "name": "Alice"}])
+        self.assertEqual(row["recipients"], [
+            {"email": "bob@example.com", "name": "Bob", "type": "to"},
+            {"email": "carol@example.com", "name": "", "type": "to"},
+        ])
+        self.assertTrue(row["thread_key"])
+
+    def test_load_neo4j_with_loader(self):
+        driver = RecordingDriver()
+        item = self._item(4)
+        load_neo4j(
+            loader=Neo4jLoader(driver=driver), account_email="u@example.com", mailbox_name="INBOX",
+            uid=item.uid, normalized=item.normalized,
+        )
+        self.assertEqual(driver.queries[-1][1]["rows"][0]["raw_sha256"], item.normalized.raw_sha256)
+
+class DeltaRebuildTests(TestCase):
+    def _message(self, mid: str, in_reply_to: str = "", references=(), subject: str = "topic") -> Message:
+        return Message.objects.create(
+            raw_sha256=mid.strip("<>").ljust(64, "0"), content_fingerprint="x", message_id=mid,
+            in_reply_to=in_reply_to, references_json=list(references), subject=subject, subject_norm=subject,
+        )
+
+    def test_delta_run_indexes_only_linked_messages(self):
+        root = self._message("<a1@x>")
+        reply = self._message("<a2@x>", "<a1@x>", ["<a1@x>"], "re: topic")
+        other = self._message("<b1@x>", subject="other")
+        threading_service.rebuild_threads()
+        root.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual(root.thread_id, reply.thread_id)
+
+        # truncated References: only In-Reply-To points at the reply
+        late = self._message("<a3@x>", "<a2@x>", [], "re: topic")
+        rows, pks = threading_service._jwz_delta_rows(Message.objects.filter(thread__isnull=True), 100)
+        self.assertEqual(pks, {late.pk})
+        self.assertEqual({row[0] for row in rows}, {root.pk, reply.pk, late.pk})
+        self.assertNotIn(other.pk, {row[0] for row in rows})
+
+        threading_service.rebuild_threads(unthreaded=True)
+        late.refresh_from_db()
+        self.assertEqual(late.thread_id, root.thread_id)
+
+    def test_import_joins_thread_of_stored_parent(self):
+        root = self._message("<a1@x>")
+        reply = self._message("<a2@x>", "<a1@x>", ["<a1@x>"], "re: topic")
+        threading_service.rebuild_threads()
+        root.refresh_from_db()
+
+        # References truncated to the parent: the header key alone would start a new thread
+        late = parse_and_normalize(make_raw(3, "re: topic", in_reply_to="<a2@x>"), 0)
+        early = parse_and_normalize(make_raw(4, "re: topic", in_reply_to="<m3@example.com>"), 0)
+        messages, _created = upsert_messages_bulk([(late, None), (early, None)], person_cache=PersonCache())
+        self.assertEqual(messages[late.raw_sha256].thread_id, root.thread_id)
+        self.assertEqual(messages[early.raw_sha256].thread_id, root.thread_id)
+
+    def test_resume_only_continues_the_same_scope(self):
+        first = self._message("<d1@x>")
+        second = self._message("<d2@x>", subject="other")
+        # an --unthreaded run killed after the first chunk
+        RebuildProgress.objects.create(name="threads", engine="jwz", unthreaded=True, last_id=first.pk, processed=1)
+        self.assertEqual(threading_service.rebuild_threads(unthreaded=True, resume=True), 2)
+        first.refresh_from_db()
+        self.assertIsNone(first.thread_id)
+
+        RebuildProgress.objects.filter(name="threads").update(
+            unthreaded=True, last_id=first.pk, processed=1, finished=False
+        )
+        self.assertEqual(threading_service.rebuild_threads(resume=True), 2)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertIsNotNone(first.thread_id)
+        self.assertIsNotNone(second.thread_id)
+
+    def test_import_threads_new_messages(self):
+        def load(*raws):
+            normalized = [parse_and_normalize(raw, len(raw)) for raw in raws]
+            messages, _created = upsert_messages_bulk(((n, None) for n in normalized), person_cache=PersonCache())
+            return [messages[n.raw_sha256].thread_id for n in normalized]
+
+        root, other = load(make_raw(1), make_raw(2, "Other"))
+        reply, reply_to_reply = load(
+            make_raw(3, "Re: Hello", in_reply_to="<m1@example.com>"),
+            make_raw(4, "Re: Hello", in_reply_to="<m3@example.com>"),
+        )
+        self.assertNotEqual(root, other)
+        self.assertEqual({reply, reply_to_reply}, {root})
+        self.assertEqual(Thread.objects.count(), 2)
+
+        # what the import assigned is what a full rebuild finds
+        threading_service.rebuild_threads()
+        self.assertEqual(RebuildProgress.objects.get(name="threads").changed, 0)
+
+    def test_delete_empty_threads(self):
+        msg = self._message("<c1@x>")
+        threading_service.rebuild_threads()
+        Thread.objects.create(thread_key="irt-era-key")
+        self.assertEqual(threading_service.delete_empty_threads(), 1)
+        self.assertTrue(Thread.objects.filter(messages=msg).exists())
+
+ACCOUNT = "u@example.com"
+
+class RetryableErrorTests(SimpleTestCase):
+    def _client(self) -> ResilientImapClient:
+        client = ResilientImapClient(ImapConfig(host="imap.invalid"), retries=0)
+        client.client = SimpleNamespace(shutdown=lambda: None)  # already connected
+        return client
+
+    def _fail(self, error: Exception):
+        raise error
+
+    def test_socket_errors_drop_the_connection(self):
+        for error in (ConnectionResetError(), TimeoutError(), EOFError()):
+            client = self._client()
+            with self.assertRaises(type(error)):
+                client._retry(self._fail, error)
+            self.assertIsNone(client.client)
+
+    def test_local_os_errors_are_not_retried(self):
+        client = self._client()
+        with self.assertRaises(OSError):
+            client._retry(self._fail, OSError(errno.ENOSPC, "No space left on device"))
+        self.assertIsNotNone(client.client)
+
+class FolderSessionTests(TestCase):
+    def test_save_touches_updated_at(self):
+        folder = ImportSession().folder(ACCOUNT, "fake", "INBOX")
+        before = ImportCheckpoint.objects.get(pk=folder.checkpoint.pk).updated_at
+        with self.captureOnCommitCallbacks(execute=True):
+            folder.advance(10)
+        checkpoint = ImportCheckpoint.objects.get(pk=folder.checkpoint.pk)
+        self.assertEqual(checkpoint.last_uid, 10)
+        self.assertGreater(checkpoint.updated_at, before)
+
+class LoadSqlBatchTests(TestCase):
+    def _items(self, uids, html: bool = False):
+        items = []
+        for uid in uids:
+            raw = make_raw(uid, html=html)
+            items.append(ImportItem(uid, ["\\Seen"], None, parse_and_normalize(raw, len(raw))))
+        return items
+
+    def _load(self, folder, items):
+        with self.captureOnCommitCallbacks(execute=True):
+            load_sql_batch(ACCOUNT, "fake", "INBOX", items, person_cache=PersonCache(), folder=folder)
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        folder = ImportSession().folder(ACCOUNT, "fake", "INBOX")
+        with CaptureQueriesContext(connection) as small:
+            self._load(folder, self._items(range(1, 3)))
+        with CaptureQueriesContext(connection) as large:
+            self._load(folder, self._items(range(3, 23)))
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(Message.objects.count(), 22)
+
+    def test_rerun_is_idempotent(self):
+        folder = ImportSession().folder(ACCOUNT, "fake", "INBOX")
+        items = self._items(range(1, 5), html=True)
+        self._load(folder, items)
+        counts = [model.objects.count() for model in (Message, MessageBody, MailboxMessage, Recipient, Person, Thread)]
+        self._load(folder, items)
+        self.assertEqual(
+            [model.objects.count() for model in (Message, MessageBody, MailboxMessage, Recipient, Person, Thread)],
+            counts,
+        )
+        self.assertEqual(folder.last_uid, 4)
+
+    def test_checkpoint_commits_with_the_batch(self):
+        folder = ImportSession().folder(ACCOUNT, "fake", "INBOX")
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                load_sql_batch(ACCOUNT, "fake", "INBOX", self._items([1, 2]), person_cache=PersonCache(), folder=folder)
+                self.assertEqual(ImportCheckpoint.objects.get(pk=folder.checkpoint.pk).last_uid, 2)
+                raise RuntimeError("writer died before commit")
+        self.assertEqual(ImportCheckpoint.objects.get(pk=folder.checkpoint.pk).last_uid, 0)
+        self.assertEqual(folder.last_uid, 0)
+        self.assertFalse(Message.objects.exists())
+
+class FlagSyncTests(TestCase):
+    def _server(self, capabilities=DEFAULT_CAPABILITIES) -> FakeImapServer:
+        server = FakeImapServer(capabilities=capabilities).start()
+        self.addCleanup(server.stop)
+        for i in range(1, 6):
+            server.append("INBOX", make_raw(i), flags=["\\Seen"] if i % 2 else [])
+        return server
+
+    def _import_all(self, server: FakeImapServer):
+        self.session = ImportSession()
+        folder = self.session.folder(ACCOUNT, "fake", "INBOX")
+        items = []
+        for uid, m in sorted(server.folders["INBOX"].messages.items()):
+            items.append(ImportItem(uid, list(m.flags), None, parse_and_normalize(m.raw, len(m.raw))))
+        with self.captureOnCommitCallbacks(execute=True):
+            load_sql_batch(ACCOUNT, "fake", "INBOX", items, person_cache=PersonCache(), folder=folder)
+
+    def _sync(self, server: FakeImapServer, io: str = "sync"):
+        with ImapClient(server.imap_config(), sync=True, io=io) as imap:
+            state = imap.select_folder("INBOX")
+            changes = collect_flag_changes(imap, ACCOUNT, "INBOX", state)
+        if changes is None:
+            return None, (0, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            result = apply_flag_changes(self.session.folder(ACCOUNT, "fake", "INBOX"), changes)
+        return changes, result
+
+    def _flags(self):
+        return dict(MailboxMessage.objects.filter(mailbox__name="INBOX").values_list("uid", "flags_json"))
+
+    def _stored_modseq(self) -> int:
+        return ImportCheckpoint.objects.get(account__email=ACCOUNT, mailbox_name="INBOX").highest_modseq
+
+    def test_first_sync_is_full_pass_and_stores_highest_modseq(self):
+        server = self._server()
+        self._import_all(server)
+        changes, _result = self._sync(server)
+        self.assertTrue(changes.full)
+        self.assertEqual(self._stored_modseq(), server.folders["INBOX"].highest_modseq)
+
+        # nothing changed since: no command beyond SELECT
+        changes, _result = self._sync(server)
+        self.assertIsNone(changes)
+
+    def test_changedsince_flag_update(self):
+        server = self._server()
+        self._import_all(server)
+        self._sync(server)
+        server.set_flags("INBOX", 2, ["\\Flagged"])
+
+        changes, (updated, removed) = self._sync(server)
+        self.assertFalse(changes.full)
+        self.assertEqual(set(changes.flags), {2})
+        self.assertEqual((updated, removed), (1, 0))
+        self.assertEqual(self._flags()[2], ["\\Flagged"])
+        self.assertEqual(self._stored_modseq(), server.folders["INBOX"].highest_modseq)
+
+    def _qresync_vanished(self, io: str):
+        server = self._server()
+        self._import_all(server)
+        self._sync(server, io)
+        server.expunge("INBOX", [3])
+        server.commands.clear()
+
+        changes, (updated, removed) = self._sync(server, io)
+        self.assertEqual(changes.vanished, [3])
+        self.assertEqual(removed, 1)
+        self.assertNotIn(3, self._flags())
+        self.assertNotIn("UID SEARCH", server.commands)  # VANISHED, no UID diff
+        self.assertEqual(self._stored_modseq(), server.folders["INBOX"].highest_modseq)
+
+    def test_qresync_vanished_expunge(self):
+        self._qresync_vanished("sync")
+
+    def test_qresync_vanished_expunge_async(self):
+        self._qresync_vanished("async")
+
+    def test_condstore_without_qresync_diffs_uids(self):
+        server = self._server(("IMAP4rev1", "ENABLE", "CONDSTORE"))
+        self._import_all(server)
+        self._sync(server)
+        server.expunge("INBOX", [4])
+        server.commands.clear()
+
+        changes, (_updated, removed) = self._sync(server)
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.vanished, [4])
+        self.assertEqual(removed, 1)
+        self.assertIn("UID SEARCH", server.commands)
+
+    def test_condstore_expunge_without_modseq_change(self):
+        server = self._server(("IMAP4rev1", "ENABLE", "CONDSTORE"))
+        self._import_all(server)
+        self._sync(server)
+        server.expunge("INBOX", [2])
+        server.folders["INBOX"].highest_modseq -= 1  # servers need not bump it on expunge
+        server.commands.clear()
+
+        changes, (_updated, removed) = self._sync(server)
+        self.assertEqual(changes.vanished, [2])
+        self.assertEqual(removed, 1)
+        self.assertNotIn("UID FETCH", server.commands)
+
+        # counts match again: nothing to ask
+        self.assertIsNone(self._sync(server)[0])
+
+    def test_full_pass_without_condstore(self):
+        server = self._server(("IMAP4rev1",))
+        self._import_all(server)
+        server.set_flags("INBOX", 1, [])
+        server.expunge("INBOX", [5])
+
+        changes, (updated, removed) = self._sync(server)
+        self.assertTrue(changes.full)
+        self.assertEqual(sorted(changes.flags), [1, 2, 3, 4])
+        self.assertEqual((updated, removed), (1, 1))
+        self.assertEqual(self._flags()[1], [])
+        self.assertEqual(self._stored_modseq(), 0)
+
+class ImportSchedulerTests(TransactionTestCase):
+    # the scheduler's worker threads use their own DB connections
+    def _server(self, host: str, messages: int = 4) -> FakeImapServer:
+        server = FakeImapServer(host=host, latency=0.01).start()
+        self.addCleanup(server.stop)
+        for i in range(1, messages + 1):
+            server.append("INBOX", make_raw(i))
+        return server
+
+    def _account(self, server: FakeImapServer, name: str) -> AccountConfig:
+        return AccountConfig(name, "fake", server.imap_config())
+
+    def _run(self, scheduler: ImportScheduler) -> dict:
+        fetched = {}
+        with ParsePool() as pool:
+            for batch in ImportPipeline(pool).run(scheduler.producers()):
+                if batch.items:
+                    fetched[batch.account_email] = fetched.get(batch.account_email, 0) + len(batch.items)
+        return fetched
+
+    def test_per_host_connection_limit(self):
+        servers = [self._server("127.0.0.1"), self._server("127.0.0.2")]
+        accounts = [self._account(servers[i % 2], f"u{i}@example.com") for i in range(6)]
+        lock = threading.Lock()
+        open_now: dict = {}
+        peak: dict = {}
+
+        class Counting(ResilientImapClient):
+            def __enter__(self):
+                with lock:
+                    open_now[self.cfg.host] = open_now.get(self.cfg.host, 0) + 1
+                    peak[self.cfg.host] = max(peak.get(self.cfg.host, 0), open_now[self.cfg.host])
+                return super().__enter__()
+
+            def __exit__(self, *exc):
+                with lock:
+                    open_now[self.cfg.host] -= 1
+                return super().__exit__(*exc)
+
+        scheduler = ImportScheduler(accounts, FetchOptions(batch_size=2), connections=4, per_host=1)
+        with mock.patch("imap2django.services.scheduler.ResilientImapClient", Counting):
+            fetched = self._run(scheduler)
+        self.assertEqual(fetched, {acc.account_email: 4 for acc in accounts})
+        self.assertEqual(peak, {"127.0.0.1": 1, "127.0.0.2": 1})
+        self.assertEqual(scheduler.failures, [])
+
+    def test_retryable_error_requeues_the_job(self):
+        server = self._server("127.0.0.1")
+        server.drop_on("UID FETCH", 2)
+        logged = []
+        scheduler = ImportScheduler(
+            [self._account(server, ACCOUNT)], FetchOptions(batch_size=2), retries=0, job_retries=2, log=logged.append,
+        )
+        self.assertEqual(self._run(scheduler), {ACCOUNT: 4})
+        self.assertEqual(scheduler.failures, [])
+        self.assertEqual(sum("re-queued" in line for line in logged), 2)
+
+        server.drop_on("UID FETCH", 3)
+        scheduler = ImportScheduler(
+            [self._account(server, ACCOUNT)], FetchOptions(batch_size=2), retries=0, job_retries=2, log=logged.append,
+        )
+        self.assertEqual(self._run(scheduler), {})
+        self.assertEqual([(acc, folder) for acc, folder, _error in scheduler.failures], [(ACCOUNT, "INBOX")])
+
+class UidValidityRelinkTests(TransactionTestCase):
+    # the scheduler's worker threads use their own DB connections
+    def _import(self, server: FakeImapServer, *args) -> str:
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"account_email": ACCOUNT, "provider": "fake", "imap": {
+                "host": server.host, "port": server.port, "ssl": False,
+                "username": server.username, "password": server.password, "timeout": 5,
+            }}, f)
+        out = io.StringIO()
+        call_command("import_imap", f"--config={f.name}", "--batch=2", *args, stdout=out)
+        return out.getvalue()
+
+    def test_interrupted_relink_is_continued(self):
+        server = FakeImapServer().start()
+        self.addCleanup(server.stop)
+        for i in range(1, 7):
+            server.append("INBOX", make_raw(i))
+        self._import(server)
+        server.reset_uidvalidity("INBOX")
+        server.expunge("INBOX", [1])
+
+        # the run that notices the reset dies (retries used up) before the re-link pass is written
+        server.drop_on("UID FETCH", 3)
+        with self.assertRaises(CommandError):
+            self._import(server, "--retries=0")
+        self.assertTrue(peek_relinking(ACCOUNT, "INBOX"))
+
+        out = self._import(server)
+        self.assertIn("re-link after UIDVALIDITY reset complete", out)
+        self.assertFalse(peek_relinking(ACCOUNT, "INBOX"))
+        self.assertEqual(Message.objects.count(), 6)
+        self.assertEqual(
+            sorted(MailboxMessage.objects.values_list("uid", "message__message_id")),
+            [(uid, f"<m{uid}@example.com>") for uid in range(2, 7)],
+        )
+
+class _Writer:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data: bytes):
+        self.lines.append(data)
+
+    async def drain(self):
+        pass
+
+class AsyncResponseRoutingTests(SimpleTestCase):
+    async def _out_of_order(self):
+        conn = AsyncImapConnection("imap.invalid", 143, ssl=False, timeout=5)
+        conn.reader, conn.writer = asyncio.StreamReader(), _Writer()
+        conn.task = asyncio.ensure_future(conn._read_responses())
+        first = asyncio.ensure_future(conn.command("UID", b"FETCH", b"1,2", b"(FLAGS)", uids=frozenset({1, 2})))
+        second = asyncio.ensure_future(conn.command("UID", b"FETCH", b"3", b"(FLAGS)", uids=frozenset({3})))
+        await asyncio.sleep(0)
+        conn.reader.feed_data(
+            b"* 3 FETCH (UID 3 FLAGS ())\r\n"
+            b"* 1 FETCH (UID 1 FLAGS (\\Seen))\r\n"
+            b"A0002 OK done\r\n"
+            b"* 2 FETCH (FLAGS () UID 2)\r\n"
+            b"A0001 OK done\r\n"
+        )
+        try:
+            return await first, await second
+        finally:
+            conn.task.cancel()
+
+    def test_fetch_responses_follow_uids_and_tags(self):
+        first, second = asyncio.run(self._out_of_order())
+        self.assertEqual(first["FETCH"], [b"1 (UID 1 FLAGS (\\Seen))", b"2 (FLAGS () UID 2)"])
+        self.assertEqual(second["FETCH"], [b"3 (UID 3 FLAGS ())"])
+
+    async def _silent_greeting(self):
+        # accepts the connection but never sends a greeting
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        conn = AsyncImapConnection("127.0.0.1", port, ssl=False, timeout=0.2)
+        try:
+            async with server:
+                await conn.connect()
+        except asyncio.TimeoutError:
+            return "timed out"
+        finally:
+            await conn.close()
+
+    def test_silent_server_times_out_on_connect(self):
+        # the outer limit only guards against a hang; it cancels rather than timing out inside
+        self.assertEqual(asyncio.run(asyncio.wait_for(self._silent_greeting(), 5)), "timed out")
+
+class RefetchMissingTests(SimpleTestCase):
+    def _imap(self, refetched, listed):
+        return SimpleNamespace(fetch_batch=lambda uids, data=None: refetched, search_uids_upto=lambda max_uid: listed)
+
+    def test_refetches_then_skips_expunged(self):
+        imap = self._imap({2: {b"RFC822": b"x"}}, [1, 2])
+        fetched = _refetch_missing(imap, [1, 2, 3], {1: {b"RFC822": b"x"}})
+        self.assertEqual(sorted(fetched), [1, 2])
+
+    def test_missing_but_listed_is_an_error(self):
+        imap = self._imap({}, [1, 2, 3])
+        with self.assertRaises(imaplib.IMAP4.abort):
+            _refetch_missing(imap, [1, 2, 3], {1: {b"RFC822": b"x"}})
+
+class LargeMessageTests(SimpleTestCase):
+    def test_expunged_large_message_is_skipped(self):
+        server = FakeImapServer().start()
+        self.addCleanup(server.stop)
+        for i in range(1, 4):
+            server.append("INBOX", make_raw(i))
+        plan = FolderPlan(ACCOUNT, "fake", "INBOX", 0, [1, 2, 3])
+        server.expunge("INBOX", [2])  # between the search that planned it and the fetch
+        batches = []
+        with ImapClient(server.imap_config()) as imap:
+            imap.fetch_sizes = lambda uids: {uid: 10_000 for uid in uids}  # as listed before the expunge
+            opts = FetchOptions(batch_size=10, large_bytes=1000, chunk_bytes=64)
+            self.assertTrue(fetch_folder(imap, plan, opts, lambda batch: batches.append(batch) or True))
+        rows = [row for batch in batches for row in batch.rows]  # one batch per large message
+        self.addCleanup(lambda: [os.unlink(row[1].path) for row in rows])
+        self.assertEqual([row[0] for row in rows], [1, 3])
+        for uid, spooled, _flags, _date, _size in rows:
+            with open(spooled.path, "rb") as f:
+                self.assertEqual(f.read(), server.folders["INBOX"].messages[uid].raw)
+
+class SyncAsyncFetchTests(SimpleTestCase):
+    def test_same_results(self):
+        server = FakeImapServer().start()
+        self.addCleanup(server.stop)
+        for i in range(1, 13):
+            server.append("INBOX", make_raw(i, html=i % 4 == 0), flags=["\\Seen"] if i % 2 else [])
+        batches = [[1, 2, 3], [4, 5], [6, 7, 8, 9], [10], [11, 12]]
+        results = {}
+        for io_mode in ("sync", "async"):
+            with ImapClient(server.imap_config(), io=io_mode) as imap:
+                imap.select_folder("INBOX")
+                results[io_mode] = (
+                    list(imap.fetch_batches(batches, window=3)),
+                    list(imap.fetch_batches(batches, window=3, data=HEADER_ONLY_FIELDS)),
+                    imap.fetch_flags(12),
+                )
+        self.assertEqual(results["sync"], results["async"])
+        self.assertEqual([sorted(r) for r in results["async"][0]], batches)
+
+class PrefetchTests(TestCase):
+    def test_known_messages_are_linked_without_fetching_bodies(self):
+        server = FakeImapServer().start()
+        self.addCleanup(server.stop)
+        raws = {server.append("INBOX", make_raw(i), flags=["\\Seen"]): make_raw(i) for i in range(1, 7)}
+        stored, _created = upsert_messages_bulk(
+            ((parse_and_normalize(raws[uid], len(raws[uid])), None) for uid in (1, 2, 5)), person_cache=PersonCache()
+        )
+        batches = []
+        with ImapClient(server.imap_config()) as imap, mock.patch.object(imap, "fetch_batch", wraps=imap.fetch_batch) as fetch:
+            plan = FolderPlan(ACCOUNT, "fake", "INBOX", 0, sorted(raws))
+            self.assertTrue(fetch_folder(imap, plan, FetchOptions(batch_size=3, prefetch=True), lambda b: batches.append(b) or True))
+        self.assertEqual([call.args[0] for call in fetch.call_args_list], [[3], [4, 6]])
+
+        links = [link for batch in batches for link in batch.links]
+        pks = {uid: stored[parse_and_normalize(raws[uid], 0).raw_sha256].pk for uid in (1, 2, 5)}
+        self.assertEqual(links, [(uid, pks[uid], ["\\Seen"]) for uid in (1, 2, 5)])
+        self.assertEqual([row[0] for batch in batches for row in batch.rows], [3, 4, 6])
+
+class MaildirResumeTests(TransactionTestCase):
+    def _deliver(self, maildir: str, name: str, i: int) -> str:
+        path = os.path.join(maildir, "cur", f"{name}:2,S")
+        with open(path, "wb") as f:
+            f.write(make_raw(i))
+        return path
+
+    def _import(self, maildir: str) -> str:
+        out = io.StringIO()
+        call_command("import_archive", maildir, f"--account={ACCOUNT}", "--mailbox=INBOX", "--batch=2", stdout=out)
+        return out.getvalue()
+
+    def _message_ids(self):
+        return sorted(MailboxMessage.objects.values_list("message__message_id", flat=True))
+
+    def test_deleted_and_earlier_files_skip_nothing(self):
+        maildir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, maildir)
+        os.mkdir(os.path.join(maildir, "cur"))
+        os.mkdir(os.path.join(maildir, "new"))
+        paths = [self._deliver(maildir, f"17000000{i:02d}.M{i}.host", i) for i in range(1, 6)]
+        self._import(maildir)
+        self.assertEqual(len(self._message_ids()), 5)
+
+        # a file that sorts first is added, an early one deleted, one marked flagged
+        os.unlink(paths[0])
+        self._deliver(maildir, "1600000000.M0.host", 6)
+        os.rename(paths[1], paths[1].replace(":2,S", ":2,FS"))
+        self._import(maildir)
+        self.assertEqual(self._message_ids(), [f"<m{i}@example.com>" for i in range(1, 7)])
+        self.assertEqual(MailboxMessage.objects.count(), 6)
+        self.assertEqual(ArchiveFile.objects.count(), 6)
+        self.assertEqual(ImportCheckpoint.objects.get().last_uid, 0)
+
+class MboxResumeTests(TransactionTestCase):
+    def _write(self, path: str, numbers):
+        with open(path, "wb") as f:
+            for i in numbers:
+                raw = make_raw(i, subject="Hello" + "!" * i)
+                if i == 1:
+                    raw += b"filler line\n" * 7000  # the first message covers the fingerprinted head
+                f.write(b"From alice@example.com Mon Jan  1 10:00:00 2024\n" + raw + b"\n")
+
+    def _import(self, path: str) -> str:
+        out = io.StringIO()
+        call_command("import_archive", path, f"--account={ACCOUNT}", "--mailbox=INBOX", "--batch=2", stdout=out)
+        return out.getvalue()
+
+    def test_rewritten_mbox_starts_over(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "All mail.mbox")
+        self._write(path, [1, 2, 3])
+        self._import(path)
+
+        # appended to: resumes at the stored offset
+        self._write(path, [1, 2, 3, 4])
+        self.assertNotIn("starting over", self._import(path))
+
+        # message 2 deleted, 5 appended: same head, but the offsets moved
+        self._write(path, [1, 3, 4, 5])
+        self.assertIn("starting over", self._import(path))
+        self.assertEqual(
+            sorted(MailboxMessage.objects.values_list("message__message_id", flat=True)),
+            [f"<m{i}@example.com>" for i in (1, 3, 4, 5)],
+        )
+
+class BenchmarkTests(TestCase):
+    def test_tiny_corpus_report(self):
+        report = run_benchmark(CorpusSpec(messages=20), batch_size=8)
+        json.dumps(report)
+        stages, corpus = report["stages"], report["corpus"]
+        self.assertEqual(list(stages), list(STAGES))
+        self.assertEqual(corpus["messages"], 20)
+        self.assertGreaterEqual(corpus["stored"], 20)  # duplicates come on top
+        for name in ("fetch", "parse_rfc822", "normalize", "load_sql"):
+            self.assertEqual(stages[name]["messages"], corpus["stored"], name)
+            self.assertEqual(stages[name]["bytes"], corpus["stored_bytes"], name)
+        self.assertEqual(stages["rebuild_threads"]["messages"], 20)
+        self.assertGreater(stages["load_sql"]["queries"], 0)
+        self.assertEqual(stages["fetch"]["queries"], 0)
+        self.assertEqual(Message.objects.count(), 20)
+        self.assertEqual(MailboxMessage.objects.count(), corpus["stored"])
+
+class MetricsTests(TestCase):
+    def test_nested_stages_are_subtracted(self):
+        metrics = Metrics()
+        with metrics.measure("load", messages=3):
+            Message.objects.count()
+            with metrics.measure("dedup"):
+                Message.objects.count()
+                Message.objects.exists()
+                time.sleep(0.05)
+            Message.objects.exists()
+        load, dedup = metrics.stages["load"], metrics.stages["dedup"]
+        self.assertEqual((load.queries, dedup.queries), (2, 2))
+        self.assertGreaterEqual(dedup.seconds, 0.05)
+        self.assertLess(load.seconds, dedup.seconds)
+        self.assertEqual((load.messages, load.calls, dedup.calls), (3, 1, 1))
+
+    def test_failing_stage_is_recorded_and_closed(self):
+        metrics = Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.measure("load"):
+                Message.objects.count()
+                raise ValueError("bad batch")
+        self.assertEqual((metrics.stages["load"].calls, metrics.stages["load"].queries), (1, 1))
+        self.assertEqual(metrics._open, [])
+
+        # an error entering the query counter is raised as is
+        with mock.patch("imap2django.services.metrics.QueryCounter.__enter__", side_effect=RuntimeError("no db")):
+            with self.assertRaises(RuntimeError):
+                with metrics.measure("load"):
+                    pass
+        self.assertEqual(metrics._open, [])
+
+    def test_progress_remaining(self):
+        progress = ImportProgress()
+        progress.plan(("u", "INBOX"), 0, [3, 1, 2, 10, 11])
+        progress.plan(("u", "Sent"), 5, [6, 7, 9])
+        self.assertEqual(progress.remaining(), 8)
+        progress.advance(("u", "INBOX"), 3, 3, 300)
+        progress.advance(("u", "Sent"), 9, 3, 300)
+        self.assertEqual(progress.remaining(), 2)
+        progress.advance(("u", "INBOX"), 2, 0, 0)  # never moves back
+        self.assertEqual(progress.remaining(), 2)
+        self.assertEqual(progress.messages, 6)
+        self.assertIn("2 to go", progress.line())
+
+class CompressionTests(SimpleTestCase):
+    def test_level_is_honored(self):
+        data = b"".join(b"line %d of a body that compresses\n" % i for i in range(2000))
+        for level in (1, 9):
+            codec, packed = compression.compress(data, level)
+            if codec == compression.ZSTD:
+                expected = compression.zstandard_module().ZstdCompressor(level=level).compress(data)
+            else:
+                expected = zlib.compress(data, level)
+            self.assertEqual(packed, expected)
+            self.assertEqual(compression.decompress(codec, packed), data)
+
+    def test_raw_spool_round_trip(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        raw = make_raw(1)
+        with RawSpool(root, level=1) as spool:
+            self.assertEqual(spool.put_many([("ab" * 32, raw)]), 1)
+            self.assertEqual(spool.get("ab" * 32), raw)
+
+    def test_raw_spool_shared_between_instances(self):
+        # two processes appending to one spool must not overwrite each other's records
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        raws = {"%064x" % i: make_raw(i) for i in range(6)}
+        items = list(raws.items())
+        with RawSpool(root, segment_bytes=4096, level=1) as a, RawSpool(root, segment_bytes=4096, level=1) as b:
+            for i, item in enumerate(items):
+                (a if i % 3 != 1 else b).put_many([item])
+        with RawSpool(root) as spool:
+            self.assertEqual(spool.count(), len(raws))
+            for sha, raw in raws.items():
+                self.assertEqual(spool.get(sha), raw)
+
+class ParsePoolTests(SimpleTestCase):
+    def test_workers_match_inline_parsing(self):
+        raws = [make_raw(i, html=i % 3 == 0) for i in range(1, 13)]
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(raws[0])
+        jobs = [(raw, len(raw)) for raw in raws]
+        expected = [parse_and_normalize(raw, len(raw)) for raw in raws]
+
+        with ParsePool(workers=2) as pool:
+            self.assertIsNotNone(pool.executor)
+            parsed = pool.map(jobs + [(SpooledRaw(path, len(raws[0])), len(raws[0]))])
+            self.assertEqual(set(pool.timings), {"parse", "normalize"})
+        self.assertEqual(parsed, expected + expected[:1])
+        self.assertFalse(os.path.exists(path))  # spool files are removed once parsed
+        with ParsePool() as pool:
+            self.assertEqual(pool.map(jobs), expected)
+
+class ImportPipelineTests(SimpleTestCase):
+    def _batch(self, uid: int) -> RawBatch:
+        raw = make_raw(uid)
+        return RawBatch(ACCOUNT, "fake", "INBOX", [uid], [(uid, raw, [], None, len(raw))])
+
+    def _drain(self, pipeline: ImportPipeline, producers, consume):
+        # runs the pipeline on a helper thread so a deadlock fails the test instead of hanging it
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = consume(pipeline.run(producers))
+            except BaseException as e:
+                outcome["error"] = e
+
+        worker = threading.Thread(target=target, daemon=True)
+        worker.start()
+        worker.join(10)
+        self.assertFalse(worker.is_alive(), "pipeline deadlocked")
+        return outcome
+
+    def test_producer_error_is_raised_while_queues_are_full(self):
+        def failing(emit, stop):
+            for uid in range(1, 6):
+                emit(self._batch(uid))
+            raise imaplib.IMAP4.error("boom")
+
+        def steady(emit, stop):
+            for uid in range(100, 200):
+                if not emit(self._batch(uid)):
+                    return
+
+        with ParsePool() as pool:
+            outcome = self._drain(ImportPipeline(pool, depth=1), [failing, steady], list)
+        self.assertIsInstance(outcome.get("error"), imaplib.IMAP4.error)
+
+    def test_parse_error_is_raised(self):
+        def producer(emit, stop):
+            for uid in range(1, 50):
+                if not emit(self._batch(uid)):
+                    return
+
+        with ParsePool() as pool, mock.patch.object(pool, "map", side_effect=ValueError("bad message")):
+            outcome = self._drain(ImportPipeline(pool, depth=1), [producer], list)
+        self.assertIsInstance(outcome.get("error"), ValueError)
+
+    def test_consumer_stopping_early_releases_producers(self):
+        refused = []
+
+        def producer(emit, stop):
+            for uid in range(1, 100):
+                if not emit(self._batch(uid)):
+                    refused.append(uid)
+                    return
+
+        def first_two(batches):
+            taken = []
+            for batch in batches:
+                taken.append(batch.uids[0])
+                if len(taken) == 2:
+                    batches.close()  # what leaving a for loop early does to the generator
+                    return taken
+            return taken
+
+        with ParsePool() as pool:
+            outcome = self._drain(ImportPipeline(pool, depth=1), [producer], first_two)
+        self.assertEqual(outcome.get("result"), [1, 2])
+        self.assertEqual(len(refused), 1)
+
+class AttachmentStoreTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.store = AttachmentStore(root)
+
+    def _files(self):
+        return sorted(
+            os.path.relpath(os.path.join(d, f), self.store.root)
+            for d, _dirs, files in os.walk(self.store.root) for f in files
+        )
+
+    def test_same_payload_is_written_once(self):
+        passes = []
+
+        def chunks():
+            passes.append(1)
+            return [b"%PDF-1.4 ", b"x" * 1000]
+
+        first = self.store.put(chunks)
+        self.assertEqual(len(passes), 2)  # hash, then write
+        self.assertEqual(self.store.put(chunks), first)
+        self.assertEqual(len(passes), 3)  # already stored: hashed only
+        sha, size, url = first
+        self.assertEqual((size, self._files()), (1009, [os.path.join(sha[:2], sha[2:4], sha)]))
+        self.assertEqual(self.store.path_for(sha).read_bytes(), b"%PDF-1.4 " + b"x" * 1000)
+        self.assertTrue(url.startswith("file://"))
+
+    def test_failed_write_leaves_nothing_behind(self):
+        calls = []
+
+        def broken():
+            calls.append(1)
+            yield b"part one"
+            if len(calls) == 2:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            yield b"part two"
+
+        with self.assertRaises(OSError):
+            self.store.put(broken)
+        self.assertEqual(self._files(), [])
+
+    def test_payload_changing_between_passes_is_refused(self):
+        payloads = iter([[b"first"], [b"second"]])
+        with self.assertRaises(IOError):
+            self.store.put(lambda: next(payloads))
+        self.assertEqual(self._files(), [])
+
+class HeaderBlockTests(SimpleTestCase):
+    HEADERS = (
+        b"From alice@example.com Mon Jan  1 10:00:00 2024\n"
+        b"Received: from mx.example.com\n"
+        b"From: =?utf-8?q?J=C3=BCrgen_M=C3=BCller?= <juergen@example.com>\n"
+        b"To: Bob <bob@example.com>,\n"
+        b"\t\"Doe, Carol\" <carol@example.com> (work)\n"
+        b"To: dave@example.com\n"
+        b"Cc: undisclosed-recipients:;\n"
+        b"Subject: =?iso-8859-1?q?Gr=FC=DFe?= aus\n"
+        b" =?utf-8?b?TcO8bmNoZW4=?= and a long\n"
+        b"  folded tail\n"
+        b"Date: Mon, 1 Jan 2024 10:00:00 +0100 (CET)\n"
+        b"Message-ID:\n"
+        b" <folded.id@example.com>\n"
+        b"In-Reply-To: <parent@example.com>\n"
+        b"References: <root@example.com>\n"
+        b"\t<parent@example.com>\n"
+        b"Subject: second subject\n"
+        b"\n"
+    )
+
+    def assertMatchesEmailParser(self, header: bytes):
+        expected = BytesParser(policy=policy.default).parsebytes(header + b"body\n")
+        block = HeaderBlock(header)
+        for name in sorted(parser_service.HEADER_ONLY_FIELDS):
+            with self.subTest(name=name):
+                self.assertEqual(
+                    [str(v) for v in block.get_all(name) or []],
+                    [str(v) for v in expected.get_all(name) or []],
+                )
+                self.assertEqual(str(block.get(name, "")), str(expected.get(name, "")))
+
+    def test_folded_encoded_and_duplicate_headers(self):
+        self.assertMatchesEmailParser(self.HEADERS)
+
+    def test_crlf_line_endings(self):
+        self.assertMatchesEmailParser(self.HEADERS.replace(b"\n", b"\r\n"))
+
+    def test_plain_headers(self):
+        self.assertMatchesEmailParser(make_raw(7, in_reply_to="<m6@example.com>").split(b"\n\n", 1)[0] + b"\n\n")
+
+class BodiesBackfillTests(TestCase):
+    def _header_only(self, raw: bytes):
+        header = raw.split(b"\n\n", 1)[0] + b"\n\n"
+        return parse_and_normalize(HeaderOnly(header), len(raw))
+
+    def test_header_only_rows_are_filled_or_merged(self):
+        person_cache = PersonCache()
+        session = ImportSession()
+        inbox = session.folder(ACCOUNT, "fake", "INBOX")
+        archive = session.folder(ACCOUNT, "fake", "Archive")
+        full, missing = make_raw(1, html=True), make_raw(2)
+        # message 1 was imported in full from Archive, both were imported header-only from INBOX
+        with self.captureOnCommitCallbacks(execute=True):
+            load_sql_batch(ACCOUNT, "fake", "Archive", [ImportItem(5, [], None, parse_and_normalize(full, len(full)))],
+                           person_cache=person_cache, folder=archive)
+            load_sql_batch(ACCOUNT, "fake", "INBOX", [
+                ImportItem(uid, ["\\Seen"], None, self._header_only(raw)) for uid, raw in ((1, full), (2, missing))
+            ], person_cache=person_cache, folder=inbox)
+        self.assertEqual(Message.objects.filter(has_body=False).count(), 2)
+        stored = Message.objects.get(has_body=True)
+
+        items = [ImportItem(uid, [], None, parse_and_normalize(raw, len(raw))) for uid, raw in ((1, full), (2, missing))]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(load_bodies_batch(inbox.mailbox, items, person_cache), (1, 1))
+        self.assertFalse(Message.objects.filter(has_body=False).exists())
+        self.assertEqual(Message.objects.count(), 2)
+        links = dict(MailboxMessage.objects.filter(mailbox=inbox.mailbox).values_list("uid", "message_id"))
+        self.assertEqual(links[1], stored.pk)  # moved to the copy already stored
+        filled = Message.objects.get(pk=links[2])
+        self.assertEqual(filled.raw_sha256, items[1].normalized.raw_sha256)
+        self.assertEqual(filled.body_text.strip(), "body 2")
+        self.assertEqual(Recipient.objects.filter(message=filled).count(), 2)
+        self.assertEqual(MailboxMessage.objects.get(mailbox=inbox.mailbox, uid=1).flags_json, ["\\Seen"])
+
+class UpsertMessageBodiesTests(TestCase):
+    def _normalized(self, i: int):
+        raw = make_raw(i, html=True)
+        return parse_and_normalize(raw, len(raw))
+
+    @override_settings(BODY_STORAGE="table")
+    def test_bodies_stored_for_new_messages_only(self):
+        n = self._normalized(1)
+        with override_settings(BODY_STORAGE="inline"):
+            upsert_message_and_relations(n)
+        _msg, created = upsert_message_and_relations(n)
+        self.assertFalse(created)
+        self.assertEqual(MessageBody.objects.count(), 0)
+
+        msg, created = upsert_message_and_relations(self._normalized(2))
+        self.assertTrue(created)
+        self.assertIsNotNone(msg.html_body_id)
+        self.assertEqual(MessageBody.objects.count(), len({msg.text_body_id, msg.html_body_id} - {None}))
+        self.assertIn("Hi 2", msg.get_body_html())
+
+class ConcurrentInsertTests(TestCase):
+    def test_row_inserted_by_another_writer_is_not_created_again(self):
+        normalized = [parse_and_normalize(make_raw(i), 0) for i in range(1, 4)]
+        raced = normalized[1]
+        resolve = dedup.resolve_threads_bulk
+
+        def other_writer_first(subjects):
+            # runs after the in_bulk lookup, before the insert
+            Message.objects.create(raw_sha256=raced.raw_sha256, message_id=raced.message_id)
+            return resolve(subjects)
+
+        with mock.patch.object(dedup, "resolve_threads_bulk", other_writer_first):
+            messages, created = upsert_messages_bulk(((n, None) for n in normalized), person_cache=PersonCache())
+        self.assertEqual(created, {normalized[0].raw_sha256, normalized[2].raw_sha256})
+        self.assertEqual(set(messages), {n.raw_sha256 for n in normalized})
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertFalse(Recipient.objects.filter(message=messages[raced.raw_sha256]).exists())
+        self.assertEqual(Recipient.objects.filter(message=messages[normalized[0].raw_sha256]).count(), 2)
+
+class ReprocessTests(TestCase):
+    def test_spool_round_trip_keeps_stored_fields(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        raws = [make_raw(i, html=i % 2 == 0) for i in range(1, 5)]
+        normalized = []
+        for raw in raws:
+            n = parse_and_normalize(raw, len(raw))
+            n.size = len(raw) + 100  # the server's RFC822.SIZE need not match the raw bytes
+            normalized.append(n)
+        with self.captureOnCommitCallbacks(execute=True):
+            upsert_messages_bulk(((n, None) for n in normalized), person_cache=PersonCache())
+        before = list(Message.objects.order_by("id").values())
+        recipients = list(Recipient.objects.order_by("id").values_list("message_id", "person_id", "type"))
+        Message.objects.update(subject="x", body_text="")
+        with RawSpool(root, level=1) as spool, ParsePool() as pool:
+            spool.put_many((n.raw_sha256, raw) for n, raw in zip(normalized, raws))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(reprocess_spool(spool, pool, batch_size=3, person_cache=PersonCache()), len(raws))
+        self.assertEqual(list(Message.objects.order_by("id").values()), before)
+        self.assertEqual(sorted(Recipient.objects.values_list("message_id", "person_id", "type")), sorted(recipients))
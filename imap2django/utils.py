@@ -4,6 +4,13 @@ import re
 def sha256_bytes(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
+def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
 def norm_email(email: str) -> str:
     return (email or "").strip().lower()
 
@@ -14,3 +21,19 @@ def norm_subject(subject: str) -> str:
     s = SUBJECT_PREFIX_RE.sub("", s).strip()
     s = re.sub(r"\s+", " ", s)
     return s.lower()
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_byte_size(value: str) -> int:
+    """
+    "64M" -> 67108864. Accepts plain integers and K/M/G suffixes (optionally with B).
+    """
+    v = (value or "").strip().upper()
+    if v.endswith("B"):
+        v = v[:-1]
+    unit = v[-1:] if v[-1:] in _SIZE_UNITS else ""
+    number = v[:-1] if unit else v
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"invalid size: {value!r}")
@@ -132,4 +132,14 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 NEO4J_URI = os.getenv("NEO4J_URI", "")
 NEO4J_USER = os.getenv("NEO4J_USER", "")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "")
\ No newline at end of file
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "")
+
+# Content-addressed attachment payload store (empty = keep attachment metadata only)
+ATTACHMENT_STORE_DIR = os.getenv("ATTACHMENT_STORE_DIR", "")
+
+# Compressed spool of raw messages for `reprocess` (empty = raw bytes are not kept)
+RAW_SPOOL_DIR = os.getenv("RAW_SPOOL_DIR", "")
+
+# Where message bodies go: "inline" (Message.body_text/body_html) or "table" (compressed,
+# deduplicated MessageBody rows; move existing ones with `manage.py store_bodies`)
+BODY_STORAGE = os.getenv("BODY_STORAGE", "inline")
\ No newline at end of file